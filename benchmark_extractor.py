@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Extraction, Caption Parsing and Export Throughput
+
+Generates synthetic saved-post corpora (realistic caption lengths, location reuse and
+video ratio) and measures rows/sec and peak memory (RSS) of every stage, without network
+access. Each stage runs in its own process so that its peak RSS is its own.
+
+    python benchmark_extractor.py                                    # 1k, 10k and 100k posts
+    python benchmark_extractor.py --scales 1000,1000000              # up to 1M posts
+    python benchmark_extractor.py --save-baseline bench_baseline.json
+    python benchmark_extractor.py --baseline bench_baseline.json     # exit 1 on a regression
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import instaloader
+
+from instagram_location_extractor import (EXPORTERS, InstagramLocationExtractor, LocationRecord, RequestScheduler,
+                                          analyze_captions, export_csv_chunks, export_records)
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+DEFAULT_TOLERANCE = 0.2
+SEED = 20240115
+# Captions and records generated for the caption and export stages, which cycle through them
+SAMPLE_SIZE = 10000
+
+WORDS = ('the', 'best', 'view', 'coffee', 'sunset', 'weekend', 'trip', 'with', 'friends', 'finally', 'here',
+         'brunch', 'museum', 'beach', 'hike', 'city', 'lights', 'dinner', 'love', 'this', 'place', 'again')
+EMOJIS = ('☕️', '🌅', '🗽', '🍕', '✨', '❤️', '🏔️', '🥐')
+VIDEO_RATIO = 0.25
+NO_LOCATION_RATIO = 0.15
+EMPTY_CAPTION_RATIO = 0.2
+MAX_CAPTION_LENGTH = 2200  # Instagram's limit
+
+
+def synthetic_caption(rng: random.Random) -> str:
+    """A caption of lognormally distributed length mixing words, hashtags, mentions, URLs and emoji"""
+    if rng.random() < EMPTY_CAPTION_RATIO:
+        return ''
+    length = min(MAX_CAPTION_LENGTH, int(rng.lognormvariate(4.5, 1.0)))
+    tokens = []
+    size = 0
+    while size < length:
+        roll = rng.random()
+        if roll < 0.1:
+            token = f'#{rng.choice(WORDS)}{rng.randrange(100)}'
+        elif roll < 0.15:
+            token = f'@{rng.choice(WORDS)}_{rng.randrange(1000)}'
+        elif roll < 0.17:
+            token = f'https://example.com/{rng.choice(WORDS)}/{rng.randrange(10 ** 6)}'
+        elif roll < 0.22:
+            token = rng.choice(EMOJIS)
+        else:
+            token = rng.choice(WORDS)
+        tokens.append(token)
+        size += len(token) + 1
+    return ' '.join(tokens)
+
+
+def synthetic_nodes(count: int, seed: int = SEED):
+    """Saved-post page nodes; popular locations are shared by many posts (Zipf-like reuse)"""
+    rng = random.Random(seed)
+    location_pool = max(1, count // 5)
+    for i in range(count):
+        location = None
+        if rng.random() >= NO_LOCATION_RATIO:
+            # Like real saved-post pages, the stub has no coordinates: they are fetched per location
+            location_id = int(location_pool * rng.random() ** 3)
+            location = {'id': str(location_id), 'name': f'Place {location_id}', 'slug': f'place-{location_id}',
+                        'has_public_page': True}
+        caption = synthetic_caption(rng)
+        is_video = rng.random() < VIDEO_RATIO
+        yield {
+            'shortcode': f'B{i:010d}',
+            'id': str(10 ** 12 + i),
+            'is_video': is_video,
+            'video_url': f'https://scontent.example.com/v/{i}.mp4' if is_video else None,
+            'taken_at_timestamp': 1500000000 + i * 97,
+            'edge_media_to_caption': {'edges': [{'node': {'text': caption}}] if caption else []},
+            'owner': {'id': str(rng.randrange(10 ** 6)), 'username': f'user_{rng.randrange(count // 10 + 1)}'},
+            'edge_media_preview_like': {'count': rng.randrange(100000)},
+            'edge_media_to_comment': {'count': rng.randrange(2000)},
+            'location': location,
+        }
+
+
+def location_info(location_id: int) -> dict:
+    """The explore/locations/ response fields of a synthetic location"""
+    rng = random.Random(location_id)
+    return {'id': str(location_id), 'name': f'Place {location_id}', 'slug': f'place-{location_id}',
+            'has_public_page': True, 'lat': rng.uniform(-60, 70), 'lng': rng.uniform(-180, 180)}
+
+
+class SyntheticSavedPosts(instaloader.NodeIterator):
+    """Saved posts generated page by page, so that even 1M posts are never all in memory"""
+
+    def __init__(self, context, count: int, seed: int = SEED):
+        self._nodes = synthetic_nodes(count, seed)
+        self._count = count
+        self._served = 0
+        super().__init__(context, 'benchmark_saved_posts', lambda d: d,
+                         lambda n: instaloader.Post(context, n), {'id': 42})
+
+    def _query(self, after=None):
+        page = [{'node': next(self._nodes)} for _ in range(min(self.page_length(), self._count - self._served))]
+        self._served += len(page)
+        self._best_before = datetime.now() + instaloader.NodeIterator._shelf_life
+        return {'edges': page, 'count': self._count,
+                'page_info': {'has_next_page': self._served < self._count, 'end_cursor': str(self._served)}}
+
+
+def make_benchmark_extractor(count: int) -> InstagramLocationExtractor:
+    """Extractor reading a synthetic corpus; location pages are answered in-process"""
+    extractor = InstagramLocationExtractor(scheduler=RequestScheduler(sleep=lambda seconds: None))
+    context = extractor.loader.context
+    context.username = 'benchmark'
+    context.iphone_support = False
+    context.sleep = False
+
+    def get_json(path, params, *args, **kwargs):
+        return {'native_location_data': {'location_info': location_info(int(path.split('/')[2]))}}
+
+    context.get_json = get_json
+    extractor._get_saved_posts = lambda: SyntheticSavedPosts(context, count)
+    return extractor
+
+
+def synthetic_records(count: int, seed: int = SEED):
+    """LocationRecords as extraction would produce them, for the export stages"""
+    for node in synthetic_nodes(count, seed):
+        if node['location'] is None:
+            continue
+        info = location_info(int(node['location']['id']))
+        edges = node['edge_media_to_caption']['edges']
+        yield LocationRecord(node['shortcode'], info['name'], info['lat'], info['lng'], '2024-01-15 10:30:00',
+                             edges[0]['node']['text'] if edges else '', owner_username=node['owner']['username'],
+                             likes=node['edge_media_preview_like']['count'],
+                             comments=node['edge_media_to_comment']['count'], is_video=node['is_video'],
+                             video_url=node['video_url'] or '')
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(rows_func) -> dict:
+    """Run a stage, returning its row count, duration, rows/sec and the process's peak RSS after it"""
+    started = time.perf_counter()
+    rows = rows_func()
+    seconds = time.perf_counter() - started
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_sec': round(rows / seconds, 1) if seconds else 0.0,
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def cycle(sample: list, count: int):
+    """``count`` items taken round-robin from a sample, so that generating the data is not timed"""
+    for i in range(count):
+        yield sample[i % len(sample)]
+
+
+STAGES = ['extract', 'captions'] + [f'export_{name}' for name in EXPORTERS] + ['export_all', 'export_chunked']
+
+
+def run_stage(count: int, stage: str) -> dict:
+    """Benchmark one stage (see STAGES) on a corpus of ``count`` saved posts, in this process"""
+    sample_size = min(count, SAMPLE_SIZE)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if stage == 'extract':
+            extractor = make_benchmark_extractor(count)
+            return timed(lambda: sum(1 for _ in extractor.iter_locations()))
+
+        if stage == 'captions':
+            captions = [edges[0]['node']['text'] if edges else '' for edges in
+                        (node['edge_media_to_caption']['edges'] for node in synthetic_nodes(sample_size))]
+            return timed(lambda: sum(1 for _ in analyze_captions(cycle(captions, count))))
+
+        records = list(synthetic_records(sample_size))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if stage == 'export_all':
+                outputs = {name: os.path.join(tmpdir, f'all.{exporter.extension}')
+                           for name, exporter in EXPORTERS.items()}
+                return timed(lambda: export_records(cycle(records, count), outputs)['csv'])
+            if stage == 'export_chunked':
+                return timed(
+                    lambda: export_csv_chunks(cycle(records, count), os.path.join(tmpdir, 'chunk'))['total_rows'])
+            format_name = stage[len('export_'):]
+            filename = os.path.join(tmpdir, f'bench.{EXPORTERS[format_name].extension}')
+            return timed(lambda: export_records(cycle(records, count), {format_name: filename})[format_name])
+
+
+def run_scale(count: int) -> dict:
+    """Benchmark every stage on a corpus of ``count`` saved posts
+
+    Each stage runs in a fresh process: the peak RSS of a process only ever grows, so stages
+    sharing one would all report the peak of the hungriest stage before them.
+    """
+    results = {}
+    for stage in STAGES:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-stage', str(count), stage],
+                                check=True, capture_output=True, text=True).stdout
+        results[stage] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions against a baseline: stages slower, or using more memory, by more than ``tolerance``"""
+    regressions = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            before = baseline.get(scale, {}).get(stage)
+            if not before:
+                continue
+            if result['rows_per_sec'] < before['rows_per_sec'] * (1 - tolerance):
+                regressions.append(f"{scale} posts, {stage}: {result['rows_per_sec']:.0f} rows/sec "
+                                   f"(baseline {before['rows_per_sec']:.0f})")
+            if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+                regressions.append(f"{scale} posts, {stage}: peak RSS {result['peak_rss_mb']:.0f} MB "
+                                   f"(baseline {before['peak_rss_mb']:.0f} MB)")
+    return regressions
+
+
+def print_report(results: dict, baseline: dict = None):
+    print(f"{'Posts':>9}  {'Stage':<16}{'Rows':>9}{'Seconds':>10}{'Rows/sec':>12}{'Peak RSS':>11}{'vs baseline':>13}")
+    print("-" * 82)
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            before = (baseline or {}).get(scale, {}).get(stage)
+            change = f"{result['rows_per_sec'] / before['rows_per_sec'] - 1:+.0%}" if before else ''
+            print(f"{scale:>9}  {stage:<16}{result['rows']:>9}{result['seconds']:>10.2f}"
+                  f"{result['rows_per_sec']:>12.0f}{result['peak_rss_mb']:>8.0f} MB{change:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extraction and export on synthetic saved posts")
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help="comma-separated corpus sizes in posts (default: %(default)s)")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against results saved with --save-baseline")
+    parser.add_argument('--save-baseline', metavar='FILE', help="save the results as a baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown or memory growth against the baseline (default: %(default)s)")
+    parser.add_argument('--run-stage', nargs=2, metavar=('POSTS', 'STAGE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(int(args.run_stage[0]), args.run_stage[1])))
+        return
+
+    print("=" * 82)
+    print("Instagram Location Extractor - Benchmark")
+    print("=" * 82)
+    results = {}
+    for scale in (int(scale) for scale in args.scales.split(',')):
+        print(f"Running {scale} posts...", flush=True)
+        results[str(scale)] = run_scale(scale)
+    print()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+                       'results': results}, f, indent=2)
+        print(f"\n✓ Baseline saved to {args.save_baseline}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n✗ {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\n✓ No regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,169 +4,2714 @@ Instagram Collection Location Extractor
 Extracts location data from Instagram saved collections and exports to CSV for Google Maps
 """
 
-import instaloader
 import csv
 import sys
 import re
+import os
+import json
+import hashlib
+import math
+import heapq
+import io
+import unicodedata
+from difflib import SequenceMatcher
+import sqlite3
+from html import escape
+import argparse
+import contextlib
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import List, Dict, Optional
+from urllib.parse import urlsplit
+from typing import (AsyncIterator, Callable, FrozenSet, Generator, Iterable, Iterator, List, Dict, NamedTuple,
+                    Optional, Tuple)
 import getpass
+import functools
+import importlib.util
 
 
-class InstagramLocationExtractor:
+def _lazy_import(name: str):
+    """Import a module on first attribute access, so that offline commands never load it"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# instaloader and requests take longer to import than everything else; only network paths need them
+instaloader = _lazy_import('instaloader')
+requests = _lazy_import('requests')
+# Only used by aiter_locations() and batch runs
+asyncio = _lazy_import('asyncio')
+concurrent_process = _lazy_import('concurrent.futures.process')
+
+
+# Default on-disk cache used by main(); re-runs only fetch new or stale posts
+DEFAULT_CACHE_PATH = 'instagram_cache.sqlite3'
+
+# Likes/comments change over time, everything else in a post record is stable
+VOLATILE_FIELDS = ('likes', 'comments')
+DEFAULT_VOLATILE_TTL = 7 * 24 * 60 * 60
+
+# Resume information written after every completed page of saved posts
+DEFAULT_CHECKPOINT_PATH = 'instagram_extractor_resume.json'
+
+# Request budgets in requests per second, matching the sliding windows of instaloader's
+# own RateController (200 GraphQL / 75 other queries per 11 minutes, 199 iPhone per 30 minutes)
+DEFAULT_RATE_BUDGETS = {'graphql': 200 / 660, 'iphone': 199 / 1800, 'other': 75 / 660}
+
+# Concurrent per-post enrichment; requests still go through the shared RequestScheduler
+DEFAULT_WORKERS = 4
+# Pages of saved posts fetched ahead, while the current page is being extracted
+DEFAULT_PREFETCH_PAGES = 2
+# Saved collections crawled at once by iter_collection_locations()
+DEFAULT_COLLECTION_CONCURRENCY = 2
+# A saved session saved or verified within this time is trusted without a test request
+SESSION_TRUST_SECONDS = 24 * 3600
+
+# Number of newest saved shortcodes remembered as the incremental sync watermark.
+# More than one, so that un-saving the newest post does not invalidate the watermark.
+WATERMARK_SIZE = 12
+
+
+# URL pattern - matches http:// and https:// URLs
+URL_PATTERN = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+URL_REGEX = re.compile(URL_PATTERN)
+
+# One pass over a caption finds URLs, hashtags, mentions and emoji. Hashtags and mentions follow
+# instaloader's Post.caption_hashtags/caption_mentions patterns (mentions are ASCII-only and must
+# not follow a letter or digit); '#' and '@' inside URLs are part of the URL.
+CAPTION_TOKEN_REGEX = re.compile(
+    '(?P<url>' + URL_PATTERN + ')'
+    r'|#(?P<hashtag>\w{1,150})'
+    r'|(?a:(?<![A-Za-z0-9])@(?P<mention>\w(?:(?:\w|(?:\.(?!\.))){0,28}(?:\w))?))'
+    '|(?P<emoji>[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF])'
+)
+
+
+class CaptionAnalysis(NamedTuple):
+    """URLs, lowercased hashtags and mentions (without # and @) and emoji count of a caption"""
+    urls: List[str]
+    hashtags: List[str]
+    mentions: List[str]
+    emoji_count: int
+
+
+def analyze_caption(text: Optional[str]) -> CaptionAnalysis:
+    """Tokenize a caption in a single pass with the precompiled CAPTION_TOKEN_REGEX"""
+    urls, hashtags, mentions = [], [], []
+    emoji_count = 0
+    if text:
+        for match in CAPTION_TOKEN_REGEX.finditer(text):
+            kind = match.lastgroup
+            if kind == 'url':
+                urls.append(match.group())
+            elif kind == 'hashtag':
+                hashtags.append(match.group(kind).lower())
+            elif kind == 'mention':
+                mentions.append(match.group(kind).lower())
+            else:
+                emoji_count += 1
+    return CaptionAnalysis(urls, hashtags, mentions, emoji_count)
+
+
+def analyze_captions(texts: Iterable[Optional[str]]) -> Iterator[CaptionAnalysis]:
+    """Analyze a batch of captions lazily, e.g. to re-derive columns from cached captions"""
+    return map(analyze_caption, texts)
+
+
+# Columns of the Google My Maps compatible CSV export
+CSV_COLUMNS = [
+    'Name', 'Latitude', 'Longitude', 'Description', 'URL', 'Date',
+    'Caption_Full', 'Caption_URLs', 'Hashtags', 'Mentions',
+    'Owner_Username', 'Likes', 'Comments', 'Is_Video', 'Video_URL',
+    'Display_URL', 'Image_File', 'Video_File', 'Collection', 'Cluster_Size'
+]
+# Record field behind each of CSV_COLUMNS
+CSV_COLUMN_FIELDS = [
+    'name', 'latitude', 'longitude', 'caption', 'post_url', 'date',
+    'caption', 'caption_urls', 'hashtags', 'mentions',
+    'owner_username', 'likes', 'comments', 'is_video', 'video_url',
+    'display_url', 'image_file', 'video_file', 'collection', 'cluster_size'
+]
+
+# Fields of a location record (the keys of LocationRecord.to_dict()), and those every record has
+RECORD_FIELDS = ('name', 'latitude', 'longitude', 'post_url', 'date', 'caption', 'caption_urls', 'hashtags',
+                 'mentions', 'owner_username', 'likes', 'comments', 'is_video', 'video_url', 'display_url',
+                 'image_file', 'video_file', 'collection', 'cluster_size')
+REQUIRED_FIELDS = ('name', 'latitude', 'longitude', 'post_url')
+# Fields read from a post's (lazy) properties; the others come from its location or later stages
+POST_FIELDS = frozenset(('date', 'caption', 'caption_urls', 'hashtags', 'mentions', 'owner_username', 'likes',
+                         'comments', 'is_video', 'video_url', 'display_url'))
+CAPTION_FIELDS = frozenset(('caption', 'caption_urls', 'hashtags', 'mentions'))
+
+
+def select_fields(fields: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    """Check a field selection, returning it in RECORD_FIELDS order with REQUIRED_FIELDS added
+
+    None (all fields) is returned as is. Raises ValueError for unknown fields.
+    """
+    if fields is None:
+        return None
+    fields = set(fields)
+    unknown = fields - set(RECORD_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))} (available: {', '.join(RECORD_FIELDS)})")
+    fields.update(REQUIRED_FIELDS)
+    return tuple(field for field in RECORD_FIELDS if field in fields)
+
+
+def csv_columns(fields: Optional[Iterable[str]] = None) -> List[str]:
+    """The CSV_COLUMNS holding the given fields (all of them for None)"""
+    if fields is None:
+        return list(CSV_COLUMNS)
+    return [column for column, field in zip(CSV_COLUMNS, CSV_COLUMN_FIELDS) if field in fields]
+
+
+class LocationRecord:
+    """Location data extracted from one saved post
+
+    Slotted, with the post URL derived from the shortcode and repeated strings
+    (location names, owner usernames) interned, so that large archives stay compact.
+    Plain dicts (to_dict()/from_dict()) are only used for JSON storage and at the API edge.
+    """
+
+    __slots__ = ('shortcode', 'name', 'latitude', 'longitude', 'date', 'caption', 'caption_urls',
+                 'hashtags', 'mentions', 'owner_username', 'likes', 'comments', 'is_video', 'video_url',
+                 'display_url', 'image_file', 'video_file', 'collection', 'cluster_size')
+
+    def __init__(self, shortcode: str, name: str, latitude: Optional[float], longitude: Optional[float],
+                 date: str, caption: str = '', caption_urls: str = '', hashtags: str = '', mentions: str = '',
+                 owner_username: str = '', likes: Optional[int] = None, comments: Optional[int] = None,
+                 is_video: bool = False, video_url: str = '', display_url: str = '', image_file: str = '',
+                 video_file: str = '', collection: str = '', cluster_size: Optional[int] = None):
+        self.shortcode = shortcode
+        self.name = sys.intern(name) if name else ''
+        self.latitude = latitude
+        self.longitude = longitude
+        self.date = date
+        self.caption = caption
+        self.caption_urls = caption_urls
+        self.hashtags = hashtags
+        self.mentions = mentions
+        self.owner_username = sys.intern(owner_username) if owner_username else ''
+        self.likes = likes
+        self.comments = comments
+        self.is_video = is_video
+        self.video_url = video_url
+        # Image (or video thumbnail) URL on Instagram's CDN, and the local copies of the media
+        # once downloaded by a MediaDownloader
+        self.display_url = display_url
+        self.image_file = image_file
+        self.video_file = video_file
+        # Name of the saved collection the post was extracted from, if extracted by collection
+        self.collection = sys.intern(collection) if collection else ''
+        # Number of locations merged into this one by dedupe_locations(), if deduplicated
+        self.cluster_size = cluster_size
+
+    @property
+    def post_url(self) -> str:
+        return f"https://www.instagram.com/p/{self.shortcode}/"
+
+    def to_dict(self, fields: Optional[Iterable[str]] = None) -> Dict[str, any]:
+        """Convert to the dict layout used by earlier versions (and the cache), or to the given fields of it"""
+        data = {
+            'name': self.name,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'post_url': self.post_url,
+            'date': self.date,
+            'caption': self.caption,
+            'caption_urls': self.caption_urls,
+            'hashtags': self.hashtags,
+            'mentions': self.mentions,
+            'owner_username': self.owner_username,
+            'likes': self.likes,
+            'comments': self.comments,
+            'is_video': self.is_video,
+            'video_url': self.video_url,
+            'display_url': self.display_url,
+            'image_file': self.image_file,
+            'video_file': self.video_file,
+            'collection': self.collection,
+            'cluster_size': self.cluster_size
+        }
+        if fields is None:
+            return data
+        return {field: value for field, value in data.items() if field in fields}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, any]) -> 'LocationRecord':
+        """Create a record from a dict as returned by to_dict()"""
+        shortcode = data.get('shortcode') or data['post_url'].rstrip('/').rsplit('/', 1)[-1]
+        return cls(shortcode, data['name'], data['latitude'], data['longitude'], data.get('date') or '',
+                   data.get('caption') or '', data.get('caption_urls') or '', data.get('hashtags') or '',
+                   data.get('mentions') or '', data.get('owner_username') or '', data.get('likes'),
+                   data.get('comments'), bool(data.get('is_video')), data.get('video_url') or '',
+                   data.get('display_url') or '', data.get('image_file') or '', data.get('video_file') or '',
+                   data.get('collection') or '', data.get('cluster_size'))
+
+    @classmethod
+    def from_csv_row(cls, row: Dict[str, str]) -> 'LocationRecord':
+        """Create a record from a row of an exported CSV (keyed by CSV_COLUMNS)"""
+        def number(value, kind):
+            return kind(value) if value not in (None, '') else None
+        return cls(row['URL'].rstrip('/').rsplit('/', 1)[-1], row['Name'], number(row['Latitude'], float),
+                   number(row['Longitude'], float), row.get('Date') or '', row.get('Caption_Full') or '',
+                   row.get('Caption_URLs') or '', row.get('Hashtags') or '', row.get('Mentions') or '',
+                   row.get('Owner_Username') or '', number(row.get('Likes'), int),
+                   number(row.get('Comments'), int), row.get('Is_Video') == 'Yes', row.get('Video_URL') or '',
+                   row.get('Display_URL') or '', row.get('Image_File') or '', row.get('Video_File') or '',
+                   row.get('Collection') or '', number(row.get('Cluster_Size'), int))
+
+    def csv_row(self, fields: Optional[Iterable[str]] = None) -> list:
+        """Values in CSV_COLUMNS order, or in csv_columns(fields) order"""
+        row = [
+            self.name,
+            self.latitude,
+            self.longitude,
+            self.caption[:200],  # Truncated for Google Maps display
+            self.post_url,
+            self.date,
+            self.caption,
+            self.caption_urls,
+            self.hashtags,
+            self.mentions,
+            self.owner_username,
+            self.likes,
+            self.comments,
+            'Yes' if self.is_video else 'No',
+            self.video_url,
+            self.display_url,
+            self.image_file,
+            self.video_file,
+            self.collection,
+            self.cluster_size
+        ]
+        if fields is None:
+            return row
+        return [value for value, field in zip(row, CSV_COLUMN_FIELDS) if field in fields]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, LocationRecord):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"<LocationRecord {self.shortcode} {self.name!r} ({self.latitude}, {self.longitude})>"
+
+
+# Exporter classes by format name, filled by @register_exporter
+EXPORTERS: Dict[str, type] = {}
+
+
+def register_exporter(name: str):
+    """Class decorator registering an Exporter subclass under a format name"""
+    def decorator(cls):
+        cls.format_name = name
+        EXPORTERS[name] = cls
+        return cls
+    return decorator
+
+
+class Exporter:
+    """Streaming writer for one output format
+
+    Subclasses write their header in begin(), one record per write_record() call and their
+    footer in end(). Every record is flushed to disk right away, and close() always writes the
+    footer, so an aborted export still leaves a well-formed file. With ``fields`` (see
+    select_fields()), only those fields of the records are written.
+    """
+
+    format_name = ''
+    extension = ''
+
+    def __init__(self, filename: str, fields: Optional[Iterable[str]] = None):
+        self.filename = filename
+        self.fields = None if fields is None else frozenset(fields)
+        self.count = 0
+        # Time spent writing records, and the file size once closed
+        self.seconds = 0.0
+        self.bytes = 0
+        self.file = open(filename, 'w', newline='', encoding='utf-8')
+        self.begin()
+
+    def includes(self, field: str) -> bool:
+        return self.fields is None or field in self.fields
+
+    def begin(self):
+        pass
+
+    def write_record(self, record: LocationRecord):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+    def write(self, record: LocationRecord):
+        started = time.perf_counter()
+        self.write_record(record)
+        self.file.flush()
+        self.count += 1
+        self.seconds += time.perf_counter() - started
+
+    def close(self):
+        if not self.file.closed:
+            self.end()
+            self.bytes = self.file.tell()
+            self.file.close()
+
+    def record_metrics(self, metrics: Optional['RunMetrics']):
+        """Add this export's time, rows and bytes to a run's metrics"""
+        if metrics is not None:
+            metrics.add_time('export', self.seconds)
+            metrics.increment('rows_written', self.count)
+            metrics.increment('bytes_written', self.bytes)
+
+
+@register_exporter('csv')
+class CsvExporter(Exporter):
+    """Google My Maps compatible CSV"""
+
+    extension = 'csv'
+
+    def begin(self):
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(csv_columns(self.fields))
+
+    def write_record(self, record: LocationRecord):
+        self.writer.writerow(record.csv_row(self.fields))
+
+
+@register_exporter('geojson')
+class GeoJsonExporter(Exporter):
+    """GeoJSON FeatureCollection of Point features, written feature by feature"""
+
+    extension = 'geojson'
+
+    def begin(self):
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+
+    def write_record(self, record: LocationRecord):
+        has_coordinates = record.latitude is not None and record.longitude is not None
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [record.longitude, record.latitude]}
+            if has_coordinates else None,
+            'properties': record.to_dict(self.fields),
+        }
+        self.file.write((',\n' if self.count else '') + json.dumps(feature, ensure_ascii=False))
+
+    def end(self):
+        self.file.write('\n]}\n')
+
+
+@register_exporter('kml')
+class KmlExporter(Exporter):
+    """KML document with one Placemark per location"""
+
+    extension = 'kml'
+
+    def begin(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+                        '<name>Instagram saved locations</name>\n')
+
+    def write_record(self, record: LocationRecord):
+        caption = record.caption if self.includes('caption') else ''
+        description = f"{caption[:200]}\n{record.post_url}" if caption else record.post_url
+        self.file.write(f"<Placemark>\n<name>{escape(record.name, quote=False)}</name>\n"
+                        f"<description>{escape(description, quote=False)}</description>\n")
+        if record.date and self.includes('date'):
+            self.file.write(f"<TimeStamp><when>{record.date.replace(' ', 'T')}</when></TimeStamp>\n")
+        if record.latitude is not None and record.longitude is not None:
+            self.file.write(f"<Point><coordinates>{record.longitude},{record.latitude},0</coordinates></Point>\n")
+        self.file.write('</Placemark>\n')
+
+    def end(self):
+        self.file.write('</Document>\n</kml>\n')
+
+
+@register_exporter('ndjson')
+class NdjsonExporter(Exporter):
+    """Newline-delimited JSON, one location dict per line"""
+
+    extension = 'ndjson'
+
+    def write_record(self, record: LocationRecord):
+        self.file.write(json.dumps(record.to_dict(self.fields), ensure_ascii=False) + '\n')
+
+
+def export_records(locations: Iterable[LocationRecord], outputs: Dict[str, str],
+                   metrics: Optional['RunMetrics'] = None, fields: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """Write locations to several formats in a single pass over them
+
+    ``outputs`` maps format names (see EXPORTERS) to filenames. Location dicts are accepted as
+    well. Returns the number of locations written per format. The time spent writing (not
+    waiting for locations), rows and bytes are added to ``metrics``. With ``fields``, only those
+    fields are written.
+    """
+    unknown = set(outputs) - set(EXPORTERS)
+    if unknown:
+        raise ValueError(f"Unknown export format(s): {', '.join(sorted(unknown))}")
+    exporters = []
+    try:
+        for format_name, filename in outputs.items():
+            exporters.append(EXPORTERS[format_name](filename, fields))
+        for location in locations:
+            if isinstance(location, dict):
+                location = LocationRecord.from_dict(location)
+            for exporter in exporters:
+                exporter.write(location)
+    finally:
+        for exporter in exporters:
+            exporter.close()
+            exporter.record_metrics(metrics)
+    return {exporter.format_name: exporter.count for exporter in exporters}
+
+
+# Google My Maps import limits per layer
+MY_MAPS_MAX_ROWS = 2000
+MY_MAPS_MAX_BYTES = 5 * 1024 * 1024
+CHUNK_GROUPINGS = ('region', 'year', 'month')
+
+
+def chunk_group(record: LocationRecord, group_by: Optional[str]) -> str:
+    """Name of the layer a location belongs to: a 10° grid square, the year or the month saved"""
+    if group_by == 'region':
+        if record.latitude is None or record.longitude is None:
+            return 'unknown'
+        lat, lng = math.floor(record.latitude / 10) * 10, math.floor(record.longitude / 10) * 10
+        return f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}_{'E' if lng >= 0 else 'W'}{abs(lng):03d}"
+    if group_by in ('year', 'month'):
+        return (record.date or '')[:4 if group_by == 'year' else 7] or 'undated'
+    if group_by is not None:
+        raise ValueError(f"Unknown grouping: {group_by} (expected one of {', '.join(CHUNK_GROUPINGS)})")
+    return ''
+
+
+def export_csv_chunks(locations: Iterable[LocationRecord], basename: str, max_rows: int = MY_MAPS_MAX_ROWS,
+                      max_bytes: int = MY_MAPS_MAX_BYTES, group_by: Optional[str] = None,
+                      metrics: Optional['RunMetrics'] = None,
+                      fields: Optional[Iterable[str]] = None) -> Dict[str, any]:
+    """Stream locations into CSV files small enough to import as Google My Maps layers
+
+    A new file is started whenever the next row would push the current one past ``max_rows``
+    rows or ``max_bytes`` bytes. With ``group_by`` ('region', 'year' or 'month'), every group
+    gets its own files, so each one makes a sensible layer. The files are named
+    ``<basename>[_<group>]_<part>.csv`` and listed in ``<basename>_manifest.json``, which is
+    also written if the export stops on an error. Returns the manifest. The time spent writing,
+    rows and bytes are added to ``metrics``. With ``fields``, only those fields are written.
+    """
+    chunk_group(LocationRecord('', '', None, None, ''), group_by)  # reject unknown groupings up front
+    fields = None if fields is None else frozenset(fields)
+    header = ','.join(csv_columns(fields)) + '\r\n'
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    chunks: List[Dict[str, any]] = []
+    open_chunks: Dict[str, Tuple[io.TextIOWrapper, Dict[str, any]]] = {}
+    manifest_path = f'{basename}_manifest.json'
+    directory = os.path.dirname(basename)
+    seconds = 0.0
+    try:
+        for location in locations:
+            started = time.perf_counter()
+            if isinstance(location, dict):
+                location = LocationRecord.from_dict(location)
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(location.csv_row(fields))
+            row = buffer.getvalue()
+            row_bytes = len(row.encode('utf-8'))
+
+            group = chunk_group(location, group_by)
+            f, chunk = open_chunks.get(group, (None, None))
+            if chunk is None or chunk['rows'] >= max_rows or chunk['bytes'] + row_bytes > max_bytes:
+                if f is not None:
+                    f.close()
+                part = sum(1 for c in chunks if c['group'] == group) + 1
+                safe_group = re.sub(r'[^\w-]', '_', group)
+                filename = f"{basename}_{safe_group}_{part:03d}.csv" if group else f"{basename}_{part:03d}.csv"
+                f = open(filename, 'w', newline='', encoding='utf-8')
+                f.write(header)
+                chunk = {'file': os.path.relpath(filename, directory or '.'), 'group': group, 'part': part,
+                         'rows': 0, 'bytes': len(header)}
+                chunks.append(chunk)
+                open_chunks[group] = (f, chunk)
+            f.write(row)
+            f.flush()
+            chunk['rows'] += 1
+            chunk['bytes'] += row_bytes
+            seconds += time.perf_counter() - started
+    finally:
+        for f, _ in open_chunks.values():
+            f.close()
+        if metrics is not None:
+            metrics.add_time('export', seconds)
+            metrics.increment('rows_written', sum(chunk['rows'] for chunk in chunks))
+            metrics.increment('bytes_written', sum(chunk['bytes'] for chunk in chunks))
+        manifest = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'group_by': group_by,
+            'max_rows': max_rows,
+            'max_bytes': max_bytes,
+            'total_rows': sum(chunk['rows'] for chunk in chunks),
+            'chunks': chunks,
+        }
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return manifest
+
+
+def read_export(filename: str) -> Iterator[LocationRecord]:
+    """Read locations back from a CSV, GeoJSON or NDJSON export"""
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        if extension == 'csv':
+            for row in csv.DictReader(f):
+                yield LocationRecord.from_csv_row(row)
+        elif extension == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield LocationRecord.from_dict(json.loads(line))
+        elif extension == 'geojson':
+            for feature in json.load(f)['features']:
+                yield LocationRecord.from_dict(feature['properties'])
+        else:
+            raise ValueError(f"Cannot read locations from {filename} (expected .csv, .geojson or .ndjson)")
+
+
+class LocationFilter:
+    """Predicates on location records, evaluated as early as the data allows
+
+    ``since`` and ``until`` are dates (YYYY-MM-DD, inclusive). ``bbox`` is (min_lat, min_lng,
+    max_lat, max_lng), crossing the antimeridian if min_lng > max_lng; ``near`` is (lat, lng,
+    radius_km). ``hashtags`` and ``owners`` match posts with any of them (case-insensitive);
+    ``has_video`` keeps only videos (True) or only photos (False). Records without a date or
+    coordinates never match the filters that need them.
+
+    matches() tests a record. During an extraction, may_match() first tests the post's page
+    node (and the coordinates of its location, if already known), so that posts it rules out
+    never have their lazy properties resolved. Saved posts come in the order they were saved,
+    not by date, so pagination only stops early for ``since`` when asked to with
+    ``stop_before_since``: then the extraction stops after the first page whose posts are all
+    older than ``since``.
+    """
+
+    def __init__(self, since: Optional[str] = None, until: Optional[str] = None,
+                 bbox: Optional[Tuple[float, float, float, float]] = None,
+                 near: Optional[Tuple[float, float, float]] = None, hashtags: Iterable[str] = (),
+                 owners: Iterable[str] = (), has_video: Optional[bool] = None, stop_before_since: bool = False):
+        if stop_before_since and not since:
+            raise ValueError("stop_before_since requires a since date")
+        self.since = since
+        self.until = until
+        self.bbox = bbox
+        self.near = near
+        self.hashtags = frozenset(tag.lstrip('#').lower() for tag in hashtags)
+        self.owners = frozenset(owner.lstrip('@').lower() for owner in owners)
+        self.has_video = has_video
+        self.stop_before_since = stop_before_since
+
+    def __bool__(self) -> bool:
+        return bool(self.since or self.until or self.bbox or self.near or self.hashtags or self.owners
+                    or self.has_video is not None)
+
+    @property
+    def needed_fields(self) -> FrozenSet[str]:
+        """The POST_FIELDS matches() reads, which an extraction must resolve"""
+        return frozenset(field for field, needed in (('date', self.since or self.until),
+                                                     ('hashtags', self.hashtags),
+                                                     ('owner_username', self.owners),
+                                                     ('is_video', self.has_video is not None)) if needed)
+
+    def _day_matches(self, day: str) -> bool:
+        return bool(day) and not (self.since and day < self.since) and not (self.until and day > self.until)
+
+    def _coordinates_match(self, lat: Optional[float], lng: Optional[float]) -> bool:
+        if lat is None or lng is None:
+            return False
+        if self.bbox:
+            min_lat, min_lng, max_lat, max_lng = self.bbox
+            if not min_lat <= lat <= max_lat:
+                return False
+            if min_lng <= max_lng:
+                if not min_lng <= lng <= max_lng:
+                    return False
+            elif max_lng < lng < min_lng:
+                return False
+        return not self.near or haversine_km(self.near[0], self.near[1], lat, lng) <= self.near[2]
+
+    def matches(self, record: LocationRecord) -> bool:
+        """Whether a record matches every predicate"""
+        if (self.since or self.until) and not self._day_matches((record.date or '')[:10]):
+            return False
+        if (self.bbox or self.near) and not self._coordinates_match(record.latitude, record.longitude):
+            return False
+        if self.hashtags and not self.hashtags.intersection(tag.lstrip('#') for tag in record.hashtags.split()):
+            return False
+        if self.owners and record.owner_username.lower() not in self.owners:
+            return False
+        return self.has_video is None or record.is_video == self.has_video
+
+    @staticmethod
+    def node_day(node: Dict[str, any]) -> Optional[str]:
+        """The local date (YYYY-MM-DD) of a post's page node, or None if the node has no timestamp"""
+        timestamp = node.get('taken_at_timestamp') or node.get('date')
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d') if timestamp else None
+
+    def may_match(self, node: Dict[str, any],
+                  coordinates: Optional[Tuple[Optional[float], Optional[float]]] = None) -> bool:
+        """Whether a post may match, judged from its page node alone
+
+        ``coordinates`` are those of the post's location, if known without a request. Predicates
+        whose data is missing from the node are left to matches().
+        """
+        if 'location' in node and not node['location']:
+            return False  # no location, so no record
+        if self.since or self.until:
+            day = self.node_day(node)
+            if day is not None and not self._day_matches(day):
+                return False
+        if (self.bbox or self.near) and coordinates is not None and not self._coordinates_match(*coordinates):
+            return False
+        if self.hashtags:
+            if 'edge_media_to_caption' in node:
+                edges = node['edge_media_to_caption']['edges']
+                caption = edges[0]['node']['text'] if edges else ''
+            else:
+                caption = (node['caption'] or '') if 'caption' in node else None
+            if caption is not None and not self.hashtags.intersection(analyze_caption(caption).hashtags):
+                return False
+        owner = (node.get('owner') or {}).get('username')
+        if self.owners and owner is not None and owner.lower() not in self.owners:
+            return False
+        return self.has_video is None or 'is_video' not in node or node['is_video'] == self.has_video
+
+    def is_before_since(self, node: Dict[str, any]) -> bool:
+        """Whether a post's page node dates it before ``since``"""
+        day = self.node_day(node)
+        return bool(self.since and day and day < self.since)
+
+    def filter(self, records: Iterable[LocationRecord]) -> Iterator[LocationRecord]:
+        """Yield the matching records"""
+        return (record for record in records if self.matches(record))
+
+
+def filter_records(records: Iterable[LocationRecord], since: Optional[str] = None, until: Optional[str] = None,
+                   bbox: Optional[Tuple[float, float, float, float]] = None,
+                   near: Optional[Tuple[float, float, float]] = None, hashtags: Iterable[str] = (),
+                   owners: Iterable[str] = (), has_video: Optional[bool] = None) -> Iterator[LocationRecord]:
+    """Yield the records matching every filter given (see LocationFilter)"""
+    return LocationFilter(since, until, bbox, near, hashtags, owners, has_video).filter(records)
+
+
+# Media downloads: requests in flight in total and per host, and the size of the chunks streamed to disk
+DEFAULT_MEDIA_WORKERS = 8
+DEFAULT_MEDIA_PER_HOST = 4
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp', 'image/heic': '.heic',
+                    'video/mp4': '.mp4'}
+
+
+class MediaDownloader:
+    """Downloads the images (and optionally the videos) of location records into a content-addressed store
+
+    Every file is named after the SHA-256 of its content, ``<directory>/<2 hex digits>/<sha256>.<ext>``,
+    so media shared by several posts is stored once. Downloads are streamed to disk in chunks,
+    on a pool of ``workers`` threads with at most ``per_host`` requests per host at a time.
+    Each downloaded post medium is recorded in ``<directory>/index.ndjson``, and is not
+    downloaded again while its file exists: an interrupted run can simply be repeated. Safe to
+    share between threads.
+    """
+
+    def __init__(self, directory: str, videos: bool = False, workers: int = DEFAULT_MEDIA_WORKERS,
+                 per_host: int = DEFAULT_MEDIA_PER_HOST, session: Optional['requests.Session'] = None,
+                 timeout: float = 60.0, metrics: Optional['RunMetrics'] = None):
+        self.directory = directory
+        self.videos = videos
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.metrics = metrics
+        self.stats = {'downloaded': 0, 'skipped': 0, 'deduplicated': 0, 'failed': 0, 'bytes': 0}
+        self._session = session
+        self._lock = threading.Lock()
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._index_path = os.path.join(directory, 'index.ndjson')
+        os.makedirs(os.path.join(directory, 'tmp'), exist_ok=True)
+        # Store file (relative to the directory) by '<shortcode>/<image or video>'
+        self.index: Dict[str, str] = {}
+        if os.path.isfile(self._index_path):
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run may be incomplete
+                        continue
+                    self.index[entry['key']] = entry['file']
+
+    @property
+    def session(self) -> 'requests.Session':
+        """HTTP session with a connection pool as large as the worker pool, created on first use"""
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def _count(self, stat: str, size: int = 0):
+        with self._lock:
+            self.stats[stat] += 1
+            self.stats['bytes'] += size
+        if self.metrics is not None:
+            self.metrics.increment(f'media_{stat}')
+            if size:
+                self.metrics.increment('media_bytes', size)
+
+    @staticmethod
+    def _extension(url: str, content_type: Optional[str]) -> str:
+        extension = MEDIA_EXTENSIONS.get((content_type or '').split(';')[0].strip().lower())
+        if extension:
+            return extension
+        extension = os.path.splitext(urlsplit(url).path)[1].lower()
+        return extension if 1 < len(extension) <= 5 else '.bin'
+
+    def fetch(self, key: str, url: str) -> Optional[str]:
+        """Download ``url`` into the store, unless ``key`` was downloaded before
+
+        Returns the path of the stored file, or None if the download failed.
+        """
+        with self._lock:
+            stored = self.index.get(key)
+            slot = self._host_slots.setdefault(urlsplit(url).hostname or '', threading.BoundedSemaphore(self.per_host))
+        if stored and os.path.isfile(os.path.join(self.directory, stored)):
+            self._count('skipped')
+            return os.path.join(self.directory, stored)
+
+        tmp_path = os.path.join(self.directory, 'tmp', f'{os.urandom(8).hex()}.part')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with slot, self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                extension = self._extension(url, response.headers.get('Content-Type'))
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+        except (requests.RequestException, OSError) as e:
+            print(f"  ⚠ Could not download {url}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            self._count('failed')
+            return None
+
+        sha256 = digest.hexdigest()
+        relative = os.path.join(sha256[:2], sha256 + extension)
+        path = os.path.join(self.directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isfile(path):
+            os.remove(tmp_path)
+            self._count('deduplicated')
+        else:
+            os.replace(tmp_path, path)
+            self._count('downloaded', size)
+        with self._lock:
+            self.index[key] = relative
+            with open(self._index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'key': key, 'file': relative, 'url': url}) + '\n')
+        return path
+
+    def _download_record(self, record: LocationRecord):
+        if record.display_url:
+            record.image_file = self.fetch(f'{record.shortcode}/image', record.display_url) or ''
+        if self.videos and record.video_url:
+            record.video_file = self.fetch(f'{record.shortcode}/video', record.video_url) or ''
+
+    def download(self, records: Iterable[LocationRecord]) -> Iterator[LocationRecord]:
+        """Download the media of each record, yielding the records in order with their files set
+
+        ``image_file`` (and with ``videos``, ``video_file``) is set to the stored file, or left
+        empty if the record has no media URL or its download failed. Only a few records per
+        worker are in flight, so the records stream through as in an export.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for record in records:
+                pending.append((record, executor.submit(self._download_record, record)))
+                if len(pending) > 2 * self.workers:
+                    record, future = pending.popleft()
+                    future.result()
+                    yield record
+            while pending:
+                record, future = pending.popleft()
+                future.result()
+                yield record
+        stats = self.stats
+        print(f"\n✓ Media in {self.directory}: {stats['downloaded']} downloaded ({stats['bytes'] / 1e6:.1f} MB), "
+              f"{stats['skipped']} already present, {stats['deduplicated']} duplicates, {stats['failed']} failed")
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+    """Grid index over location coordinates for bounding box, radius and nearest-neighbour queries
+
+    Points are bucketed into square cells on a few grid levels, from ``cell_size`` degrees up to
+    whole-hemisphere cells, each level 8 times coarser than the previous one. A query picks the
+    finest level at which its area spans only a handful of cells and looks at the points in
+    those cells, instead of scanning every location. Locations without coordinates are skipped.
+    Longitudes wrap around the antimeridian.
+    """
+
+    DEFAULT_CELL_SIZE = 0.0025  # ~280 m of latitude
+    LEVEL_FACTOR = 8
+    MAX_QUERY_CELLS = 64
+    MAX_NEAREST_RINGS = 3  # 7x7 cells
+
+    def __init__(self, records: Iterable[LocationRecord] = (), cell_size: float = DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.records: List[LocationRecord] = []
+        self._lats: List[float] = []
+        self._lngs: List[float] = []
+        # (cell size, number of columns, {(column, row): [point indexes]}) from finest to coarsest
+        self._levels: List[Tuple[float, int, Dict[Tuple[int, int], List[int]]]] = []
+        size = cell_size
+        while True:
+            self._levels.append((size, math.ceil(360 / size), {}))
+            if size >= 180:
+                break
+            size *= self.LEVEL_FACTOR
+        for record in records:
+            self.add(record)
+
+    @classmethod
+    def from_cache(cls, cache: 'PostCache', cell_size: float = DEFAULT_CELL_SIZE) -> 'SpatialIndex':
+        """Index every location stored in a post cache"""
+        return cls(cache.records(), cell_size)
+
+    @classmethod
+    def from_export(cls, filename: str, cell_size: float = DEFAULT_CELL_SIZE) -> 'SpatialIndex':
+        """Index the locations of a CSV, GeoJSON or NDJSON export"""
+        return cls(read_export(filename), cell_size)
+
+    @classmethod
+    def load(cls, path: str) -> 'SpatialIndex':
+        """Load an index written by save()"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls((LocationRecord.from_dict(record) for record in data['records']), data['cell_size'])
+
+    def save(self, path: str):
+        """Persist the indexed locations, atomically replacing ``path``"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'cell_size': self.cell_size,
+                       'records': [dict(record.to_dict(), shortcode=record.shortcode) for record in self.records]},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _cell(size: float, columns: int, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor((lng + 180) / size) % columns, math.floor((lat + 90) / size)
+
+    def add(self, record: LocationRecord):
+        if record.latitude is None or record.longitude is None:
+            return
+        index = len(self.records)
+        self.records.append(record)
+        self._lats.append(record.latitude)
+        self._lngs.append(record.longitude)
+        for size, columns, cells in self._levels:
+            cells.setdefault(self._cell(size, columns, record.latitude, record.longitude), []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _candidates(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> Iterator[int]:
+        """Indexes of the points in the cells overlapping a box (min_lng > max_lng crosses the antimeridian)"""
+        for size, columns, cells in self._levels:
+            x0, y0 = self._cell(size, columns, min_lat, min_lng)
+            x1, y1 = self._cell(size, columns, max_lat, max_lng)
+            width = x1 - x0 + 1 if x0 <= x1 else columns - x0 + x1 + 1
+            if max_lng - min_lng >= 360 or (x0 == x1 and min_lng > max_lng):
+                x0, width = 0, columns
+            if width * (y1 - y0 + 1) <= self.MAX_QUERY_CELLS or size >= 180:
+                break
+        for x in range(x0, x0 + width):
+            for y in range(y0, y1 + 1):
+                indexes = cells.get((x % columns, y))
+                if indexes:
+                    yield from indexes
+
+    def bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[LocationRecord]:
+        """Locations inside a bounding box; min_lng > max_lng selects a box crossing the antimeridian"""
+        lats, lngs, records = self._lats, self._lngs, self.records
+        if min_lng <= max_lng:
+            return [records[i] for i in self._candidates(min_lat, min_lng, max_lat, max_lng)
+                    if min_lat <= lats[i] <= max_lat and min_lng <= lngs[i] <= max_lng]
+        return [records[i] for i in self._candidates(min_lat, min_lng, max_lat, max_lng)
+                if min_lat <= lats[i] <= max_lat and (lngs[i] >= min_lng or lngs[i] <= max_lng)]
+
+    @staticmethod
+    def _radius_box(lat: float, lng: float, radius_km: float) -> Tuple[float, float, float, float]:
+        """Bounding box (min_lat, min_lng, max_lat, max_lng) of a circle"""
+        lat_span = radius_km / KM_PER_DEGREE
+        min_lat, max_lat = max(-90.0, lat - lat_span), min(90.0, lat + lat_span)
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        lng_span = lat_span / cos_lat if cos_lat > 1e-9 else 360
+        if lng_span >= 180:
+            return min_lat, -180.0, max_lat, 180.0
+        return min_lat, (lng - lng_span + 180) % 360 - 180, max_lat, (lng + lng_span + 180) % 360 - 180
+
+    def _within_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[float, int]]:
+        lats, lngs = self._lats, self._lngs
+        matches = []
+        for i in self._candidates(*self._radius_box(lat, lng, radius_km)):
+            distance = haversine_km(lat, lng, lats[i], lngs[i])
+            if distance <= radius_km:
+                matches.append((distance, i))
+        matches.sort()
+        return matches
+
+    def within_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[float, LocationRecord]]:
+        """(distance_km, location) pairs within ``radius_km`` of a point, nearest first"""
+        return [(distance, self.records[i]) for distance, i in self._within_radius(lat, lng, radius_km)]
+
+    def _ring_bound_km(self, lat: float, lng: float, ring: int) -> float:
+        """Lower bound of the distance from a point to any location outside the ``ring`` rings of
+        finest-level cells around its own"""
+        size, columns, _ = self._levels[0]
+        cy = math.floor((lat + 90) / size)
+        south, north = (cy - ring) * size - 90, (cy + ring + 1) * size - 90
+        bound = math.inf
+        if south > -90:
+            bound = (lat - south) * KM_PER_DEGREE
+        if north < 90:
+            bound = min(bound, (north - lat) * KM_PER_DEGREE)
+        if 2 * ring + 1 < columns:
+            # Locations beyond the rings in longitude only lie within their latitudes
+            offset = (lng + 180) / size - math.floor((lng + 180) / size)
+            lng_span = math.radians(min(offset + ring, 1 - offset + ring) * size)
+            if lng_span < math.pi:
+                max_lat = math.radians(min(90.0, max(abs(south), abs(north))))
+                a = math.cos(math.radians(lat)) * math.cos(max_lat) * math.sin(lng_span / 2) ** 2
+                bound = min(bound, 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a))))
+        return bound
+
+    def nearest(self, lat: float, lng: float, k: int = 1) -> List[Tuple[float, LocationRecord]]:
+        """The ``k`` locations nearest to a point as (distance_km, location) pairs, nearest first
+
+        The finest-level cells are searched ring by ring outwards from the point's own, until the
+        k-th nearest location found is closer than anything beyond the rings. Where locations are
+        too sparse for that within MAX_NEAREST_RINGS rings, the 3x3 block of cells around the
+        point on the finest level holding at least ``k`` locations bounds the k-th nearest
+        distance, and a radius query of that size finds the rest.
+        """
+        if k <= 0 or not self.records:
+            return []
+        lats, lngs = self._lats, self._lngs
+        size, columns, cells = self._levels[0]
+        cx, cy = self._cell(size, columns, lat, lng)
+        # The k nearest so far, as a heap of (-distance, -index): the farthest (and, on a tie, the
+        # last indexed) on top
+        best: List[Tuple[float, int]] = []
+        visited = set()
+        for ring in range(self.MAX_NEAREST_RINGS + 1):
+            keys = {((cx + dx) % columns, cy + dy) for dx in range(-ring, ring + 1) for dy in range(-ring, ring + 1)
+                    if max(abs(dx), abs(dy)) == ring}
+            for key in keys - visited:
+                for i in cells.get(key, ()):
+                    item = (-haversine_km(lat, lng, lats[i], lngs[i]), -i)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+            visited |= keys
+            if len(best) == k and -best[0][0] <= self._ring_bound_km(lat, lng, ring):
+                return [(-distance, self.records[-i]) for distance, i in sorted(best, reverse=True)]
+
+        for size, columns, cells in self._levels:
+            cx, cy = self._cell(size, columns, lat, lng)
+            # A set, as on the coarsest levels the wrapped columns around the point coincide
+            keys = {((cx + dx) % columns, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+            block = [i for key in keys for i in cells.get(key, ())]
+            if len(block) >= k:
+                bound = heapq.nsmallest(k, (haversine_km(lat, lng, lats[i], lngs[i]) for i in block))[-1]
+                matches = self._within_radius(lat, lng, bound)[:k]
+                break
+        else:
+            matches = heapq.nsmallest(k, ((haversine_km(lat, lng, lats[i], lngs[i]), i)
+                                          for i in range(len(self.records))))
+        return [(distance, self.records[i]) for distance, i in matches]
+
+
+class RunMetrics:
+    """Phase timers and counters of an extraction run
+
+    Phases are timed cumulatively and may overlap: per-post phases ('resolve', which includes
+    'caption_parsing') run on several workers at once, so their total can exceed the wall time.
+    Thread-safe.
+    """
+
     def __init__(self):
-        self.loader = instaloader.Instaloader()
+        self.started_at = time.time()
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, phase: str, seconds: float, calls: int = 1):
+        with self._lock:
+            totals = self.phases.setdefault(phase, {'seconds': 0.0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time a block of code as one call of a phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def timed_iter(self, iterable: Iterable, phase: str) -> Iterator:
+        """Yield from an iterable, timing each step of it (but not the consumer) as a phase call"""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, time.perf_counter() - started)
+            yield item
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+def write_json_report(report: Dict[str, any], path: str):
+    """Atomically write a run report as JSON"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_prometheus_textfile(report: Dict[str, any], path: str, prefix: str = 'instagram_extractor'):
+    """Atomically write a run report in the Prometheus text format (for node_exporter's textfile collector)"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[Tuple[str, float]]):
+        lines.append(f'# HELP {prefix}_{name} {help_text}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        lines.extend(f'{prefix}_{name}{labels} {value}' for labels, value in samples)
+
+    metric('run_start_timestamp_seconds', 'gauge', 'Start of the last run', [('', report['started_at'])])
+    metric('run_duration_seconds', 'gauge', 'Wall time of the last run', [('', report['duration_seconds'])])
+    metric('phase_seconds', 'gauge', 'Time spent per phase (summed over workers)',
+           [(f'{{phase="{phase}"}}', totals['seconds']) for phase, totals in report['phases'].items()])
+    metric('phase_calls', 'gauge', 'Number of timed calls per phase',
+           [(f'{{phase="{phase}"}}', totals['calls']) for phase, totals in report['phases'].items()])
+    metric('requests', 'gauge', 'Requests to Instagram per endpoint',
+           [(f'{{endpoint="{endpoint}"}}', count) for endpoint, count in report['requests']['by_endpoint'].items()])
+    metric('rate_limited', 'gauge', 'Rate-limit responses', [('', report['requests']['rate_limited'])])
+    metric('request_wait_seconds', 'gauge', 'Time spent waiting for the request scheduler (pacing and backoff)',
+           [('', report['requests']['wait_seconds'])])
+    for counter, value in report['counters'].items():
+        metric(counter, 'gauge', counter.replace('_', ' ').capitalize(), [('', value)])
+    for ratio, value in report['cache'].items():
+        if value is not None:
+            metric(ratio, 'gauge', ratio.replace('_', ' ').capitalize(), [('', value)])
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+DEFAULT_CLUSTER_DISTANCE_M = 150
+DEFAULT_NAME_SIMILARITY = 0.75
+
+
+class LocationCluster(NamedTuple):
+    """Locations that refer to the same real-world place"""
+    cluster_id: int
+    representative: LocationRecord
+    members: List[LocationRecord]
+
+
+def normalize_place_name(name: str) -> str:
+    """Case-, accent- and punctuation-insensitive form of a location name"""
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def name_similarity(a: str, b: str) -> float:
+    """Similarity of two normalized names in [0, 1], tolerant of reordered words"""
+    if a == b:
+        return 1.0
+    similarity = SequenceMatcher(None, a, b).ratio()
+    sorted_a, sorted_b = ' '.join(sorted(a.split())), ' '.join(sorted(b.split()))
+    if sorted_a != a or sorted_b != b:
+        similarity = max(similarity, SequenceMatcher(None, sorted_a, sorted_b).ratio())
+    return similarity
+
+
+def cluster_locations(records: Iterable[LocationRecord], max_distance_m: float = DEFAULT_CLUSTER_DISTANCE_M,
+                      min_name_similarity: float = DEFAULT_NAME_SIMILARITY) -> List[LocationCluster]:
+    """Group locations that are within ``max_distance_m`` of each other and have similar names
+
+    The same place often shows up under several Instagram location IDs with slightly different
+    names and coordinates. Candidate pairs come from a SpatialIndex with cells about the size of
+    ``max_distance_m``, so only nearby locations are compared and clustering runs in roughly
+    linear time. Matches are merged transitively. Each cluster's representative is the member
+    carrying the most common name, closest to the cluster's centre. Locations without
+    coordinates form clusters of their own. Clusters are numbered in input order.
+    """
+    records = list(records)
+    max_distance_km = max_distance_m / 1000
+    # Posts saved from the same Instagram location share its name and coordinates exactly:
+    # cluster each distinct place once
+    places: Dict[Tuple[str, float, float], LocationRecord] = {}
+    for record in records:
+        if record.latitude is not None and record.longitude is not None:
+            places.setdefault((normalize_place_name(record.name), record.latitude, record.longitude), record)
+    index = SpatialIndex(places.values(), cell_size=max(max_distance_km / KM_PER_DEGREE, 1e-6))
+    names = list(key[0] for key in places)
+    lats, lngs = index._lats, index._lngs
+    similarities: Dict[Tuple[str, str], float] = {}
+    parents = list(range(len(index.records)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i in range(len(parents)):
+        lat, lng = lats[i], lngs[i]
+        root_i = find(i)
+        for j in index._candidates(*index._radius_box(lat, lng, max_distance_km)):
+            if j <= i:
+                continue  # each pair is looked at once
+            root_j = find(j)
+            if root_i == root_j or haversine_km(lat, lng, lats[j], lngs[j]) > max_distance_km:
+                continue
+            pair = (names[i], names[j]) if names[i] <= names[j] else (names[j], names[i])
+            if pair not in similarities:
+                similarities[pair] = name_similarity(*pair)
+            if similarities[pair] >= min_name_similarity:
+                parents[max(root_i, root_j)] = root_i = min(root_i, root_j)
+
+    place_index = {key: i for i, key in enumerate(places)}
+    groups: Dict[int, List[LocationRecord]] = {}
+    for position, record in enumerate(records):
+        if record.latitude is None or record.longitude is None:
+            groups[-1 - position] = [record]
+        else:
+            key = (normalize_place_name(record.name), record.latitude, record.longitude)
+            groups.setdefault(find(place_index[key]), []).append(record)
+
+    clusters = []
+    for cluster_id, members in enumerate(groups.values()):
+        representative = members[0]
+        if len(members) > 1:
+            counts: Dict[str, int] = {}
+            for member in members:
+                counts[member.name] = counts.get(member.name, 0) + 1
+            center_lat = sum(member.latitude for member in members) / len(members)
+            center_lng = sum(member.longitude for member in members) / len(members)
+            representative = min(members, key=lambda member: (
+                -counts[member.name], haversine_km(center_lat, center_lng, member.latitude, member.longitude)))
+        clusters.append(LocationCluster(cluster_id, representative, members))
+    return clusters
+
+
+def dedupe_locations(records: Iterable[LocationRecord], **kwargs) -> List[LocationRecord]:
+    """The representative of each place (see cluster_locations()), its cluster_size set to its cluster's size"""
+    representatives = []
+    for cluster in cluster_locations(records, **kwargs):
+        cluster.representative.cluster_size = len(cluster.members)
+        representatives.append(cluster.representative)
+    return representatives
+
+
+class PostCache:
+    """Persistent SQLite cache of extracted post records, keyed by shortcode
+
+    Posts without a location are cached too (with an empty record), so they are
+    never re-resolved on later runs. Volatile fields are refreshed once they are
+    older than ``volatile_ttl`` seconds. Records extracted with a field selection
+    remember the fields left unresolved, so that a later run can fill them in.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: str, volatile_ttl: float = DEFAULT_VOLATILE_TTL):
+        self.path = path
+        self.volatile_ttl = volatile_ttl
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS posts ('
+            ' shortcode TEXT PRIMARY KEY,'
+            ' record TEXT,'
+            ' fetched_at REAL NOT NULL,'
+            ' refreshed_at REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS locations ('
+            ' id INTEGER PRIMARY KEY,'
+            ' name TEXT,'
+            ' slug TEXT,'
+            ' lat REAL,'
+            ' lng REAL,'
+            ' fetched_at REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS sync_state ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL)'
+        )
+        self.conn.commit()
+
+    def get(self, shortcode: str) -> Optional[Tuple[Optional[LocationRecord], bool]]:
+        """Return (record, is_stale) for a cached post, or None if it is not cached"""
+        cached = self.lookup(shortcode)
+        return cached[:2] if cached is not None else None
+
+    def lookup(self, shortcode: str) -> Optional[Tuple[Optional[LocationRecord], bool, FrozenSet[str]]]:
+        """Return (record, is_stale, unresolved fields) for a cached post, or None if it is not cached"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT record, refreshed_at FROM posts WHERE shortcode = ?', (shortcode,)
+            ).fetchone()
+        if row is None:
+            return None
+        if row[0] is None:
+            return None, False, frozenset()
+        data = json.loads(row[0])
+        record = LocationRecord.from_dict(data)
+        is_stale = time.time() - row[1] > self.volatile_ttl
+        return record, is_stale, frozenset(data.get('unresolved', ()))
+
+    @staticmethod
+    def _serialize(record: Optional[LocationRecord], unresolved: Iterable[str]) -> Optional[str]:
+        if record is None:
+            return None
+        data = record.to_dict()
+        unresolved = sorted(unresolved)
+        if unresolved:
+            data['unresolved'] = unresolved
+        return json.dumps(data)
+
+    def put(self, shortcode: str, record: Optional[LocationRecord], unresolved: Iterable[str] = ()):
+        """Store a freshly extracted record (None for posts without a location)
+
+        ``unresolved`` names the fields that were not read from the post.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO posts (shortcode, record, fetched_at, refreshed_at) VALUES (?, ?, ?, ?)',
+                (shortcode, self._serialize(record, unresolved), now, now)
+            )
+            self.conn.commit()
+
+    def refresh(self, shortcode: str, record: LocationRecord, unresolved: Iterable[str] = (),
+                refreshed: bool = True):
+        """Store a record whose volatile fields (if ``refreshed``) or unresolved fields have just been read"""
+        with self._lock:
+            if refreshed:
+                self.conn.execute(
+                    'UPDATE posts SET record = ?, refreshed_at = ? WHERE shortcode = ?',
+                    (self._serialize(record, unresolved), time.time(), shortcode)
+                )
+            else:
+                self.conn.execute('UPDATE posts SET record = ? WHERE shortcode = ?',
+                                  (self._serialize(record, unresolved), shortcode))
+            self.conn.commit()
+
+    def get_location(self, location_id: int) -> Optional['instaloader.PostLocation']:
+        """Return the cached metadata of an Instagram location, or None"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT name, slug, lat, lng FROM locations WHERE id = ?', (location_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        name, slug, lat, lng = row
+        return instaloader.PostLocation(location_id, name, slug, None, lat, lng)
+
+    def put_location(self, location: 'instaloader.PostLocation'):
+        """Store the metadata of an Instagram location"""
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO locations (id, name, slug, lat, lng, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (location.id, location.name, location.slug, location.lat, location.lng, time.time())
+            )
+            self.conn.commit()
+
+    def get_state(self, key: str) -> Optional[any]:
+        """Return a JSON value stored with set_state(), or None"""
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_state(self, key: str, value: any):
+        """Persist a JSON-serializable value under the given key"""
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, json.dumps(value))
+            )
+            self.conn.commit()
+
+    def records(self) -> Iterator[LocationRecord]:
+        """All cached location records (posts without a location are skipped)"""
+        with self._lock:
+            rows = self.conn.execute('SELECT record FROM posts WHERE record IS NOT NULL').fetchall()
+        for row in rows:
+            yield LocationRecord.from_dict(json.loads(row[0]))
+
+    def last_run_records(self) -> Iterator[LocationRecord]:
+        """Location records of the posts saved at the last complete run, in saved order
+
+        All cached records (see records()) if no run has been recorded.
+        """
+        shortcodes = self.get_state('saved_shortcodes')
+        if shortcodes is None:
+            yield from self.records()
+            return
+        for shortcode in shortcodes:
+            cached = self.get(shortcode)
+            if cached is not None and cached[0] is not None:
+                yield cached[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class RequestScheduler:
+    """Token-bucket request scheduler with AIMD rate adaptation and jittered exponential backoff
+
+    Every endpoint ('graphql', 'iphone', 'other') has its own token bucket, whose rate starts
+    at and never exceeds the endpoint's budget (requests per second). Each granted request
+    raises the rate additively; each rate-limit response halves it and pauses all requests
+    for an exponentially growing, jittered delay. Safe to share between threads.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, float]] = None, burst: int = 3,
+                 base_backoff: float = 60.0, max_backoff: float = 30 * 60, max_retries: int = 8,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.budgets = {**DEFAULT_RATE_BUDGETS, **(budgets or {})}
+        self.rates = dict(self.budgets)
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.total_wait = 0.0
+        self.request_counts = {endpoint: 0 for endpoint in self.budgets}
+        self.rate_limit_count = 0
+        self._sleep = sleep
+        self._clock = clock
+        self._tokens = {endpoint: float(burst) for endpoint in self.budgets}
+        self._updated = {endpoint: clock() for endpoint in self.budgets}
+        self._paused_until = 0.0
+        self._consecutive_failures = 0
+        self._last_endpoint = 'graphql'
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_for(query_type: str) -> str:
+        """Map an instaloader query type (query hash, doc_id, 'iphone' or 'other') to an endpoint"""
+        return query_type if query_type in ('iphone', 'other') else 'graphql'
+
+    def _wait(self, seconds: float):
+        if seconds > 0:
+            with self._lock:
+                self.total_wait += seconds
+            self._sleep(seconds)
+
+    def acquire(self, endpoint: str):
+        """Block until a request to the given endpoint may be sent"""
+        with self._lock:
+            now = self._clock()
+            rate = self.rates[endpoint]
+            # Tokens may go negative: each caller reserves its slot and waits for it outside the lock
+            tokens = min(self.burst, self._tokens[endpoint] + (now - self._updated[endpoint]) * rate) - 1
+            self._tokens[endpoint] = tokens
+            self._updated[endpoint] = now
+            wait = max(-tokens / rate, self._paused_until - now, 0.0)
+            budget = self.budgets[endpoint]
+            self.rates[endpoint] = min(budget, rate + budget / 20)
+            self.request_counts[endpoint] += 1
+            self._last_endpoint = endpoint
+        self._wait(wait)
+
+    def record_success(self):
+        """Reset the backoff after an operation completed without being rate limited"""
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def backoff(self, endpoint: Optional[str] = None) -> float:
+        """Halve the endpoint's rate and pause all requests after a rate-limit response
+
+        Defaults to the endpoint of the most recent request. Returns the pause in seconds.
+        """
+        with self._lock:
+            endpoint = endpoint or self._last_endpoint
+            now = self._clock()
+            # Concurrent requests failing during the same pause just wait for it to end
+            if now >= self._paused_until:
+                budget = self.budgets[endpoint]
+                self.rates[endpoint] = max(budget / 20, self.rates[endpoint] / 2)
+                self.rate_limit_count += 1
+                self._consecutive_failures += 1
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_failures - 1))
+                self._paused_until = now + delay / 2 + random.uniform(0, delay / 2)
+            wait = self._paused_until - now
+        print(f"⏳ Rate limited, pausing {wait:.0f}s ({endpoint} rate now {self.rates[endpoint] * 60:.1f}/min)")
+        self._wait(wait)
+        return wait
+
+    def stats(self) -> Dict[str, any]:
+        """Current rates (requests per minute), request counts and cumulative wait time"""
+        with self._lock:
+            return {
+                'rates_per_minute': {endpoint: rate * 60 for endpoint, rate in self.rates.items()},
+                'requests': dict(self.request_counts),
+                'rate_limited': self.rate_limit_count,
+                'total_wait_seconds': self.total_wait,
+            }
+
+
+class SchedulerRateController:
+    """instaloader RateController delegating to a RequestScheduler
+
+    Implements the two methods InstaloaderContext calls, rather than subclassing
+    instaloader.RateController, so that defining it does not import instaloader.
+    """
+
+    def __init__(self, context: 'instaloader.InstaloaderContext', scheduler: RequestScheduler):
+        self._context = context
+        self.scheduler = scheduler
+
+    def wait_before_query(self, query_type: str) -> None:
+        self.scheduler.acquire(self.scheduler.endpoint_for(query_type))
+
+    def handle_429(self, query_type: str) -> None:
+        self.scheduler.backoff(self.scheduler.endpoint_for(query_type))
+
+
+@functools.lru_cache(maxsize=None)
+def _replay_classes() -> tuple:
+    """ReplayMissError and the offline transport of a replay, defined on first use
+
+    They extend instaloader and requests classes, which would otherwise be imported at startup.
+    """
+    class ReplayMissError(instaloader.exceptions.ConnectionException):
+        """A request that is not in the recording being replayed"""
+
+    class OfflineAdapter(requests.adapters.BaseAdapter):
+        """Transport refusing every request, so a replayed run can never reach Instagram"""
+
+        def send(self, request, **kwargs):
+            raise requests.exceptions.ConnectionError(f"Offline replay: refusing {request.method} {request.url}")
+
+        def close(self):
+            pass
+
+    return ReplayMissError, OfflineAdapter
+
+
+def __getattr__(name: str):
+    if name == 'ReplayMissError':
+        return _replay_classes()[0]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class ResponseRecorder:
+    """Records the JSON responses instaloader receives during a run, or replays them offline
+
+    install() wraps the context's login, get_json() (which carries every GraphQL and iPhone API
+    request) and get_page_data(). In 'record' mode, the real requests are made and every
+    response, or error, is appended to ``path`` as a JSON line. In 'replay' mode, the responses
+    are served from ``path`` in the order they were recorded, with no network access, login or
+    rate limiting, so a recorded run can be repeated deterministically at full speed. When a
+    request was recorded fewer times than it is replayed, its last response is served again.
+    Requests instaloader retries internally are recorded once, with their final outcome.
+    """
+
+    def __init__(self, path: str, mode: str = 'replay'):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown recorder mode: {mode} (expected 'record' or 'replay')")
+        self.path = path
+        self.mode = mode
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._login: Optional[Dict[str, any]] = None
+        self._responses: Dict[str, List[Dict[str, any]]] = {}
+        self._served: Dict[str, int] = {}
+        if mode == 'record':
+            self._file = open(path, 'w', encoding='utf-8')
+        else:
+            self._file = None
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if 'login' in entry:
+                        self._login = entry['login']
+                    else:
+                        self._responses.setdefault(entry['key'], []).append(entry)
+
+    @staticmethod
+    def _key(call: str, **request) -> str:
+        return json.dumps(dict(request, call=call), sort_keys=True, default=str)
+
+    def _append(self, entry: Dict[str, any]):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def _call(self, key: str, func, *args, response_headers: Optional[Dict[str, any]] = None, **kwargs):
+        """Record func's result under key, or replay the result recorded under it"""
+        with self._lock:
+            self.requests += 1
+        if self.mode == 'record':
+            headers = {} if response_headers is None else response_headers
+            try:
+                response = func(*args, response_headers=headers, **kwargs) if response_headers is not None \
+                    else func(*args, **kwargs)
+            except instaloader.exceptions.InstaloaderException as e:
+                self._append({'key': key, 'error': [type(e).__name__, str(e)]})
+                raise
+            self._append({'key': key, 'response': response, 'headers': dict(headers)})
+            return response
+
+        entries = self._responses.get(key)
+        if not entries:
+            raise _replay_classes()[0](f"Request not in recording {self.path}: {key}")
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        entry = entries[min(served, len(entries) - 1)]
+        if 'error' in entry:
+            name, message = entry['error']
+            error_class = getattr(instaloader.exceptions, name, instaloader.exceptions.ConnectionException)
+            raise error_class(message)
+        if response_headers is not None:
+            response_headers.update(entry.get('headers') or {})
+        return json.loads(json.dumps(entry['response']))  # a fresh copy, as from the network
+
+    def install(self, context: 'instaloader.InstaloaderContext'):
+        """Route the context's requests through this recorder"""
+        get_json, get_page_data, login = context.get_json, context.get_page_data, context.login
+
+        def recorded_get_json(path, params, host='www.instagram.com', session=None, _attempt=1,
+                              response_headers=None, use_post=False):
+            if _attempt > 1:
+                # instaloader retrying a request through context.get_json: the outer call records
+                # the final response, once
+                return get_json(path, params, host, session, _attempt, response_headers=response_headers,
+                                use_post=use_post)
+            key = self._key('get_json', path=path, params=params, host=host, use_post=use_post)
+            return self._call(key, get_json, path, params, host, session, _attempt,
+                              response_headers=response_headers, use_post=use_post)
+
+        def recorded_get_page_data(path):
+            return self._call(self._key('get_page_data', path=path), get_page_data, path)
+
+        def recorded_login(user, passwd):
+            if self.mode == 'record':
+                login(user, passwd)
+                self._append({'login': {'username': context.username, 'user_id': context.user_id}})
+            elif self._login is None:
+                raise instaloader.exceptions.LoginException(f"No login in recording {self.path}")
+            else:
+                context.username = self._login['username']
+                context.user_id = self._login['user_id']
+
+        context.get_json = recorded_get_json
+        context.get_page_data = recorded_get_page_data
+        context.login = recorded_login
+        if self.mode == 'replay':
+            context.sleep = False
+            # doc_id queries fetch a CSRF token first if the session has none
+            context._session.cookies.set('csrftoken', 'replay', domain='.instagram.com')  # pylint:disable=protected-access
+            for prefix in ('https://', 'http://'):
+                context._session.mount(prefix, _replay_classes()[1]())  # pylint:disable=protected-access
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class SavedCollection(NamedTuple):
+    """A collection of the logged-in user's saved posts"""
+    id: str
+    name: str
+    media_count: Optional[int]
+
+
+def _post_from_collection_media(context: 'instaloader.InstaloaderContext', media: Dict[str, any]) -> 'instaloader.Post':
+    """Create a Post from a media item of the iPhone API, without lazy requests for what the item holds
+
+    Post.from_iphone_struct() leaves out the location and the comment count, which the Post would
+    then fetch with the full post metadata; they are filled in from the item, like in a page node
+    (as is the owner, for LocationFilter).
+    """
+    post = instaloader.Post.from_iphone_struct(context, media)
+    node = post._node  # pylint:disable=protected-access
+    node['edge_media_to_comment'] = {'count': media.get('comment_count') or 0}
+    if media.get('user'):
+        node['owner'] = {'id': str(media['user']['pk']), 'username': media['user']['username']}
+    location = media.get('location')
+    if location:
+        node['location'] = {'id': str(location['pk']), 'name': location.get('name') or '',
+                            'slug': location.get('slug') or '', 'has_public_page': True}
+        # Without coordinates, Post.location fetches the location page (through the location cache)
+        if location.get('lat') is not None and location.get('lng') is not None:
+            node['location'].update(lat=location['lat'], lng=location['lng'])
+    else:
+        node['location'] = None
+    return post
+
+
+class CollectionPosts:
+    """Iterator over the posts of a saved collection, paginated by the iPhone API
+
+    Like instaloader's NodeIterator, it keeps its position when a page fetch fails, so that
+    calling next() again retries the fetch. It cannot be frozen for checkpoints.
+    """
+
+    def __init__(self, context: 'instaloader.InstaloaderContext', collection: SavedCollection):
+        self.collection = collection
+        self._context = context
+        self._buffer = deque()
+        self._max_id: Optional[str] = None
+        self._more = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> 'instaloader.Post':
+        while not self._buffer:
+            if not self._more:
+                raise StopIteration
+            params = {'max_id': self._max_id} if self._max_id else {}
+            data = self._context.get_iphone_json(f'api/v1/feed/collection/{self.collection.id}/posts/', params)
+            self._buffer.extend(_post_from_collection_media(self._context, item['media'])
+                                for item in data.get('items') or [] if item.get('media'))
+            self._max_id = data.get('next_max_id')
+            self._more = bool(data.get('more_available') and self._max_id)
+        return self._buffer.popleft()
+
+
+class _BlockingCall(NamedTuple):
+    """A blocking call the extraction core asks its driver to make, see InstagramLocationExtractor._extraction()"""
+    function: Callable
+    args: tuple
+
+
+class _BlockingMap(NamedTuple):
+    """Blocking calls of ``function`` for every item, which the driver may make concurrently"""
+    function: Callable
+    items: list
+
+
+class InstagramLocationExtractor:
+    def __init__(self, cache_path: Optional[str] = None, volatile_ttl: float = DEFAULT_VOLATILE_TTL,
+                 scheduler: Optional[RequestScheduler] = None, workers: int = DEFAULT_WORKERS,
+                 recorder: Optional[ResponseRecorder] = None, prefetch: int = DEFAULT_PREFETCH_PAGES,
+                 fields: Optional[Iterable[str]] = None, location_filter: Optional[LocationFilter] = None):
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # Created on first use, see the loader property
+        self._loader: Optional['instaloader.Instaloader'] = None
+        self._loader_lock = threading.Lock()
+        # Records the run's responses, or replays a recorded run offline
+        self.recorder = recorder
         self.profile = None
+        self.cache = PostCache(cache_path, volatile_ttl) if cache_path else None
+        # Location metadata by Instagram location ID, shared by all posts of a run
+        self.locations: Dict[int, 'instaloader.PostLocation'] = {}
+        self.location_cache_hits = 0
+        # Number of posts of a page whose lazy properties are resolved concurrently
+        self.workers = workers
+        # Number of pages fetched ahead by a background thread (0 fetches each page when needed)
+        self.prefetch = prefetch
+        # Fields extracted and exported (see select_fields()); None for all of them. The post
+        # properties behind the other fields are never read, so they cost no requests.
+        self.fields = select_fields(fields)
+        # Only the locations matching this filter are extracted; posts it rules out from their
+        # page node are skipped before anything is resolved (see LocationFilter)
+        self.location_filter = location_filter if location_filter else None
+        self._post_fields = POST_FIELDS if self.fields is None else POST_FIELDS.intersection(self.fields)
+        if self.location_filter is not None:
+            self._post_fields |= self.location_filter.needed_fields
+        self.stats = {'posts': 0, 'locations': 0, 'cached': 0}
+        self.location_cache_misses = 0
+        # Timings and counters of everything this extractor does, see run_report()
+        self.metrics = RunMetrics()
+        self._lock = threading.Lock()
+        self._location_locks: Dict[int, threading.Lock] = {}
+        # (username, password, session_file) of the last login, to renew an expired session
+        self._credentials: Optional[Tuple[str, Optional[str], Optional[str]]] = None
+        self._session_generation = 0
+        self._login_lock = threading.Lock()
+
+    @property
+    def loader(self) -> 'instaloader.Instaloader':
+        """The Instaloader instance, created (and instaloader imported) on first use
+
+        Exporting records that are already at hand never needs it.
+        """
+        with self._loader_lock:
+            if self._loader is None:
+                loader = instaloader.Instaloader(
+                    rate_controller=lambda context: SchedulerRateController(context, self.scheduler))
+                if self.recorder is not None:
+                    self.recorder.install(loader.context)
+                self._loader = loader
+            return self._loader
 
     @staticmethod
     def extract_urls_from_text(text: str) -> List[str]:
         """Extract all URLs from a text string"""
         if not text:
             return []
-        # URL pattern - matches http://, https://, and www. URLs
-        url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        urls = re.findall(url_pattern, text)
-        return urls
+        return URL_REGEX.findall(text)
+
+    def login(self, username: str, password: Optional[str] = None, session_file: Optional[str] = None,
+              two_factor_code: Optional[Callable[[], str]] = None,
+              password_prompt: Optional[Callable[[], str]] = None) -> bool:
+        """Login to Instagram, reusing a saved session when possible
 
-    def login(self, username: str, password: str) -> bool:
-        """Login to Instagram with username and password"""
+        With a ``session_file``, the session saved there by an earlier run is loaded instead of
+        logging in again. A session saved or verified within SESSION_TRUST_SECONDS is used as is;
+        an older one is first checked with a single lightweight request. If there is no valid
+        session, the extractor logs in with the password and saves the new session to
+        ``session_file``. Without a ``password``, ``password_prompt`` (if any) is called for one
+        only then. ``two_factor_code`` is called for the code when Instagram asks for two-factor
+        authentication. The credentials are kept, so that a session expiring in the middle of a
+        run is renewed transparently.
+        """
+        if self.recorder is not None and self.recorder.mode == 'replay':
+            try:
+                self.loader.login(username, password)
+            except instaloader.exceptions.LoginException as e:
+                print(f"✗ Login failed: {e}")
+                return False
+            print(f"✓ Replaying the recorded session of {self.loader.context.username}")
+            return True
+
+        self._credentials = (username, password, session_file)
+        if session_file and self._load_session(username, session_file):
+            return True
+        if not password and password_prompt is not None:
+            password = password_prompt()
+            self._credentials = (username, password, session_file)
+        if not password:
+            print("✗ Login failed: no valid saved session, and no password given")
+            return False
+        return self._password_login(username, password, session_file, two_factor_code)
+
+    def _load_session(self, username: str, session_file: str) -> bool:
+        """Load a saved session, verifying it if it has not been used for a while"""
+        if not os.path.isfile(session_file):
+            return False
+        context = self.loader.context
+        try:
+            with self.metrics.phase('login'):
+                self.loader.load_session_from_file(username, session_file)
+        except Exception as e:
+            print(f"⚠ Could not load the saved session from {session_file}: {e}")
+            context.username = None
+            return False
+        cookies = context._session.cookies.get_dict()  # pylint:disable=protected-access
+        if not cookies.get('sessionid'):
+            print(f"⚠ The session saved in {session_file} is not logged in")
+            context.username = None
+            return False
+        context.user_id = cookies.get('ds_user_id')
+
+        if time.time() - os.path.getmtime(session_file) > SESSION_TRUST_SECONDS:
+            with self.metrics.phase('login'):
+                session_username = self.loader.test_login()
+            if not session_username or session_username.lower() != username.lower():
+                print(f"⚠ The session saved in {session_file} has expired")
+                context.username = None
+                return False
+            os.utime(session_file)  # verified: trusted for another SESSION_TRUST_SECONDS
+        print(f"✓ Logged in as {username} with the session saved in {session_file}")
+        return True
+
+    def _password_login(self, username: str, password: str, session_file: Optional[str],
+                        two_factor_code: Optional[Callable[[], str]] = None) -> bool:
         try:
             print(f"Logging in as {username}...")
-            self.loader.login(username, password)
+            with self.metrics.phase('login'):
+                try:
+                    self.loader.login(username, password)
+                except instaloader.exceptions.TwoFactorAuthRequiredException:
+                    if two_factor_code is None:
+                        raise
+                    self.loader.two_factor_login(two_factor_code())
             print("✓ Login successful!")
-            return True
         except instaloader.exceptions.BadCredentialsException:
-            print("✗ Login failed: Invalid username or password")
+            print("✗ Login failed: Invalid username or password (or two-factor code)")
             return False
         except instaloader.exceptions.TwoFactorAuthRequiredException:
-            print("✗ Two-factor authentication required. Please disable 2FA temporarily or use session file.")
+            print("✗ Two-factor authentication required. Log in once interactively to save a session.")
             return False
         except Exception as e:
             print(f"✗ Login failed: {e}")
             return False
 
-    def get_saved_collections(self) -> List[str]:
-        """Get list of saved collection names"""
+        if session_file:
+            try:
+                self.loader.save_session_to_file(session_file)
+                print(f"  Session saved to {session_file}")
+            except OSError as e:
+                print(f"⚠ Could not save the session to {session_file}: {e}")
+        return True
+
+    def _relogin(self, generation: int) -> bool:
+        """Renew an expired session with the stored credentials, once per expiry
+
+        ``generation`` is the session generation the failed request was sent with: if another
+        worker has renewed the session since, there is nothing left to do.
+        """
+        with self._login_lock:
+            if self._session_generation != generation:
+                return True
+            username, password, session_file = self._credentials or (None, None, None)
+            if not password:
+                return False
+            print("⚠ Session expired, logging in again...")
+            if not self._password_login(username, password, session_file):
+                return False
+            self._session_generation += 1
+            return True
+
+    def get_saved_collections(self) -> List[SavedCollection]:
+        """Get the logged-in user's saved collections
+
+        instaloader has no API for collections, so they are listed with the iPhone API endpoint
+        the app uses. The automatic "All posts" collection is left out; iter_locations() without
+        a collection covers it.
+        """
         try:
             print("\nFetching your saved collections...")
             collections = []
+            params = {'collection_types': '["MEDIA"]'}
+            while True:
+                with self.metrics.phase('page_fetch'):
+                    data = self._call_with_backoff(self.loader.context.get_iphone_json,
+                                                   'api/v1/collections/list/', dict(params))
+                for item in data.get('items') or []:
+                    if item.get('collection_type', 'MEDIA') != 'MEDIA':
+                        continue
+                    collections.append(SavedCollection(str(item['collection_id']), item['collection_name'],
+                                                       item.get('collection_media_count')))
+                if not (data.get('more_available') and data.get('next_max_id')):
+                    break
+                params['max_id'] = data['next_max_id']
 
-            # Get saved posts (collections are accessed through saved posts)
-            profile = instaloader.Profile.from_username(self.loader.context, self.loader.context.username)
-
-            # Note: Instaloader provides access to saved posts, but Instagram's API
-            # doesn't directly expose collection names. We'll work with all saved posts.
-            saved_posts = profile.get_saved_posts()
-
-            print("✓ Accessing saved posts...")
-            return saved_posts
+            print(f"✓ Found {len(collections)} collections")
+            return collections
 
         except Exception as e:
             print(f"✗ Error fetching collections: {e}")
             return []
 
-    def extract_locations_from_saved(self) -> List[Dict[str, any]]:
-        """Extract location data from saved posts"""
-        locations = []
+    def find_collections(self, names: Iterable[str]) -> List[SavedCollection]:
+        """Look up saved collections by name (case-insensitive)
+
+        Raises ValueError naming the available collections if a name is not found.
+        """
+        collections = self.get_saved_collections()
+        by_name = {collection.name.casefold(): collection for collection in collections}
+        found = []
+        for name in names:
+            collection = by_name.get(name.casefold())
+            if collection is None:
+                available = ', '.join(collection.name for collection in collections) or 'none'
+                raise ValueError(f"No saved collection named {name!r} (available: {available})")
+            if collection not in found:
+                found.append(collection)
+        return found
+
+    @staticmethod
+    def _is_rate_limit_error(error: Exception) -> bool:
+        """Whether an instaloader error is Instagram refusing requests (401 Unauthorized / 429)"""
+        if isinstance(error, instaloader.exceptions.TooManyRequestsException):
+            return True
+        return isinstance(error, instaloader.exceptions.ConnectionException) and (
+            '401 Unauthorized' in str(error) or '429' in str(error))
+
+    def _call_with_backoff(self, func, *args):
+        """Call func(*args), pausing in-process and retrying it while Instagram rate limits us
+
+        If the session expires, it is renewed once and the call retried.
+        """
+        renewed = False
+        attempt = 0
+        while True:
+            generation = self._session_generation
+            try:
+                result = func(*args)
+            except instaloader.exceptions.LoginRequiredException:
+                if renewed or not self._relogin(generation):
+                    raise
+                renewed = True
+            except instaloader.exceptions.ConnectionException as e:
+                if not self._is_rate_limit_error(e) or attempt == self.scheduler.max_retries:
+                    raise
+                attempt += 1
+                self.scheduler.backoff()
+            else:
+                self.scheduler.record_success()
+                return result
+
+    def _iter_with_backoff(self, iterator):
+        """Iterate, retrying a failed page fetch after backing off (NodeIterator keeps its position)"""
+        while True:
+            try:
+                item = self._call_with_backoff(next, iterator)
+            except StopIteration:
+                return
+            yield item
+
+    def _prefetch_pages(self, pages: Iterator[list], freeze: Optional[Callable[[], Dict[str, any]]] = None,
+                        stop_at: Iterable[str] = ()) -> Iterator[Tuple[list, Optional[Dict[str, any]]]]:
+        """Yield (page, freeze()) pairs, fetching up to ``self.prefetch`` pages ahead in a background thread
+
+        ``freeze`` is called right after each page, before the next one is fetched, so that it can
+        capture the position of the underlying iterator at that page. Fetching stops after a page
+        containing a shortcode of ``stop_at``, where the consumer is expected to stop. An error of
+        the fetching thread is raised in the consumer, after the pages fetched before it.
+        """
+        if self.prefetch < 1:
+            for page in pages:
+                yield page, freeze() if freeze else None
+            return
+
+        stop_at = set(stop_at)
+        pending = queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            # Gives up once the consumer is gone, instead of blocking on the full queue forever
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for page in pages:
+                    if not put((page, freeze() if freeze else None)):
+                        return
+                    if stop_at and any(post.shortcode in stop_at for post in page):
+                        break
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, name='saved-posts-prefetch', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            producer.join()
+
+    def _get_saved_posts(self):
+        """Return the iterator over the logged-in user's saved posts"""
+        profile = instaloader.Profile.from_username(self.loader.context, self.loader.context.username)
+        return profile.get_saved_posts()
+
+    def _get_post(self, shortcode: str):
+        """Fetch a post by its shortcode"""
+        return instaloader.Post.from_shortcode(self.loader.context, shortcode)
+
+    def _complete_cached(self, shortcode: str) -> Optional[LocationRecord]:
+        """Return the cached location of a post not seen in this run, or None if it has none
+
+        Fields this run extracts but the run that cached the post left out are read from the post,
+        fetched again for them. A post that can no longer be fetched (unsaved or deleted since,
+        say) is left out.
+        """
+        cached = self.cache.lookup(shortcode)
+        if cached is None or cached[0] is None:
+            return None
+        record, _, unresolved = cached
+        missing = self._post_fields & unresolved
+        if missing:
+            try:
+                with self.metrics.phase('resolve'):
+                    post = self._call_with_backoff(self._get_post, shortcode)
+                    self._call_with_backoff(self._resolve_fields, post, record, missing)
+            except instaloader.exceptions.InstaloaderException as e:
+                print(f"⚠ Could not fetch post {shortcode} again, leaving it out: {e}")
+                return None
+            self.cache.refresh(shortcode, record, unresolved - missing, refreshed=False)
+        return record
+
+    def _resolve_location(self, post) -> Optional['instaloader.PostLocation']:
+        """Return a post's location, consulting the location cache before Post.location can fetch it"""
+        # pylint:disable=protected-access
+        if 'location' in post._node:
+            stub = post._node['location']
+        else:
+            # Without the location stub in the page node, only the full post metadata can tell; the
+            # location it names may be cached all the same
+            try:
+                stub = post._field('location')
+            except KeyError:
+                return None
+        if not stub:
+            return None
+
+        location_id = int(stub['id'])
+        with self._lock:
+            # Concurrent workers looking up the same location wait for a single fetch
+            location_lock = self._location_locks.setdefault(location_id, threading.Lock())
+
+        with location_lock:
+            location = self.locations.get(location_id)
+            if location is None and self.cache is not None:
+                location = self.cache.get_location(location_id)
+                if location is not None:
+                    self.locations[location_id] = location
+            if location is not None:
+                with self._lock:
+                    self.location_cache_hits += 1
+                return location
+
+            # May fetch the location page to fill in lat/lng
+            with self._lock:
+                self.location_cache_misses += 1
+            location = post.location
+            if location is not None:
+                self.locations[location_id] = location
+                if self.cache is not None:
+                    self.cache.put_location(location)
+            return location
+
+    def _may_match(self, post) -> bool:
+        """Whether a post may match the location filter, judged without any request
+
+        Besides the page node, the coordinates of the post's location are used if they are
+        already known (in the location stub, or in the location caches).
+        """
+        node = post._node  # pylint:disable=protected-access
+        stub = node.get('location')
+        coordinates = None
+        if stub and (self.location_filter.bbox or self.location_filter.near):
+            if stub.get('lat') is not None and stub.get('lng') is not None:
+                coordinates = (stub['lat'], stub['lng'])
+            else:
+                location_id = int(stub['id'])
+                location = self.locations.get(location_id)
+                if location is None and self.cache is not None:
+                    location = self.cache.get_location(location_id)
+                if location is not None:
+                    coordinates = (location.lat, location.lng)
+        return self.location_filter.may_match(node, coordinates)
+
+    def _build_location_record(self, post) -> Optional[LocationRecord]:
+        """Resolve a post's lazy properties into a location record, or None if it has no location
+
+        Only the properties behind the extractor's fields are read.
+        """
+        location = self._resolve_location(post)
+        if not location:
+            return None
 
+        record = LocationRecord(shortcode=post.shortcode, name=location.name, latitude=location.lat,
+                                longitude=location.lng, date='')
+        self._resolve_fields(post, record, self._post_fields)
+        return record
+
+    def _resolve_fields(self, post, record: LocationRecord, fields: FrozenSet[str]):
+        """Set the given POST_FIELDS of a record from the post, reading no other property"""
+        if 'date' in fields:
+            record.date = post.date_local.strftime('%Y-%m-%d %H:%M:%S')
+
+        if fields & CAPTION_FIELDS:
+            # Get full caption text
+            full_caption = post.caption or ''
+
+            # Extract URLs, hashtags and mentions in a single pass over the caption
+            with self.metrics.phase('caption_parsing'):
+                caption = analyze_caption(full_caption)
+            values = {
+                'caption': full_caption,
+                'caption_urls': ', '.join(caption.urls),
+                'hashtags': ' '.join([f'#{tag}' for tag in caption.hashtags]),
+                'mentions': ' '.join([f'@{mention}' for mention in caption.mentions]),
+            }
+            for field in fields & CAPTION_FIELDS:
+                setattr(record, field, values[field])
+
+        if 'owner_username' in fields:
+            record.owner_username = sys.intern(post.owner_username or '')
+        if 'likes' in fields:
+            record.likes = post.likes
+        if 'comments' in fields:
+            record.comments = post.comments
+        if 'is_video' in fields:
+            record.is_video = post.is_video
+        if 'video_url' in fields:
+            record.video_url = post.video_url if post.is_video else ''
+        if 'display_url' in fields:
+            # Read from the page node: Post.url may request the full-resolution version
+            node = post._node  # pylint:disable=protected-access
+            record.display_url = node.get('display_url') or node.get('thumbnail_src') or ''
+
+    def _extract_post(self, post) -> Tuple[Optional[LocationRecord], bool]:
+        """Return (record, from_cache) for a post, consulting the cache before touching lazy properties"""
+        # The shortcode is part of the page node, so reading it never costs a request
+        shortcode = post.shortcode
+
+        if self.cache is not None:
+            cached = self.cache.lookup(shortcode)
+            if cached is not None:
+                record, is_stale, unresolved = cached
+                # Fields left out by an earlier run with fewer fields are read now, and volatile ones
+                # once stale, but only if this run extracts them
+                missing = self._post_fields & unresolved
+                refreshed = is_stale and bool(self._post_fields.intersection(VOLATILE_FIELDS))
+                if refreshed:
+                    missing |= self._post_fields.intersection(VOLATILE_FIELDS)
+                if record is not None and missing:
+                    self._call_with_backoff(self._resolve_fields, post, record, missing)
+                    self.cache.refresh(shortcode, record, unresolved - missing, refreshed)
+                return record, True
+
+        with self.metrics.phase('resolve'):
+            record = self._call_with_backoff(self._build_location_record, post)
+        if self.cache is not None:
+            self.cache.put(shortcode, record, POST_FIELDS - self._post_fields)
+        return record, False
+
+    @staticmethod
+    def _enrich_page(extract_post: Callable, posts: list, executor: Optional[ThreadPoolExecutor]) -> list:
+        """Extract a page of posts, resolving their lazy properties on the executor's workers
+
+        Results are returned in the order of the given posts.
+        """
+        if executor is None or len(posts) < 2:
+            return [extract_post(post) for post in posts]
+        return list(executor.map(extract_post, posts))
+
+    @staticmethod
+    def _iter_pages(posts, page_length: int):
+        """Group an iterator of posts into lists of (at most) page_length posts"""
+        page = []
+        for post in posts:
+            page.append(post)
+            if len(page) == page_length:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    @staticmethod
+    def _save_checkpoint(path: str, state: Dict[str, any]):
+        """Atomically write resume information, so an interruption never leaves a corrupt file"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _load_checkpoint(path: str, saved_posts) -> Optional[Dict[str, any]]:
+        """Load resume information and thaw the saved-posts iterator with it, or return None
+
+        The ``<path>.rows`` file is truncated to the rows of the completed pages.
+        """
+        if not os.path.isfile(path):
+            print(f"⚠ No resume information found at {path}, starting from the beginning")
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            # The rows come first: the iterator is only thawed once they are known to be there
+            with open(path + '.rows', 'r+', encoding='utf-8') as f:
+                # Drop a page that was appended after the checkpoint was last written
+                f.truncate(state['rows_size'])
+            saved_posts.thaw(instaloader.FrozenNodeIterator(**state['iterator']))
+            return state
+        except (instaloader.exceptions.InvalidArgumentException, json.JSONDecodeError, OSError,
+                KeyError, TypeError) as e:
+            print(f"⚠ Not resuming from {path}: {e}")
+            return None
+
+    def iter_locations(self, incremental: bool = False, checkpoint_path: Optional[str] = None,
+                       resume: bool = False, collection: Optional[SavedCollection] = None) -> Iterator[LocationRecord]:
+        """Yield location data from saved posts as soon as each page has been extracted
+
+        Memory use does not grow with the number of saved posts. Progress is counted in
+        ``self.stats`` ('posts', 'locations', 'cached').
+
+        With ``incremental=True`` (requires a cache), pagination stops at the first post that was
+        already among the newest saved posts of the previous run, and the locations of all
+        previously seen posts are merged in from the cache.
+
+        With a ``checkpoint_path``, the position of the saved-posts iterator is written after every
+        completed page, and the page's rows are appended to ``<checkpoint_path>.rows``.
+        ``resume=True`` continues an interrupted run from the last completed page, yielding the
+        rows found before the interruption first; both files are removed once the extraction
+        completes.
+
+        With a ``collection`` (see get_saved_collections()), only the posts of that collection are
+        extracted, and each record's ``collection`` is set to its name. Collections are not
+        checkpointed, and incremental runs keep a separate watermark per collection.
+        """
+        return self._drive(self._extraction(incremental, checkpoint_path, resume, collection))
+
+    def _drive(self, steps: Generator[any, any, None]) -> Iterator[LocationRecord]:
+        """Run an _extraction() synchronously, resolving the posts of a page on a thread pool"""
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        send, value = steps.send, None
         try:
-            profile = instaloader.Profile.from_username(self.loader.context, self.loader.context.username)
-            saved_posts = profile.get_saved_posts()
-
-            print("\nExtracting locations from saved posts...")
-            post_count = 0
-            location_count = 0
-
-            for post in saved_posts:
-                post_count += 1
-
-                if post.location:
-                    # Get full caption text
-                    full_caption = post.caption if post.caption else ''
-
-                    # Extract URLs from caption
-                    caption_urls = self.extract_urls_from_text(full_caption)
-
-                    # Extract hashtags
-                    hashtags = ' '.join([f'#{tag}' for tag in post.caption_hashtags]) if post.caption_hashtags else ''
-
-                    # Extract mentions
-                    mentions = ' '.join([f'@{mention}' for mention in post.caption_mentions]) if post.caption_mentions else ''
-
-                    location_data = {
-                        'name': post.location.name,
-                        'latitude': post.location.lat,
-                        'longitude': post.location.lng,
-                        'post_url': f"https://www.instagram.com/p/{post.shortcode}/",
-                        'date': post.date_local.strftime('%Y-%m-%d %H:%M:%S'),
-                        'caption': full_caption,
-                        'caption_urls': ', '.join(caption_urls) if caption_urls else '',
-                        'hashtags': hashtags,
-                        'mentions': mentions,
-                        'owner_username': post.owner_username,
-                        'likes': post.likes,
-                        'comments': post.comments,
-                        'is_video': post.is_video,
-                        'video_url': post.video_url if post.is_video else ''
-                    }
-                    locations.append(location_data)
-                    location_count += 1
-                    print(f"  [{location_count}] Found: {post.location.name}")
-
-                # Show progress every 10 posts
-                if post_count % 10 == 0:
-                    print(f"  Processed {post_count} posts, found {location_count} locations...")
-
-            print(f"\n✓ Extraction complete: {location_count} locations from {post_count} posts")
-            return locations
+            while True:
+                try:
+                    step = send(value)
+                except StopIteration:
+                    return
+                send, value = steps.send, None
+                if isinstance(step, LocationRecord):
+                    yield step
+                    continue
+                try:
+                    if isinstance(step, _BlockingMap):
+                        value = self._enrich_page(step.function, step.items, executor)
+                    else:
+                        value = step.function(*step.args)
+                except (Exception, KeyboardInterrupt) as e:
+                    # Into the extraction, which saves and reports its progress
+                    send, value = steps.throw, e
+        finally:
+            steps.close()
+            if executor is not None:
+                executor.shutdown()
+
+    def iter_collection_locations(self, collections: Iterable[SavedCollection], incremental: bool = False,
+                                  concurrency: int = DEFAULT_COLLECTION_CONCURRENCY) -> Iterator[LocationRecord]:
+        """Yield the locations of several saved collections, crawling up to ``concurrency`` at once
+
+        Each collection is extracted as by iter_locations(collection=...), in its own thread, and
+        the records are yielded as they arrive, tagged with their collection; a post saved in
+        several collections is yielded once for each. All crawls go through this extractor's
+        RequestScheduler, so together they stay within one rate budget. ``self.stats`` adds up
+        the collections. An error of one crawl stops the others and is raised here.
+        """
+        collections = list(collections)
+        self.stats = {'posts': 0, 'locations': 0, 'cached': 0}
+        self.location_cache_hits = 0
+        self.location_cache_misses = 0
+        if not collections:
+            return
+        collection_stats = [dict(self.stats) for _ in collections]
+        pending = queue.Queue(maxsize=max(self.workers, 1) * instaloader.NodeIterator.page_length())
+        stopped = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def crawl(collection: SavedCollection, stats: Dict[str, int]):
+            try:
+                steps = self._extraction(incremental, None, False, collection, stats)
+                with contextlib.closing(self._drive(steps)) as records:
+                    for record in records:
+                        if not put(record):
+                            return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        def add_up():
+            for key in self.stats:
+                self.stats[key] = sum(stats[key] for stats in collection_stats)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(collections))),
+                                      thread_name_prefix='collection-crawl')
+        for collection, stats in zip(collections, collection_stats):
+            executor.submit(crawl, collection, stats)
+        try:
+            remaining = len(collections)
+            while remaining:
+                item = pending.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                add_up()
+                yield item
+            add_up()
+            print(f"\n✓ Extracted {self.stats['locations']} locations from {self.stats['posts']} posts "
+                  f"in {len(collections)} collections")
+        finally:
+            stopped.set()
+            executor.shutdown(cancel_futures=True)
+
+    async def aiter_locations(self, incremental: bool = False, checkpoint_path: Optional[str] = None,
+                              resume: bool = False, collection: Optional[SavedCollection] = None,
+                              semaphore: Optional['asyncio.Semaphore'] = None) -> AsyncIterator[LocationRecord]:
+        """Asynchronous iter_locations(), for use in an asyncio application
+
+        ``async for record in extractor.aiter_locations():`` yields the same records as
+        iter_locations(). The blocking instaloader requests run in worker threads
+        (asyncio.to_thread()), so the event loop stays free while pages are fetched; the posts
+        of a page are resolved concurrently, at most ``self.workers`` at a time (besides the
+        page being prefetched, see ``prefetch``). Pass a ``semaphore`` to limit the calls in
+        flight across several extractors instead, and give them one RequestScheduler to share
+        their rate budgets as well.
+        """
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.workers)
+
+        async def call(function, *args):
+            async with semaphore:
+                return await asyncio.to_thread(function, *args)
+
+        steps = self._extraction(incremental, checkpoint_path, resume, collection)
+        send, value = steps.send, None
+        try:
+            while True:
+                try:
+                    step = send(value)
+                except StopIteration:
+                    return
+                send, value = steps.send, None
+                if isinstance(step, LocationRecord):
+                    yield step
+                    continue
+                try:
+                    if isinstance(step, _BlockingMap):
+                        value = await asyncio.gather(*(call(step.function, item) for item in step.items))
+                    else:
+                        value = await call(step.function, *step.args)
+                except (Exception, KeyboardInterrupt) as e:
+                    send, value = steps.throw, e
+        finally:
+            # Closing waits for a page being prefetched, so it is not done on the event loop
+            await asyncio.to_thread(steps.close)
+
+    def _extraction(self, incremental: bool, checkpoint_path: Optional[str], resume: bool,
+                    collection: Optional[SavedCollection] = None,
+                    stats: Optional[Dict[str, int]] = None) -> Generator[any, any, None]:
+        """The extraction shared by iter_locations() and aiter_locations()
+
+        Yields the location records, and _BlockingCall and _BlockingMap requests for the blocking
+        network calls. The driver makes each call (in the way that suits it) and sends back its
+        result (for a map, the list of results in the order of the items), or throws its
+        exception into the generator. Everything else (cache, checkpoint and statistics) is done
+        here, so that both drivers extract identically.
+
+        Progress is counted in ``stats`` if given (leaving the extractor's counters alone, for
+        concurrent extractions), or else in a fresh ``self.stats``.
+        """
+        if collection is None:
+            state_key, source = 'saved_shortcodes', self._get_saved_posts
+            description = 'saved posts'
+        else:
+            state_key = f'collection_shortcodes:{collection.id}'
+            source = functools.partial(CollectionPosts, self.loader.context, collection)
+            description = f"collection '{collection.name}'"
+
+        # Saved shortcodes of the previous complete run, newest first
+        previous_shortcodes = None
+        if incremental:
+            if self.cache is None:
+                print("⚠ Incremental mode requires a cache, doing a full crawl instead")
+            else:
+                previous_shortcodes = self.cache.get_state(state_key)
+                if previous_shortcodes is None:
+                    print(f"⚠ No previous run recorded for {description}, doing a full crawl")
+        watermark = set(previous_shortcodes[:WATERMARK_SIZE]) if previous_shortcodes else set()
+
+        if stats is None:
+            self.stats = {'posts': 0, 'locations': 0, 'cached': 0}
+            self.location_cache_hits = 0
+            self.location_cache_misses = 0
+            stats = self.stats
+        # Saved order is only needed (and only kept) to record it in the cache
+        seen_shortcodes = [] if self.cache is not None else None
+        # A thawed iterator yields the last post of the checkpointed page again
+        last_shortcode = None
+        rows_file = None
+        pages = None
+
+        try:
+            with self.metrics.phase('page_fetch'):
+                saved_posts = yield _BlockingCall(self._call_with_backoff, (source,))
+
+            # Only instaloader's NodeIterator can be frozen and thawed
+            if not isinstance(saved_posts, instaloader.NodeIterator):
+                checkpoint_path = None
 
+            if checkpoint_path:
+                state = self._load_checkpoint(checkpoint_path, saved_posts) if resume else None
+                if state is not None:
+                    last_shortcode = state['last_shortcode']
+                    print(f"\nResuming from {checkpoint_path}")
+                    with open(checkpoint_path + '.rows', 'r', encoding='utf-8') as f:
+                        for line in f:
+                            page = json.loads(line)
+                            stats['posts'] += len(page['shortcodes'])
+                            if seen_shortcodes is not None:
+                                seen_shortcodes.extend(page['shortcodes'])
+                            for location_data in page['locations']:
+                                stats['locations'] += 1
+                                yield LocationRecord.from_dict(location_data)
+                    print(f"  Resumed after {stats['posts']} posts ({stats['locations']} locations)")
+                rows_file = open(checkpoint_path + '.rows', 'a' if state is not None else 'w', encoding='utf-8')
+
+            print(f"\nExtracting locations from {description}...")
+            reached_watermark = False
+            reached_since = False
+            location_filter = self.location_filter
+            filtered_count = 0
+
+            # The next pages are fetched while this one is extracted; the iterator position of each
+            # page is frozen as soon as it has been fetched, for its checkpoint
+            saved_pages = self._iter_pages(self._iter_with_backoff(saved_posts), instaloader.NodeIterator.page_length())
+            freeze = (lambda: saved_posts.freeze()._asdict()) if checkpoint_path else None
+            pages = self._prefetch_pages(self.metrics.timed_iter(saved_pages, 'page_fetch'), freeze, watermark)
+            while True:
+                fetched = yield _BlockingCall(next, (pages, None))
+                if fetched is None:
+                    break
+                page, iterator_state = fetched
+                posts = []
+                for post in page:
+                    if post.shortcode == last_shortcode:
+                        continue
+
+                    if post.shortcode in watermark:
+                        print(f"  Reached previously synced post {post.shortcode}, stopping")
+                        reached_watermark = True
+                        break
+
+                    posts.append(post)
+
+                page_shortcodes = [post.shortcode for post in posts]
+                page_locations = []
+                if location_filter is not None:
+                    # pylint:disable=protected-access
+                    reached_since = location_filter.stop_before_since and bool(posts) and all(
+                        location_filter.is_before_since(post._node) for post in posts)
+                    candidates = [post for post in posts if self._may_match(post)]
+                    # Posts ruled out here were seen all the same
+                    stats['posts'] += len(posts) - len(candidates)
+                    filtered_count += len(posts) - len(candidates)
+                    posts = candidates
+
+                for location_data, from_cache in (yield _BlockingMap(self._extract_post, posts)):
+                    stats['posts'] += 1
+                    if from_cache:
+                        stats['cached'] += 1
+
+                    if location_data and location_filter is not None and not location_filter.matches(location_data):
+                        filtered_count += 1
+                        location_data = None
+
+                    if location_data:
+                        if collection is not None:
+                            location_data.collection = collection.name
+                        page_locations.append(location_data)
+                        stats['locations'] += 1
+                        print(f"  [{stats['locations']}] Found: {location_data.name}")
+
+                    # Show progress every 10 posts
+                    if stats['posts'] % 10 == 0:
+                        print(f"  Processed {stats['posts']} posts, found {stats['locations']} locations...")
+
+                if seen_shortcodes is not None:
+                    seen_shortcodes.extend(page_shortcodes)
+
+                if rows_file is not None and not reached_watermark:
+                    rows_file.write(json.dumps({
+                        'shortcodes': page_shortcodes,
+                        'locations': [location_data.to_dict() for location_data in page_locations]
+                    }) + '\n')
+                    rows_file.flush()
+                    last_shortcode = page[-1].shortcode
+                    self._save_checkpoint(checkpoint_path, {
+                        'iterator': iterator_state,
+                        'last_shortcode': last_shortcode,
+                        'rows_size': rows_file.tell(),
+                    })
+
+                yield from page_locations
+
+                if reached_watermark:
+                    break
+                if reached_since:
+                    print(f"  Reached posts from before {location_filter.since}, stopping")
+                    break
+
+            print(f"\n✓ Extraction complete: {stats['locations']} locations from {stats['posts']} posts"
+                  + (f" in {description}" if collection is not None else ''))
+            if filtered_count:
+                self.metrics.increment('posts_filtered', filtered_count)
+                print(f"  ({filtered_count} posts did not match the filter)")
+            if self.location_cache_hits:
+                print(f"  ({self.location_cache_hits} location lookups served from the location cache)")
+            scheduler_stats = self.scheduler.stats()
+            if scheduler_stats['rate_limited']:
+                print(f"  (rate limited {scheduler_stats['rate_limited']} times, "
+                      f"waited {scheduler_stats['total_wait_seconds']:.0f}s in total)")
+
+            if self.cache is not None:
+                print(f"  ({stats['cached']} posts served from cache: {self.cache.path})")
+                if watermark:
+                    new_shortcodes = set(seen_shortcodes)
+                    previous_shortcodes = [sc for sc in previous_shortcodes if sc not in new_shortcodes]
+                    merged_count = 0
+                    # A page at a time, so that memory use does not grow with the previous run
+                    page_length = instaloader.NodeIterator.page_length()
+                    for start in range(0, len(previous_shortcodes), page_length):
+                        batch = previous_shortcodes[start:start + page_length]
+                        for record in (yield _BlockingMap(self._complete_cached, batch)):
+                            if record and (location_filter is None or location_filter.matches(record)):
+                                merged_count += 1
+                                if collection is not None:
+                                    record.collection = collection.name
+                                yield record
+                    seen_shortcodes.extend(previous_shortcodes)
+                    print(f"  Merged {merged_count} locations from the previous run")
+                # Stopping at the date cutoff leaves the older posts unseen, and posts ruled out by
+                # the filter are not cached, so the last complete unfiltered run stays the reference
+                if not reached_since and location_filter is None:
+                    self.cache.set_state(state_key, seen_shortcodes)
+
+            if rows_file is not None:
+                rows_file.close()
+                os.unlink(checkpoint_path + '.rows')
+                if os.path.isfile(checkpoint_path):
+                    os.unlink(checkpoint_path)
+
+        except (Exception, KeyboardInterrupt):
+            if checkpoint_path and os.path.isfile(checkpoint_path):
+                print("  Progress up to the last completed page is saved, re-run with --resume to continue")
+            raise
+
+        finally:
+            if pages is not None:
+                pages.close()
+            if rows_file is not None and not rows_file.closed:
+                rows_file.close()
+
+    def extract_locations_from_saved(self, incremental: bool = False, checkpoint_path: Optional[str] = None,
+                                     resume: bool = False, collections: Optional[List[SavedCollection]] = None,
+                                     concurrency: int = DEFAULT_COLLECTION_CONCURRENCY) -> List[LocationRecord]:
+        """Extract location data from saved posts into a list (see iter_locations())
+
+        With ``collections``, from those collections instead (see iter_collection_locations()).
+        On an error, the locations extracted so far are returned.
+        """
+        if collections is None:
+            records = self.iter_locations(incremental, checkpoint_path, resume)
+        else:
+            records = self.iter_collection_locations(collections, incremental, concurrency)
+        locations = []
+        try:
+            for location_data in records:
+                locations.append(location_data)
         except Exception as e:
             print(f"✗ Error extracting locations: {e}")
-            return locations
+        return locations
+
+    def export_to_csv(self, locations: Iterable[LocationRecord], filename: str = None) -> str:
+        """Export locations to CSV format for Google Maps import
 
-    def export_to_csv(self, locations: List[Dict[str, any]], filename: str = None) -> str:
-        """Export locations to CSV format for Google Maps import"""
+        ``locations`` may be any iterable, e.g. iter_locations(): rows are written and flushed as
+        they are produced, so the rows written before an error remain in the file. Location
+        dicts (as returned by LocationRecord.to_dict()) are accepted as well.
+        """
         if not filename:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f'instagram_locations_{timestamp}.csv'
 
+        exporter = None
         try:
-            # Extended field names to capture all post data
-            with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-                fieldnames = [
-                    'Name', 'Latitude', 'Longitude', 'Description', 'URL', 'Date',
-                    'Caption_Full', 'Caption_URLs', 'Hashtags', 'Mentions',
-                    'Owner_Username', 'Likes', 'Comments', 'Is_Video', 'Video_URL'
-                ]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-                writer.writeheader()
-                for loc in locations:
-                    writer.writerow({
-                        'Name': loc['name'],
-                        'Latitude': loc['latitude'],
-                        'Longitude': loc['longitude'],
-                        'Description': loc['caption'][:200] if loc['caption'] else '',  # Truncated for Google Maps display
-                        'URL': loc['post_url'],
-                        'Date': loc['date'],
-                        'Caption_Full': loc['caption'],
-                        'Caption_URLs': loc['caption_urls'],
-                        'Hashtags': loc['hashtags'],
-                        'Mentions': loc['mentions'],
-                        'Owner_Username': loc['owner_username'],
-                        'Likes': loc['likes'],
-                        'Comments': loc['comments'],
-                        'Is_Video': 'Yes' if loc['is_video'] else 'No',
-                        'Video_URL': loc['video_url']
-                    })
+            exporter = CsvExporter(filename, self.fields)
+            for loc in locations:
+                if isinstance(loc, dict):
+                    loc = LocationRecord.from_dict(loc)
+                exporter.write(loc)
+            exporter.close()
+            exporter.record_metrics(self.metrics)
 
-            print(f"\n✓ Exported {len(locations)} locations to: {filename}")
-            print(f"\nCSV includes:")
-            print(f"  - Full caption text (Caption_Full column)")
-            print(f"  - Extracted URLs from captions (Caption_URLs column)")
-            print(f"  - Hashtags and mentions")
-            print(f"  - Owner username, likes, comments")
-            print(f"  - Video URLs (if applicable)")
+            print(f"\n✓ Exported {exporter.count} locations to: {filename}")
+            if self.fields is None:
+                print(f"\nCSV includes:")
+                print(f"  - Full caption text (Caption_Full column)")
+                print(f"  - Extracted URLs from captions (Caption_URLs column)")
+                print(f"  - Hashtags and mentions")
+                print(f"  - Owner username, likes, comments")
+                print(f"  - Video URLs (if applicable)")
+            else:
+                print(f"\nCSV columns: {', '.join(csv_columns(self.fields))}")
             print(f"\nTo import into Google Maps:")
             print(f"1. Go to https://www.google.com/maps/d/")
             print(f"2. Click 'Create a New Map'")
@@ -177,47 +2722,728 @@ class InstagramLocationExtractor:
 
         except Exception as e:
             print(f"✗ Error exporting to CSV: {e}")
+            if exporter is not None:
+                if not exporter.file.closed:
+                    exporter.close()
+                    exporter.record_metrics(self.metrics)
+                if exporter.count:
+                    print(f"  {exporter.count} locations were written to {filename} before the error")
             return None
 
+    def export_to_formats(self, locations: Iterable[LocationRecord], formats: List[str],
+                          basename: str = None) -> Optional[Dict[str, str]]:
+        """Export locations to several formats (e.g. ['csv', 'geojson', 'kml']) in one pass
 
-def main():
-    print("=" * 60)
-    print("Instagram Collection Location Extractor")
-    print("=" * 60)
+        Files are named ``<basename>.<extension>``. Returns the filenames by format, or None
+        on an error (the locations written up to the error remain in the files).
+        """
+        if not basename:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            basename = f'instagram_locations_{timestamp}'
+        try:
+            outputs = {format_name: f'{basename}.{EXPORTERS[format_name].extension}' for format_name in formats}
+        except KeyError as e:
+            print(f"✗ Unknown export format: {e.args[0]} (available: {', '.join(EXPORTERS)})")
+            return None
 
-    extractor = InstagramLocationExtractor()
+        try:
+            counts = export_records(locations, outputs, self.metrics, self.fields)
+        except Exception as e:
+            print(f"✗ Error exporting locations: {e}")
+            return None
+
+        for format_name, filename in outputs.items():
+            print(f"✓ Exported {counts[format_name]} locations to: {filename}")
+        return outputs
+
+    def export_to_chunks(self, locations: Iterable[LocationRecord], basename: str = None,
+                         group_by: Optional[str] = None) -> Optional[List[str]]:
+        """Export locations to CSV files within Google My Maps' per-layer limits
+
+        See export_csv_chunks(). Returns the filenames written, the manifest last, or None on an
+        error (the chunks written up to the error are listed in the manifest).
+        """
+        if not basename:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            basename = f'instagram_locations_{timestamp}'
+        manifest_path = f'{basename}_manifest.json'
+
+        try:
+            manifest = export_csv_chunks(locations, basename, group_by=group_by, metrics=self.metrics,
+                                         fields=self.fields)
+        except Exception as e:
+            print(f"✗ Error exporting locations: {e}")
+            return None
+
+        print(f"\n✓ Exported {manifest['total_rows']} locations to {len(manifest['chunks'])} files "
+              f"(listed in {manifest_path}):")
+        for chunk in manifest['chunks']:
+            print(f"  {chunk['file']}: {chunk['rows']} locations")
+        print(f"\nImport each file as a separate layer of your map (My Maps allows up to 10 layers per map).")
+        chunk_dir = os.path.dirname(basename)
+        return [os.path.join(chunk_dir, chunk['file']) for chunk in manifest['chunks']] + [manifest_path]
+
+    def download_media(self, locations: Iterable[LocationRecord], directory: str,
+                       videos: bool = False) -> Iterator[LocationRecord]:
+        """Download the images (and with ``videos``, the videos) of locations, see MediaDownloader.download()
+
+        Returns an iterator over the locations, to be passed on to an export.
+        """
+        return MediaDownloader(directory, videos=videos, metrics=self.metrics).download(locations)
+
+    def run_report(self) -> Dict[str, any]:
+        """Timings, request counts, cache hit ratios and output sizes of this extractor's run so far"""
+        scheduler_stats = self.scheduler.stats()
+        location_lookups = self.location_cache_hits + self.location_cache_misses
+        counters = {
+            'posts': self.stats['posts'],
+            'locations': self.stats['locations'],
+            'post_cache_hits': self.stats['cached'] if self.cache is not None else 0,
+            'post_cache_misses': self.stats['posts'] - self.stats['cached'] if self.cache is not None else 0,
+            'location_cache_hits': self.location_cache_hits,
+            'location_cache_misses': self.location_cache_misses,
+        }
+        counters.update(self.metrics.counters)
+        return {
+            'started_at': self.metrics.started_at,
+            'duration_seconds': round(time.time() - self.metrics.started_at, 3),
+            'phases': {phase: {'seconds': round(totals['seconds'], 3), 'calls': totals['calls']}
+                       for phase, totals in self.metrics.phases.items()},
+            'counters': counters,
+            'cache': {
+                'post_cache_hit_ratio': round(self.stats['cached'] / self.stats['posts'], 4)
+                if self.cache is not None and self.stats['posts'] else None,
+                'location_cache_hit_ratio': round(self.location_cache_hits / location_lookups, 4)
+                if location_lookups else None,
+            },
+            'requests': {
+                'by_endpoint': scheduler_stats['requests'],
+                'rate_limited': scheduler_stats['rate_limited'],
+                # Pacing plus backoff after rate-limit responses
+                'wait_seconds': scheduler_stats['total_wait_seconds'],
+                'rates_per_minute': scheduler_stats['rates_per_minute'],
+            },
+        }
+
+
+# Environment variable the password is read from when there is no valid saved session
+DEFAULT_PASSWORD_ENV = 'INSTAGRAM_PASSWORD'
+# Keys of an entry of a batch run's accounts file (see load_accounts())
+ACCOUNT_KEYS = ('username', 'session_file', 'password_env', 'cache', 'record', 'replay')
+# Formats the merged output of a batch run can be built from, in order of preference
+MERGEABLE_FORMATS = ('ndjson', 'geojson', 'csv')
 
-    # Get credentials
-    print("\nEnter your Instagram credentials:")
-    username = input("Username: ").strip()
-    password = getpass.getpass("Password: ")
 
-    # Login
-    if not extractor.login(username, password):
+def build_parser() -> argparse.ArgumentParser:
+    """Command line of main(); everything an interactive run prompts for can be given here"""
+    parser = argparse.ArgumentParser(description="Extract locations from Instagram saved posts")
+
+    account = parser.add_argument_group('account')
+    account.add_argument('--username', help="Instagram account to log in as (prompted for if omitted)")
+    account.add_argument('--password-env', metavar='VAR', default=DEFAULT_PASSWORD_ENV,
+                         help="environment variable holding the password, used when there is no valid "
+                              f"saved session (default: {DEFAULT_PASSWORD_ENV}); prompted for if unset")
+    account.add_argument('--session-file', metavar='FILE',
+                         help="where the login session is saved and reused across runs "
+                              "(default: instaloader's session file for the username)")
+    account.add_argument('--accounts', metavar='FILE',
+                         help="batch mode: extract every account listed in the JSON file FILE, "
+                              "each in its own process, and merge their locations")
+    account.add_argument('--processes', type=int, metavar='N',
+                         help="with --accounts, number of accounts extracted at once "
+                              "(default: all of them, at most one per CPU)")
+
+    extraction = parser.add_argument_group('extraction')
+    extraction.add_argument('--incremental', action='store_true',
+                            help="only fetch the posts saved since the previous run; the others come from the cache")
+    extraction.add_argument('--resume', action='store_true',
+                            help=f"continue an interrupted extraction from {DEFAULT_CHECKPOINT_PATH}")
+    extraction.add_argument('--cache', metavar='FILE',
+                            help=f"post and location cache (default: {DEFAULT_CACHE_PATH}; "
+                                 "with --accounts, <output-dir>/<username>.sqlite3)")
+    extraction.add_argument('--no-cache', action='store_true', help="neither read nor update the cache")
+    extraction.add_argument('--workers', type=int, default=DEFAULT_WORKERS, metavar='N',
+                            help=f"posts of a page resolved concurrently (default: {DEFAULT_WORKERS})")
+    extraction.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH_PAGES, metavar='N',
+                            help="pages of saved posts fetched ahead while the current one is extracted "
+                                 f"(default: {DEFAULT_PREFETCH_PAGES}; 0 disables prefetching)")
+    extraction.add_argument('--collection', action='append', metavar='NAME',
+                            help="only extract the saved collection NAME, tagging its locations with the "
+                                 "name; repeat for several collections")
+    extraction.add_argument('--parallel-collections', type=int, default=DEFAULT_COLLECTION_CONCURRENCY,
+                            metavar='N', help="collections crawled at once, sharing one rate budget "
+                                              f"(default: {DEFAULT_COLLECTION_CONCURRENCY})")
+    extraction.add_argument('--list-collections', action='store_true',
+                            help="list the account's saved collections and exit")
+    extraction.add_argument('--dedupe', action='store_true',
+                            help="merge locations of the same place (within "
+                                 f"{DEFAULT_CLUSTER_DISTANCE_M} m and with similar names) into one pin")
+
+    filters = _add_filter_arguments(parser, "; posts ruled out by their page data are skipped before any "
+                                            "further request")
+    filters.add_argument('--stop-before-since', action='store_true',
+                         help="with --since, stop at the first page of saved posts that are all older than "
+                              "--since (saved posts are in the order they were saved, so older posts saved "
+                              "later are missed)")
+
+    output = _add_output_arguments(parser, "with --accounts, the merged output")
+    output.add_argument('--output-dir', metavar='DIR',
+                        help="with --accounts, directory of the per-account outputs, caches and logs "
+                             "(default: the current directory)")
+
+    run = parser.add_argument_group('run')
+    run.add_argument('-y', '--yes', action='store_true', help="do not ask for confirmation before extracting")
+    recording = run.add_mutually_exclusive_group()
+    recording.add_argument('--record', metavar='FILE',
+                           help="save every Instagram response of this run to FILE")
+    recording.add_argument('--replay', metavar='FILE',
+                           help="re-run a recorded extraction from FILE, offline and without logging in")
+    run.add_argument('--metrics', metavar='FILE',
+                     help="write a JSON report of the run (phase timings, requests, cache hit ratios) to FILE")
+    run.add_argument('--prometheus', metavar='FILE',
+                     help="write the run's metrics as a Prometheus textfile (e.g. for node_exporter) to FILE")
+
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    export = commands.add_parser(
+        'export', help="export the locations of the cache or of earlier exports again, offline",
+        description="Write the locations of the last run (from the cache) or of earlier exports again, "
+                    "filtered and in other formats, without connecting to Instagram")
+    export.add_argument('sources', nargs='*', metavar='EXPORT',
+                        help="earlier exports (.csv, .ndjson or .geojson) to read, each post once "
+                             "(default: the locations of the last run, from the cache)")
+    export.add_argument('--cache', metavar='FILE', help=f"cache to read (default: {DEFAULT_CACHE_PATH})")
+    filters = _add_filter_arguments(export)
+    filters.add_argument('--dedupe', action='store_true', help="merge locations of the same place into one pin")
+    _add_output_arguments(export)
+    return parser
+
+
+def _add_output_arguments(parser: argparse.ArgumentParser,
+                          output_note: Optional[str] = None) -> argparse._ArgumentGroup:
+    """Add the output options shared by extraction and the export command, returning their group"""
+    output = parser.add_argument_group('output')
+    output.add_argument('-o', '--output', metavar='BASENAME',
+                        help="output file name without extension (default: instagram_locations_<timestamp>"
+                             + (f"; {output_note})" if output_note else ")"))
+    output.add_argument('--format', default='csv',
+                        help=f"comma-separated output formats, written in one pass ({', '.join(EXPORTERS)})")
+    output.add_argument('--columns', metavar='FIELDS',
+                        help="comma-separated fields to extract and write (default: all); "
+                             f"{', '.join(REQUIRED_FIELDS)} are always included. Fields: {', '.join(RECORD_FIELDS)}")
+    output.add_argument('--chunked', action='store_true',
+                        help=f"split the CSV into files of at most {MY_MAPS_MAX_ROWS} rows and "
+                             f"{MY_MAPS_MAX_BYTES // (1024 * 1024)} MB, one Google My Maps layer each")
+    output.add_argument('--group-by', choices=CHUNK_GROUPINGS,
+                        help="with --chunked, put each region (10° square), year or month in separate files")
+    output.add_argument('--media', metavar='DIR',
+                        help="download the posts' images to DIR (named by content hash; files already "
+                             "downloaded are skipped) and add their paths to the output")
+    output.add_argument('--media-videos', action='store_true', help="with --media, download videos as well")
+    return output
+
+
+def _add_filter_arguments(parser: argparse.ArgumentParser, note: str = '') -> argparse._ArgumentGroup:
+    """Add the location filters shared by extraction and the export command, returning their group"""
+    filters = parser.add_argument_group('filters', "only locations matching every filter given" + note)
+    filters.add_argument('--since', type=_date_argument, metavar='YYYY-MM-DD', help="only posts from this day on")
+    filters.add_argument('--until', type=_date_argument, metavar='YYYY-MM-DD', help="only posts up to this day")
+    filters.add_argument('--bbox', type=_floats_argument(4), metavar='MIN_LAT,MIN_LNG,MAX_LAT,MAX_LNG',
+                         help="only locations inside this box")
+    filters.add_argument('--near', type=_floats_argument(3), metavar='LAT,LNG,KM',
+                         help="only locations within KM kilometers of LAT,LNG")
+    filters.add_argument('--hashtag', action='append', metavar='TAG',
+                         help="only posts with this hashtag; repeat to allow several")
+    filters.add_argument('--owner', action='append', metavar='USERNAME',
+                         help="only posts by this account; repeat to allow several")
+    videos = filters.add_mutually_exclusive_group()
+    videos.add_argument('--videos-only', action='store_true', help="only videos")
+    videos.add_argument('--no-videos', action='store_true', help="only photos")
+    return filters
+
+
+def _date_argument(value: str) -> str:
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a YYYY-MM-DD date: {value}")
+
+
+def _floats_argument(count: int) -> Callable[[str], Tuple[float, ...]]:
+    def parse(value: str) -> Tuple[float, ...]:
+        try:
+            numbers = tuple(float(number) for number in value.split(','))
+        except ValueError:
+            numbers = ()
+        if len(numbers) != count:
+            raise argparse.ArgumentTypeError(f"expected {count} comma-separated numbers: {value}")
+        return numbers
+    return parse
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse and check the command line
+
+    The output formats are put in ``args.formats``, the selected fields (None for all) in ``args.fields``
+    and the filters in ``args.location_filter``.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    args.formats = [format_name.strip() for format_name in args.format.split(',') if format_name.strip()]
+    unknown = [format_name for format_name in args.formats if format_name not in EXPORTERS]
+    if unknown or not args.formats:
+        parser.error(f"unknown format: {', '.join(unknown)}")
+    if args.chunked and args.formats != ['csv']:
+        parser.error("--chunked only applies to CSV output")
+    if args.group_by and not args.chunked:
+        parser.error("--group-by requires --chunked")
+    if args.media_videos and not args.media:
+        parser.error("--media-videos requires --media")
+    args.fields = None
+    if args.columns:
+        columns = [column.strip() for column in args.columns.split(',') if column.strip()]
+        # Fields the other options need or add
+        if args.media:
+            columns += ['display_url', 'image_file'] + (['video_url', 'video_file'] if args.media_videos else [])
+        if args.collection:
+            columns.append('collection')
+        if args.dedupe:
+            columns.append('cluster_size')
+        try:
+            args.fields = select_fields(columns)
+        except ValueError as e:
+            parser.error(f"--columns: {e}")
+    if args.since and args.until and args.since > args.until:
+        parser.error("--since is after --until")
+    try:
+        args.location_filter = LocationFilter(
+            args.since, args.until, args.bbox, args.near, args.hashtag or (), args.owner or (),
+            True if args.videos_only else False if args.no_videos else None, args.stop_before_since)
+    except ValueError as e:
+        parser.error(f"--stop-before-since: {e}")
+    if args.command == 'export':
+        if args.sources and args.cache:
+            parser.error("export reads either earlier exports or the cache, not both")
+        return args
+    if args.incremental and args.no_cache:
+        parser.error("--incremental requires the cache")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.prefetch < 0:
+        parser.error("--prefetch cannot be negative")
+    if args.parallel_collections < 1:
+        parser.error("--parallel-collections must be at least 1")
+    if args.collection and args.resume:
+        parser.error("--resume does not apply to --collection: collections are not checkpointed")
+
+    if args.accounts:
+        for option in ('username', 'session_file', 'cache', 'record', 'replay', 'prometheus', 'list_collections'):
+            if getattr(args, option):
+                parser.error(f"--{option.replace('_', '-')} applies to a single account; "
+                             "with --accounts, set it per account in the accounts file")
+        if not set(args.formats) & set(MERGEABLE_FORMATS):
+            parser.error(f"the merged output of --accounts is read back from {', '.join(MERGEABLE_FORMATS)} "
+                         "files; add one of them to --format")
+        if args.processes is not None and args.processes < 1:
+            parser.error("--processes must be at least 1")
+    elif args.processes is not None or args.output_dir:
+        parser.error("--processes and --output-dir require --accounts")
+    return args
+
+
+def login_account(extractor: InstagramLocationExtractor, username: str, session_file: Optional[str] = None,
+                  password_env: str = DEFAULT_PASSWORD_ENV, interactive: bool = False) -> bool:
+    """Log in with the saved session, else with the password from ``password_env``
+
+    Without a saved session or a password in the environment, the password (and a two-factor
+    code, if Instagram asks for one) is prompted for when ``interactive``; otherwise the login
+    fails.
+    """
+    session_file = session_file or instaloader.instaloader.get_default_session_filename(username)
+    # The password is passed along even with a saved session, to renew it should it expire mid-run
+    password = os.environ.get(password_env)
+    if not password and not interactive and not os.path.isfile(session_file):
+        print(f"✗ Login failed: no saved session for {username}, and ${password_env} is not set")
+        return False
+    password_prompt = (lambda: getpass.getpass("Password: ")) if interactive else None
+    two_factor_code = (lambda: input("Two-factor authentication code: ").strip()) if interactive else None
+    return extractor.login(username, password, session_file=session_file, two_factor_code=two_factor_code,
+                           password_prompt=password_prompt)
+
+
+def export_locations(extractor: InstagramLocationExtractor, locations: Iterable[LocationRecord],
+                     args: argparse.Namespace, basename: str) -> Optional[List[str]]:
+    """Write ``locations`` to ``<basename>.<extension>`` in the formats (or chunks) asked for in ``args``
+
+    Returns the filenames written, or None on an error.
+    """
+    if args.chunked:
+        return extractor.export_to_chunks(locations, basename, group_by=args.group_by)
+    if args.formats == ['csv']:
+        filename = extractor.export_to_csv(locations, f'{basename}.csv')
+        return [filename] if filename else None
+    outputs = extractor.export_to_formats(locations, args.formats, basename)
+    return list(outputs.values()) if outputs else None
+
+
+def extract_and_export(extractor: InstagramLocationExtractor, args: argparse.Namespace, basename: str,
+                       checkpoint_path: Optional[str] = None) -> Optional[List[str]]:
+    """Extract the logged-in account's locations and export them (see export_locations())
+
+    With ``args.collection``, only the named collections are extracted. When no locations were
+    written, the empty files are removed and an empty list is returned.
+    """
+    collections = None
+    if args.collection:
+        try:
+            collections = extractor.find_collections(args.collection)
+        except ValueError as e:
+            print(f"✗ {e}")
+            return None
+
+    if args.dedupe:
+        # Clustering needs every location, so nothing is streamed in this mode
+        records = extractor.extract_locations_from_saved(args.incremental, checkpoint_path, args.resume,
+                                                         collections, args.parallel_collections)
+        locations = dedupe_locations(records)
+        print(f"\n✓ Merged {len(records)} locations into {len(locations)} places")
+    elif collections is not None:
+        locations = extractor.iter_collection_locations(collections, args.incremental, args.parallel_collections)
+    else:
+        # Extract locations, streaming them into the output files as they are found
+        locations = extractor.iter_locations(args.incremental, checkpoint_path, args.resume)
+    if args.media:
+        locations = extractor.download_media(locations, args.media, videos=args.media_videos)
+    # Rows rather than extracted locations: an incremental run also writes those of earlier runs
+    rows_before = extractor.metrics.counters.get('rows_written', 0)
+    filenames = export_locations(extractor, locations, args, basename)
+
+    if filenames and extractor.metrics.counters.get('rows_written', 0) == rows_before:
+        for filename in filenames:
+            os.remove(filename)
+        return []
+    return filenames
+
+
+def load_accounts(path: str) -> List[Dict[str, str]]:
+    """Read the accounts of a batch run from a JSON file
+
+    The file holds a list of usernames, or of objects with a "username" and optionally a
+    "session_file", a "password_env" (the environment variable holding the account's password),
+    a "cache", and a recording to "record" to or "replay" from.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("expected a list of accounts")
+
+    accounts = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {'username': entry}
+        if not isinstance(entry, dict) or not entry.get('username'):
+            raise ValueError(f"account without a username: {entry!r}")
+        unknown = set(entry) - set(ACCOUNT_KEYS)
+        if unknown:
+            raise ValueError(f"unknown keys for {entry['username']}: {', '.join(sorted(unknown))}")
+        if entry.get('record') and entry.get('replay'):
+            raise ValueError(f"{entry['username']} cannot both record and replay")
+        accounts.append(dict(entry))
+
+    usernames = [account['username'] for account in accounts]
+    duplicates = sorted({username for username in usernames if usernames.count(username) > 1})
+    if duplicates:
+        raise ValueError(f"accounts listed more than once: {', '.join(duplicates)}")
+    return accounts
+
+
+def merge_exports(filenames: Iterable[str]) -> Iterator[LocationRecord]:
+    """Read the locations of several exports (see read_export()), each post only once"""
+    seen = set()
+    for filename in filenames:
+        for record in read_export(filename):
+            if record.shortcode not in seen:
+                seen.add(record.shortcode)
+                yield record
+
+
+def _mergeable_files(filenames: List[str]) -> List[str]:
+    """The files of one account's output to read its locations back from (all chunks, or one format)"""
+    for format_name in MERGEABLE_FORMATS:
+        extension = f'.{EXPORTERS[format_name].extension}'
+        matching = [filename for filename in filenames if filename.endswith(extension)]
+        if matching:
+            return matching
+    return []
+
+
+def _run_account(job: Dict[str, any]) -> Dict[str, any]:
+    """Extract one account of a batch run; runs in a worker process
+
+    Everything the extraction prints goes to the account's log file. Returns a summary with
+    the files written, the number of locations and the run report.
+    """
+    args = job['args']
+    summary = {'username': job['username'], 'ok': False, 'error': None, 'files': [], 'locations': 0,
+               'log': job['log'], 'report': None}
+    with open(job['log'], 'a', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(f"=== {datetime.now().isoformat(timespec='seconds')} {job['username']} ===")
+        extractor = None
+        try:
+            if job['replay']:
+                extractor = InstagramLocationExtractor(workers=args.workers, prefetch=args.prefetch,
+                                                       recorder=ResponseRecorder(job['replay']), fields=args.fields,
+                                                       location_filter=args.location_filter)
+                logged_in = extractor.login(job['username'], '')
+            else:
+                # Every account has its own scheduler, and so its own rate budget
+                recorder = ResponseRecorder(job['record'], mode='record') if job['record'] else None
+                extractor = InstagramLocationExtractor(cache_path=job['cache'], workers=args.workers,
+                                                       prefetch=args.prefetch, recorder=recorder,
+                                                       fields=args.fields, location_filter=args.location_filter)
+                logged_in = login_account(extractor, job['username'], job['session_file'], job['password_env'])
+            if not logged_in:
+                summary['error'] = "login failed"
+                return summary
+
+            filenames = extract_and_export(extractor, args, job['basename'], job['checkpoint'])
+            if filenames is None:
+                summary['error'] = "export failed"
+                return summary
+            summary.update(ok=True, files=filenames, locations=extractor.stats['locations'])
+        except Exception as e:
+            print(f"✗ {type(e).__name__}: {e}")
+            summary['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            if extractor is not None:
+                summary['report'] = extractor.run_report()
+                if extractor.recorder is not None:
+                    extractor.recorder.close()
+                if extractor.cache is not None:
+                    extractor.cache.close()
+    return summary
+
+
+def run_batch(args: argparse.Namespace,
+              accounts: List[Dict[str, str]]) -> Tuple[List[Dict[str, any]], bool]:
+    """Extract the accounts (see load_accounts()) in worker processes and merge their locations
+
+    Each account has its own session, cache, rate budget, checkpoint, log file and outputs,
+    all named after the username in ``args.output_dir``. The locations of all accounts are
+    then written, each post once, to the merged output ``args.output``. Returns the accounts'
+    summaries (see _run_account()), in the order of the accounts file, and whether the merged
+    output could be written (True if there was nothing to merge).
+    """
+    output_dir = args.output_dir or '.'
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for account in accounts:
+        account_base = os.path.join(output_dir, account['username'])
+        jobs.append({
+            'args': args,
+            'username': account['username'],
+            'session_file': account.get('session_file'),
+            'password_env': account.get('password_env', args.password_env),
+            'cache': None if args.no_cache else account.get('cache', f'{account_base}.sqlite3'),
+            'record': account.get('record'),
+            'replay': account.get('replay'),
+            'basename': account_base,
+            'checkpoint': f'{account_base}.resume.json',
+            'log': f'{account_base}.log',
+        })
+    if not jobs:
+        print("⚠ No accounts to extract")
+        return [], True
+
+    processes = args.processes or min(len(jobs), os.cpu_count() or 1)
+    print(f"\nExtracting {len(jobs)} accounts in {processes} processes (logs in {output_dir})")
+    summaries = {}
+    with concurrent_process.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(_run_account, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # e.g. a worker process that died
+                summary = {'username': job['username'], 'ok': False, 'error': f"{type(e).__name__}: {e}",
+                           'files': [], 'locations': 0, 'log': job['log'], 'report': None}
+            summaries[job['username']] = summary
+            if summary['ok']:
+                print(f"✓ {job['username']}: {summary['locations']} locations")
+            else:
+                print(f"✗ {job['username']}: {summary['error']} (see {job['log']})")
+    summaries = [summaries[job['username']] for job in jobs]
+
+    sources = [filename for summary in summaries if summary['ok'] for filename in _mergeable_files(summary['files'])]
+    merged = True
+    if sources:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        basename = args.output or os.path.join(output_dir, f'instagram_locations_{timestamp}')
+        print(f"\nMerging the locations of {sum(summary['ok'] for summary in summaries)} accounts:")
+        try:
+            locations = merge_exports(sources)
+            if args.dedupe:
+                # Different accounts may have saved different posts of the same place
+                locations = dedupe_locations(locations)
+            merged = export_locations(InstagramLocationExtractor(fields=args.fields), locations, args,
+                                      basename) is not None
+        except (OSError, ValueError, csv.Error) as e:
+            print(f"✗ Could not merge the accounts' locations: {e}")
+            merged = False
+    return summaries, merged
+
+
+def run_export(args: argparse.Namespace):
+    """The export command: write the locations of the cache or of earlier exports again, offline
+
+    Neither instaloader nor the network are needed, so this starts and runs quickly.
+    """
+    cache = None
+    if args.sources:
+        missing = [filename for filename in args.sources if not os.path.isfile(filename)]
+        if missing:
+            print(f"✗ No such file: {', '.join(missing)}")
+            sys.exit(2)
+        records = merge_exports(args.sources)
+    else:
+        cache_path = args.cache or DEFAULT_CACHE_PATH
+        if not os.path.isfile(cache_path):
+            print(f"✗ No cache at {cache_path}: run an extraction first, or give the exports to read")
+            sys.exit(2)
+        cache = PostCache(cache_path)
+        records = cache.last_run_records()
+
+    try:
+        records = args.location_filter.filter(records)
+        if args.dedupe:
+            records = list(records)
+            places = dedupe_locations(records)
+            print(f"\n✓ Merged {len(records)} locations into {len(places)} places")
+            records = places
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        extractor = InstagramLocationExtractor(fields=args.fields)
+        if args.media:
+            records = extractor.download_media(records, args.media, videos=args.media_videos)
+        filenames = export_locations(extractor, records, args, args.output or f'instagram_locations_{timestamp}')
+    finally:
+        if cache is not None:
+            cache.close()
+    if filenames is None:
         sys.exit(1)
+    if not extractor.metrics.counters.get('rows_written'):
+        for filename in filenames:
+            os.remove(filename)
+        print("\n⚠ No locations match")
 
-    # Note: Instagram API limitations mean we can't easily list collection names
-    # So we'll extract from all saved posts
-    print("\nNote: Due to Instagram API limitations, this will extract locations")
-    print("from ALL your saved posts (across all collections).")
 
-    proceed = input("\nProceed? (y/n): ").strip().lower()
-    if proceed != 'y':
-        print("Cancelled.")
-        sys.exit(0)
+def create_extractor(args: argparse.Namespace) -> InstagramLocationExtractor:
+    """The extractor of a single-account run, recording or replaying it if asked to"""
+    if args.replay:
+        # A replay neither reads nor updates the post cache, so that it repeats the recorded run exactly
+        return InstagramLocationExtractor(workers=args.workers, prefetch=args.prefetch,
+                                          recorder=ResponseRecorder(args.replay), fields=args.fields,
+                                          location_filter=args.location_filter)
+    recorder = ResponseRecorder(args.record, mode='record') if args.record else None
+    cache_path = None if args.no_cache else args.cache or DEFAULT_CACHE_PATH
+    return InstagramLocationExtractor(cache_path=cache_path, workers=args.workers, prefetch=args.prefetch,
+                                      recorder=recorder, fields=args.fields, location_filter=args.location_filter)
+
 
-    # Extract locations
-    locations = extractor.extract_locations_from_saved()
+def run_single(args: argparse.Namespace, extractor: InstagramLocationExtractor):
+    """Extract the locations of one account, prompting for what is missing when interactive
+
+    Exits with a non-zero status when the login or the export fails.
+    """
+    interactive = sys.stdin.isatty()
+    username = args.username or ''
+    if not username and not args.replay:
+        # Get credentials
+        print("\nEnter your Instagram credentials:")
+        try:
+            username = input("Username: ").strip()
+        except EOFError:
+            print("\n✗ No username given: use --username when running non-interactively")
+            sys.exit(2)
 
-    if not locations:
+    # Login, with the session saved by an earlier run if there is one
+    if args.replay:
+        logged_in = extractor.login(username, '')
+    else:
+        logged_in = login_account(extractor, username, args.session_file, args.password_env, interactive)
+    if not logged_in:
+        sys.exit(1)
+
+    if args.list_collections:
+        collections = extractor.get_saved_collections()
+        for collection in collections:
+            count = f" ({collection.media_count} posts)" if collection.media_count is not None else ''
+            print(f"  {collection.name}{count}")
+        return
+
+    if args.collection:
+        print(f"\nThis will extract locations from the collections: {', '.join(args.collection)}")
+    else:
+        print("\nThis will extract locations from ALL your saved posts (across all collections).")
+        print("Use --collection NAME to extract single collections (--list-collections lists them).")
+
+    if not args.yes:
+        try:
+            proceed = input("\nProceed? (y/n): ").strip().lower()
+        except EOFError:
+            proceed = ''
+        if proceed != 'y':
+            print("Cancelled (use --yes to proceed without asking).")
+            sys.exit(0)
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    basename = args.output or f'instagram_locations_{timestamp}'
+    filenames = extract_and_export(extractor, args, basename, DEFAULT_CHECKPOINT_PATH)
+    if filenames is None:
+        sys.exit(1)
+    if not filenames:
         print("\n⚠ No locations found in your saved posts.")
         print("This could mean:")
         print("  - None of your saved posts have location tags")
         print("  - There was an error accessing the data")
         sys.exit(0)
 
-    # Export to CSV
-    extractor.export_to_csv(locations)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+
+    print("=" * 60)
+    print("Instagram Collection Location Extractor")
+    print("=" * 60)
+
+    if args.command == 'export':
+        run_export(args)
+    elif args.accounts:
+        try:
+            accounts = load_accounts(args.accounts)
+        except (OSError, ValueError) as e:
+            print(f"✗ Could not read the accounts from {args.accounts}: {e}")
+            sys.exit(2)
+        summaries, merged = run_batch(args, accounts)
+        if args.metrics:
+            write_json_report({'accounts': {summary['username']: summary['report'] for summary in summaries}},
+                              args.metrics)
+            print(f"Run report written to {args.metrics}")
+        if not merged or not all(summary['ok'] for summary in summaries):
+            sys.exit(1)
+    else:
+        extractor = create_extractor(args)
+        try:
+            run_single(args, extractor)
+        finally:
+            if args.metrics or args.prometheus:
+                report = extractor.run_report()
+                if args.metrics:
+                    write_json_report(report, args.metrics)
+                    print(f"Run report written to {args.metrics}")
+                if args.prometheus:
+                    write_prometheus_textfile(report, args.prometheus)
+                    print(f"Prometheus metrics written to {args.prometheus}")
 
     print("\n" + "=" * 60)
     print("Done!")
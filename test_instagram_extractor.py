@@ -4,10 +4,268 @@ Test script for Instagram Location Extractor
 Creates mock data to test the CSV export functionality
 """
 
-from instagram_location_extractor import InstagramLocationExtractor
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+import csv
+import hashlib
+import json
+import random
+import subprocess
+import xml.etree.ElementTree as ET
+import instaloader
+import requests
+import sys
+from instagram_location_extractor import (InstagramLocationExtractor, LocationRecord, PostCache, RequestScheduler,
+                                          analyze_caption, analyze_captions, export_records,
+                                          haversine_km, SpatialIndex, cluster_locations, export_csv_chunks,
+                                          ResponseRecorder, ReplayMissError, write_json_report,
+                                          write_prometheus_textfile, main, parse_args, load_accounts,
+                                          read_export, filter_records, MediaDownloader, LocationFilter,
+                                          login_account, dedupe_locations, extract_and_export)
 from datetime import datetime
 
 
+def make_post_node(shortcode, location=None, caption='', owner='tester_owner', likes=10, comments=2,
+                   is_video=False, timestamp=1705314600):
+    """Build a saved-post page node carrying every field the extractor reads"""
+    node = {
+        'shortcode': shortcode,
+        'id': str(abs(hash(shortcode)) % 10 ** 12),
+        'is_video': is_video,
+        'taken_at_timestamp': timestamp,
+        'edge_media_to_caption': {'edges': [{'node': {'text': caption}}] if caption else []},
+        'owner': {'id': '42', 'username': owner},
+        'edge_media_preview_like': {'count': likes},
+        'edge_media_to_comment': {'count': comments},
+        'location': location,
+    }
+    if is_video:
+        node['video_url'] = f'https://cdn.example.com/{shortcode}.mp4'
+    return node
+
+
+def make_iphone_media(shortcode, location=None, caption='', owner='tester_owner', likes=10, comments=2,
+                      timestamp=1705314600):
+    """Build a media item as listed by the iPhone API, e.g. in a saved collection"""
+    return {
+        'pk': str(abs(hash(shortcode)) % 10 ** 12),
+        'code': shortcode,
+        'media_type': 1,
+        'taken_at': timestamp,
+        'caption': {'text': caption} if caption else None,
+        'has_liked': False,
+        'like_count': likes,
+        'comment_count': comments,
+        'user': {'pk': '42', 'username': owner, 'is_private': False, 'full_name': owner.title(),
+                 'profile_pic_url': 'https://cdn.example.com/pic.jpg'},
+        'image_versions2': {'candidates': [{'url': f'https://cdn.example.com/{shortcode}.jpg'}]},
+        'location': location and {'pk': int(location['id']), 'name': location['name'],
+                                  'lat': location['lat'], 'lng': location['lng']},
+    }
+
+
+def make_location(location_id, name, lat, lng):
+    return {'id': str(location_id), 'name': name, 'slug': name.lower().replace(' ', '-'),
+            'has_public_page': True, 'lat': lat, 'lng': lng}
+
+
+class ExplodingPost(instaloader.Post):
+    """Post whose lazy properties must not be touched (they would cost a request)"""
+
+    @property
+    def location(self):
+        raise AssertionError(f'location of {self.shortcode} resolved although it was cached')
+
+
+class CountingPost(instaloader.Post):
+    """Post counting the reads of the lazy properties behind the optional record fields"""
+
+    reads = {}
+    lock = threading.Lock()
+
+    def _count(self, name):
+        with CountingPost.lock:
+            CountingPost.reads[name] = CountingPost.reads.get(name, 0) + 1
+        return getattr(super(), name)
+
+    date_local = property(lambda self: self._count('date_local'))
+    caption = property(lambda self: self._count('caption'))
+    owner_username = property(lambda self: self._count('owner_username'))
+    likes = property(lambda self: self._count('likes'))
+    comments = property(lambda self: self._count('comments'))
+    is_video = property(lambda self: self._count('is_video'))
+    video_url = property(lambda self: self._count('video_url'))
+
+
+class PagedNodeIterator(instaloader.NodeIterator):
+    """NodeIterator serving saved-post pages from memory instead of GraphQL queries"""
+
+    def __init__(self, context, nodes, post_class=instaloader.Post, fail_at_page=None, fail_times=None):
+        page_length = instaloader.NodeIterator.page_length()
+        self._pages = [nodes[i:i + page_length] for i in range(0, len(nodes), page_length)] or [[]]
+        self.fail_at_page = fail_at_page
+        self.fail_times = fail_times
+        self.queries = 0
+        self.queried = threading.Condition()
+        super().__init__(context, 'saved_posts_test', lambda d: d, lambda n: post_class(context, n), {'id': 42})
+
+    def _query(self, after=None):
+        index = int(after) if after else 0
+        with self.queried:
+            self.queries += 1
+            self.queried.notify_all()
+        if index == self.fail_at_page and self.fail_times != 0:
+            if self.fail_times is not None:
+                self.fail_times -= 1
+            raise instaloader.exceptions.ConnectionException('401 Unauthorized')
+        self._best_before = datetime.now() + instaloader.NodeIterator._shelf_life
+        return {'edges': [{'node': dict(node)} for node in self._pages[index]],
+                'page_info': {'has_next_page': index + 1 < len(self._pages), 'end_cursor': str(index + 1)}}
+
+    def wait_for_queries(self, count, timeout=10):
+        """Wait until ``count`` pages have been queried (by a background thread)"""
+        with self.queried:
+            assert self.queried.wait_for(lambda: self.queries >= count, timeout), f'{self.queries} queries'
+
+
+def make_test_scheduler(**kwargs):
+    """RequestScheduler on a simulated clock, where sleeping advances time instantly"""
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    return RequestScheduler(sleep=sleep, clock=lambda: clock[0], **kwargs)
+
+
+def make_offline_extractor(nodes, post_class=instaloader.Post, fail_at_page=None, fail_times=None, **kwargs):
+    """Create an extractor whose saved posts are served from the given nodes without network access
+
+    Rate-limit backoff runs on a simulated clock, with few retries.
+    """
+    kwargs.setdefault('scheduler', make_test_scheduler(max_retries=2))
+    extractor = InstagramLocationExtractor(**kwargs)
+    context = extractor.loader.context
+    context.username = 'tester'
+    context.iphone_support = False
+    context.sleep = False
+    extractor._get_saved_posts = lambda: PagedNodeIterator(context, nodes, post_class, fail_at_page, fail_times)
+    by_shortcode = {node['shortcode']: node for node in nodes}
+    extractor._get_post = lambda shortcode: post_class(context, by_shortcode[shortcode])
+    return extractor
+
+
+class FakeInstagram:
+    """Serves a saved-posts account through the context methods a recorder wraps, counting requests
+
+    ``collections`` maps collection names to the media items (make_iphone_media()) saved in them.
+    """
+
+    def __init__(self, nodes, locations, collections=None):
+        self.nodes = nodes
+        self.locations = {str(location['id']): location for location in locations}
+        self.collections = collections or {}
+        self.requests = 0
+
+    def install(self, context):
+        context.get_json = self.get_json
+        context.get_page_data = self.get_page_data
+        context.login = lambda user, passwd: setattr(context, 'username', user) or setattr(context, 'user_id', '42')
+
+    def get_page_data(self, path):
+        self.requests += 1
+        return [{'xig_user_by_username': {'pk': '42', 'username': path.strip('/'), 'full_name': 'Tester'}}]
+
+    def get_json(self, path, params, host='www.instagram.com', session=None, _attempt=1, response_headers=None,
+                 use_post=False):
+        self.requests += 1
+        if path.startswith('explore/locations/'):
+            location_id = path.split('/')[2]
+            if location_id not in self.locations:
+                raise instaloader.exceptions.QueryReturnedNotFoundException(f'location {location_id} not found')
+            return {'native_location_data': {'location_info': self.locations[location_id]}}
+        if host == 'i.instagram.com':
+            return self.get_iphone_api(path, params)
+        variables = json.loads(params['variables'])
+        start = int(variables.get('after') or 0)
+        end = start + variables['first']
+        return {'status': 'ok', 'data': {'user': {'edge_saved_media': {
+            'count': len(self.nodes),
+            'page_info': {'has_next_page': end < len(self.nodes), 'end_cursor': str(end)},
+            'edges': [{'node': node} for node in self.nodes[start:end]],
+        }}}}
+
+    def get_iphone_api(self, path, params, page_length=5):
+        start = int(params.get('max_id') or 0)
+        if path == 'api/v1/collections/list/':
+            items = [{'collection_id': 'ALL', 'collection_name': 'All posts',
+                      'collection_type': 'ALL_MEDIA_AUTO_COLLECTION'}]
+            items += [{'collection_id': str(100 + i), 'collection_name': name, 'collection_type': 'MEDIA',
+                       'collection_media_count': len(media)}
+                      for i, (name, media) in enumerate(self.collections.items())]
+            page_length = 2
+        elif path.startswith('api/v1/feed/collection/'):
+            index = int(path.split('/')[4]) - 100
+            if not 0 <= index < len(self.collections):
+                raise instaloader.exceptions.QueryReturnedNotFoundException(f'collection {path} not found')
+            items = [{'media': media} for media in list(self.collections.values())[index]]
+        else:
+            raise instaloader.exceptions.QueryReturnedNotFoundException(f'{path} not found')
+        end = start + page_length
+        return {'items': items[start:end], 'more_available': end < len(items), 'next_max_id': str(end),
+                'status': 'ok'}
+
+
+class FakeCdn:
+    """requests.Session stand-in serving media by URL, tracking the requests in flight per host"""
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.chunk_sizes = set()
+        self.lock = threading.Lock()
+
+    def get(self, url, stream=False, timeout=None):
+        assert stream, 'media must be streamed'
+        host = url.split('/')[2]
+        with self.lock:
+            self.requests.append(url)
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.max_in_flight[host] = max(self.max_in_flight.get(host, 0), self.in_flight[host])
+        cdn = self
+
+        class Response:
+            status_code = 200 if url in cdn.files else 404
+            headers = {'Content-Type': 'video/mp4' if url.endswith('.mp4') else 'image/jpeg'}
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                with cdn.lock:
+                    cdn.in_flight[host] -= 1
+
+            def raise_for_status(self):
+                if self.status_code != 200:
+                    raise requests.HTTPError(f'404 Not Found: {url}')
+
+            def iter_content(self, chunk_size):
+                cdn.chunk_sizes.add(chunk_size)
+                time.sleep(0.01)
+                data = cdn.files[url]
+                for start in range(0, len(data), chunk_size):
+                    yield data[start:start + chunk_size]
+
+        return Response()
+
+
 def test_csv_export():
     """Test the CSV export functionality with mock data"""
     print("=" * 60)
@@ -143,24 +401,1554 @@ def test_class_initialization():
         return False
 
 
+def test_post_cache():
+    """Test that re-runs are served from the SQLite post cache"""
+    print("\n🔄 Testing persistent post cache...")
+    nodes = [
+        make_post_node('CACHE001', make_location(1, 'Golden Gate Bridge', 37.8199, -122.4783),
+                       caption='Foggy morning #sf @friend https://example.com/sf'),
+        make_post_node('CACHE002'),
+        make_post_node('CACHE003', make_location(2, 'Times Square', 40.7580, -73.9855), likes=99),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+
+        first = make_offline_extractor(nodes, cache_path=cache_path).extract_locations_from_saved()
+        assert [loc.name for loc in first] == ['Golden Gate Bridge', 'Times Square']
+        assert first[0].hashtags == '#sf'
+        assert first[0].caption_urls == 'https://example.com/sf'
+
+        # Second run: every post is cached, so no location may be resolved again
+        second = make_offline_extractor(nodes, post_class=ExplodingPost,
+                                        cache_path=cache_path).extract_locations_from_saved()
+        assert second == first
+
+        cache = PostCache(cache_path)
+        assert cache.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert len(cache) == 3
+        assert cache.get('CACHE002') == (None, False)
+        assert cache.get('MISSING') is None
+        cache.close()
+
+        # Expired TTL: volatile fields are re-read from the post, the rest stays cached
+        nodes[2]['edge_media_preview_like'] = {'count': 150}
+        third = make_offline_extractor(nodes, post_class=ExplodingPost, cache_path=cache_path,
+                                       volatile_ttl=-1).extract_locations_from_saved()
+        assert third[1].likes == 150
+        assert third[1].name == 'Times Square'
+
+    print("✅ Post cache serves repeated runs without re-resolving posts")
+    return True
+
+
+def test_incremental_sync():
+    """Test that incremental mode stops at the previous run's watermark and merges old rows"""
+    print("\n🔄 Testing incremental sync...")
+    old_nodes = [make_post_node(f'OLD{i:03d}', make_location(i, f'Old Place {i}', 10.0 + i, 20.0 + i) if i % 2 else None)
+                 for i in range(30)]
+    new_nodes = [make_post_node('NEW001', make_location(100, 'New Place', 1.0, 2.0)), make_post_node('NEW002')]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+
+        full = make_offline_extractor(old_nodes, cache_path=cache_path).extract_locations_from_saved(incremental=True)
+        assert len(full) == 15
+
+        extractor = make_offline_extractor(new_nodes + old_nodes, cache_path=cache_path)
+        posts = extractor._get_saved_posts()
+        extractor._get_saved_posts = lambda: posts
+        batches = []
+        enrich_page = extractor._enrich_page
+        extractor._enrich_page = lambda function, items, executor: batches.append(len(items)) or enrich_page(
+            function, items, executor)
+        merged = extractor.extract_locations_from_saved(incremental=True)
+
+        # The watermark is on the first page, so no further page is requested
+        assert posts.queries == 1
+        assert merged[0].name == 'New Place'
+        assert [loc.name for loc in merged[1:]] == [loc.name for loc in full]
+        # Previous rows are merged a page at a time
+        assert max(batches) <= instaloader.NodeIterator.page_length() < sum(batches)
+
+        cache = PostCache(cache_path)
+        assert cache.get_state('saved_shortcodes')[:3] == ['NEW001', 'NEW002', 'OLD000']
+        cache.close()
+
+        # Without new saves, the export still holds the earlier locations
+        for argv in (['--incremental'], ['--incremental', '--dedupe']):
+            extractor = make_offline_extractor(new_nodes + old_nodes, cache_path=cache_path)
+            basename = os.path.join(tmpdir, 'again')
+            assert extract_and_export(extractor, parse_args(argv), basename) == [basename + '.csv']
+            assert extractor.stats['locations'] == 0
+            assert len(list(read_export(basename + '.csv'))) == 16
+
+    print("✅ Incremental sync stops at the watermark and merges previous rows")
+    return True
+
+
+def test_resume_from_checkpoint():
+    """Test that an interrupted extraction resumes after the last completed page"""
+    print("\n🔄 Testing checkpointed resume...")
+    nodes = [make_post_node(f'PAGE{i:03d}', make_location(i, f'Place {i}', 30.0 + i / 100, -90.0) if i % 3 else None)
+             for i in range(30)]
+    expected = make_offline_extractor(nodes).extract_locations_from_saved()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, 'resume.json')
+
+        # Fetching the third page fails, after two pages (24 posts) have been completed
+        partial = make_offline_extractor(nodes, fail_at_page=2).extract_locations_from_saved(
+            checkpoint_path=checkpoint_path)
+        assert len(partial) == 16
+        assert os.path.isfile(checkpoint_path)
+
+        extractor = make_offline_extractor(nodes)
+        extracted = []
+        extract_post = extractor._extract_post
+        extractor._extract_post = lambda post: extracted.append(post.shortcode) or extract_post(post)
+        resumed = extractor.extract_locations_from_saved(checkpoint_path=checkpoint_path, resume=True)
+
+        assert extracted == [f'PAGE{i:03d}' for i in range(24, 30)]
+        assert resumed == expected
+        assert not os.path.exists(checkpoint_path)
+        assert not os.path.exists(checkpoint_path + '.rows')
+
+        # Without the rows of the completed pages, the crawl starts over rather than skip them
+        make_offline_extractor(nodes, fail_at_page=2).extract_locations_from_saved(checkpoint_path=checkpoint_path)
+        os.remove(checkpoint_path + '.rows')
+        assert make_offline_extractor(nodes).extract_locations_from_saved(
+            checkpoint_path=checkpoint_path, resume=True) == expected
+
+        # Interrupting with Ctrl+C keeps the progress, and says how to resume
+        extractor = make_offline_extractor(nodes)
+        extract_post = extractor._extract_post
+
+        def interrupted(post):
+            if post.shortcode == 'PAGE025':
+                raise KeyboardInterrupt
+            return extract_post(post)
+
+        extractor._extract_post = interrupted
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                list(extractor.iter_locations(checkpoint_path=checkpoint_path))
+            assert False, 'the interruption should propagate'
+        except KeyboardInterrupt:
+            pass
+        assert 're-run with --resume' in output.getvalue()
+        assert make_offline_extractor(nodes).extract_locations_from_saved(
+            checkpoint_path=checkpoint_path, resume=True) == expected
+
+    print("✅ Resumed extraction only processed the remaining page")
+    return True
+
+
+def test_location_cache():
+    """Test that posts sharing an Instagram location ID fetch its metadata only once"""
+    print("\n🔄 Testing location cache...")
+    places = {'7': ('Blue Bottle Coffee', 37.776, -122.423), '8': ('Dolores Park', 37.759, -122.427)}
+    fetched = []
+
+    def fake_get_json(path, params, **kwargs):
+        location_id = path.split('/')[2]
+        fetched.append(location_id)
+        name, lat, lng = places[location_id]
+        return {'native_location_data': {'location_info': {
+            'name': name, 'slug': name.lower(), 'has_public_page': True, 'lat': lat, 'lng': lng}}}
+
+    def stub(location_id):
+        # Saved-post page nodes only carry the location ID, lat/lng need an extra request
+        return {'id': location_id, 'name': places[location_id][0]}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+
+        nodes = [make_post_node(f'LOC{i:03d}', stub('7' if i % 4 else '8')) for i in range(8)]
+        extractor = make_offline_extractor(nodes, cache_path=cache_path)
+        extractor.loader.context.get_json = fake_get_json
+        first = extractor.extract_locations_from_saved()
+        assert sorted(fetched) == ['7', '8']
+        assert extractor.location_cache_hits == 6
+        assert first[1].latitude == 37.776
+
+        # A later run with new posts at known locations needs no location requests at all
+        fetched.clear()
+        nodes = [make_post_node(f'LOCNEW{i:03d}', stub('7')) for i in range(3)]
+        extractor = make_offline_extractor(nodes, cache_path=cache_path)
+        extractor.loader.context.get_json = fake_get_json
+        second = extractor.extract_locations_from_saved()
+        assert fetched == []
+        assert [loc.longitude for loc in second] == [-122.423] * 3
+
+        # Posts whose page node lacks the location need their metadata, but not the location page
+        metadata_requests = []
+
+        class MetadataPost(instaloader.Post):
+            @property
+            def _full_metadata(self):
+                metadata_requests.append(self.shortcode)
+                return {'location': stub('7')}
+
+        nodes = [make_post_node(f'LOCMETA{i:03d}') for i in range(3)]
+        for node in nodes:
+            del node['location']
+        extractor = make_offline_extractor(nodes, post_class=MetadataPost, cache_path=cache_path)
+        extractor.loader.context.get_json = fake_get_json
+        third = extractor.extract_locations_from_saved()
+        assert fetched == [] and extractor.location_cache_hits == 3
+        assert sorted(set(metadata_requests)) == [f'LOCMETA{i:03d}' for i in range(3)]
+        assert [loc.latitude for loc in third] == [37.776] * 3
+
+    print("✅ Location metadata is fetched once per location ID")
+    return True
+
+
+def test_request_scheduler():
+    """Test token-bucket pacing, AIMD adaptation and in-process backoff on rate limiting"""
+    print("\n🔄 Testing request scheduler...")
+    clock = [0.0]
+    slept = []
+
+    def fake_sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+
+    scheduler = RequestScheduler(budgets={'graphql': 1.0}, burst=2, base_backoff=10, sleep=fake_sleep,
+                                 clock=lambda: clock[0])
+
+    # The burst is free, afterwards requests are paced at the budget
+    for _ in range(4):
+        scheduler.acquire('graphql')
+    assert slept == [1.0, 1.0]
+
+    # A rate-limit response halves the rate and pauses for a jittered 5-10s
+    pause = scheduler.backoff()
+    assert 5 <= pause <= 10
+    assert scheduler.rates['graphql'] == 0.5
+    assert scheduler.backoff() > 10
+    scheduler.record_success()
+
+    # Additive increase back up to, but never beyond, the budget
+    for _ in range(30):
+        scheduler.acquire('graphql')
+    assert scheduler.rates['graphql'] == 1.0
+
+    stats = scheduler.stats()
+    assert stats['rate_limited'] == 2
+    assert stats['requests']['graphql'] == 34
+    assert stats['total_wait_seconds'] == sum(slept)
+    assert stats['rates_per_minute']['graphql'] == 60.0
+
+    # A page fetch failing with 401 twice is retried in-process without losing progress
+    nodes = [make_post_node(f'RATE{i:03d}', make_location(i, f'Spot {i}', 1.0, 2.0)) for i in range(30)]
+    scheduler = make_test_scheduler()
+    locations = make_offline_extractor(nodes, fail_at_page=1, fail_times=2,
+                                       scheduler=scheduler).extract_locations_from_saved()
+    assert len(locations) == 30
+    assert scheduler.rate_limit_count == 2
+
+    print("✅ Scheduler paces requests and backs off on rate limiting")
+    return True
+
+
+def test_concurrent_enrichment():
+    """Test that lazy properties of a page are resolved on a worker pool, keeping post order"""
+    print("\n🔄 Testing concurrent enrichment...")
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+
+    def slow_get_json(path, params, **kwargs):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        location_id = int(path.split('/')[2])
+        return {'native_location_data': {'location_info': {
+            'name': f'Venue {location_id}', 'slug': f'venue-{location_id}', 'has_public_page': True,
+            'lat': float(location_id), 'lng': 0.0}}}
+
+    nodes = [make_post_node(f'POOL{i:03d}', {'id': str(i)}) for i in range(24)]
+    extractor = make_offline_extractor(nodes, workers=6)
+    extractor.loader.context.get_json = slow_get_json
+    locations = extractor.extract_locations_from_saved()
+
+    assert [loc.name for loc in locations] == [f'Venue {i}' for i in range(24)]
+    assert 1 < max_in_flight[0] <= 6
+
+    print(f"✅ Enriched pages with up to {max_in_flight[0]} concurrent requests")
+    return True
+
+
+def test_streaming_export():
+    """Test that locations are streamed page by page and partial CSV output survives an error"""
+    print("\n🔄 Testing streaming extraction and export...")
+    nodes = [make_post_node(f'STREAM{i:03d}', make_location(i, f'Stop {i}', 48.0, 2.0 + i / 100)) for i in range(36)]
+    extractor = make_offline_extractor(nodes, prefetch=0)
+    posts = extractor._get_saved_posts()
+    extractor._get_saved_posts = lambda: posts
+
+    # Without prefetching, the first location is available before the second page has been requested
+    locations = extractor.iter_locations()
+    assert next(locations).name == 'Stop 0'
+    assert posts.queries == 1
+    assert len(list(locations)) == 35
+    assert extractor.stats == {'posts': 36, 'locations': 36, 'cached': 0}
+
+    # The third page fails for good: the rows of the first two pages are in the CSV
+    extractor = make_offline_extractor(nodes, fail_at_page=2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'partial.csv')
+        assert extractor.export_to_csv(extractor.iter_locations(), filename=filename) is None
+        with open(filename, 'r', encoding='utf-8') as f:
+            assert len(f.readlines()) == 1 + 24
+
+    print("✅ Rows are streamed to the CSV as they are extracted")
+    return True
+
+
+def test_page_prefetch():
+    """Test that pages are fetched ahead in the background, at most `prefetch` pages ahead"""
+    print("\n🔄 Testing page prefetching...")
+    nodes = [make_post_node(f'PRE{i:03d}', make_location(i, f'Spot {i}', 10.0, 20.0 + i / 100)) for i in range(96)]
+
+    for prefetch in (1, 2):
+        extractor = make_offline_extractor(nodes, prefetch=prefetch)
+        posts = extractor._get_saved_posts()
+        extractor._get_saved_posts = lambda: posts
+        locations = extractor.iter_locations()
+        assert next(locations).name == 'Spot 0'
+        # The page being extracted, `prefetch` pages in the queue, and one waiting for room in it:
+        # no more, as the extraction is suspended
+        posts.wait_for_queries(1 + prefetch + 1)
+        assert posts.queries == 1 + prefetch + 1
+        assert len(list(locations)) == 95
+        assert posts.queries == 8
+        # Stopping early stops the background thread as well
+        extractor = make_offline_extractor(nodes, prefetch=prefetch)
+        locations = extractor.iter_locations()
+        next(locations)
+        locations.close()
+        assert not [thread for thread in threading.enumerate() if thread.name == 'saved-posts-prefetch']
+
+    # Fetching overlaps with extraction: the second page is fetched while the first post is being
+    # extracted, which waits for it. Without prefetching, it is only fetched after the first page.
+    overlapped = {}
+    for prefetch in (0, 2):
+        extractor = make_offline_extractor(nodes, workers=1, prefetch=prefetch)
+        posts = extractor._get_saved_posts()
+        extractor._get_saved_posts = lambda: posts
+        extract_post = extractor._extract_post
+
+        def extract(post, prefetch=prefetch, posts=posts, extract_post=extract_post):
+            if post.shortcode == 'PRE000':
+                if prefetch:
+                    posts.wait_for_queries(2)
+                overlapped[prefetch] = posts.queries >= 2
+            return extract_post(post)
+
+        extractor._extract_post = extract
+        assert len(list(extractor.iter_locations())) == 96
+    assert overlapped == {0: False, 2: True}
+
+    print("✅ Pages prefetched in the background while posts are extracted")
+    return True
+
+
+def test_async_extraction():
+    """Test that aiter_locations() extracts like iter_locations() without blocking the event loop"""
+    print("\n🔄 Testing asyncio extraction...")
+    locations = [make_location(i, f'Cafe {i}', 52.0 + i / 10, 13.0) for i in range(12)]
+    # Location stubs without coordinates: every post needs a location request
+    nodes = [make_post_node(f'ASY{i:03d}', {'id': str(i % 12), 'name': f'Cafe {i % 12}'}, caption=f'#cafe{i}')
+             for i in range(30)]
+    in_flight = [0, 0]  # current, maximum
+    counter_lock = threading.Lock()
+
+    def make_extractor(scheduler=None):
+        extractor = InstagramLocationExtractor(scheduler=scheduler or make_test_scheduler(), workers=4)
+        extractor.loader.context.sleep = False
+        # Post.location fills the location stub of its node in, so every run gets fresh nodes
+        instagram = FakeInstagram(json.loads(json.dumps(nodes)), locations)
+        instagram.install(extractor.loader.context)
+        get_json = instagram.get_json
+
+        def slow_get_json(path, params, **kwargs):
+            # As instaloader's rate controller would
+            extractor.scheduler.acquire('other' if path.startswith('explore/') else 'graphql')
+            with counter_lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            try:
+                time.sleep(0.02)
+                return get_json(path, params, **kwargs)
+            finally:
+                with counter_lock:
+                    in_flight[0] -= 1
+
+        extractor.loader.context.get_json = slow_get_json
+        assert extractor.login('tester', 'secret')
+        return extractor
+
+    expected = list(make_extractor().iter_locations())
+    assert len(expected) == 30
+
+    async def collect(extractor, **kwargs):
+        return [record async for record in extractor.aiter_locations(**kwargs)]
+
+    async def run_with_ticker(coroutine):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        try:
+            return await coroutine, ticks
+        finally:
+            task.cancel()
+
+    # Same records and statistics, while the event loop keeps running
+    extractor = make_extractor()
+    in_flight[1] = 0
+    records, ticks = asyncio.run(run_with_ticker(collect(extractor)))
+    assert records == expected
+    assert extractor.stats == {'posts': 30, 'locations': 30, 'cached': 0}
+    assert ticks > 10
+    # The posts resolved concurrently, and the page being prefetched
+    assert 1 < in_flight[1] <= 4 + 1
+
+    # Two extractors embedded in one service share a semaphore and a rate budget
+    scheduler = make_test_scheduler()
+    extractors = [make_extractor(scheduler), make_extractor(scheduler)]
+    in_flight[1] = 0
+
+    async def both():
+        semaphore = asyncio.Semaphore(3)
+        return await asyncio.gather(*(collect(extractor, semaphore=semaphore) for extractor in extractors))
+
+    assert asyncio.run(both()) == [expected, expected]
+    assert in_flight[1] <= 3 + 2
+    # Three pages and twelve locations each
+    assert scheduler.stats()['requests'] == {'graphql': 2 * 3, 'iphone': 0, 'other': 2 * 12}
+
+    # Errors reach the consumer, as in iter_locations()
+    extractor = make_offline_extractor(nodes[:5], fail_at_page=0)
+    try:
+        asyncio.run(collect(extractor))
+        assert False, 'the failing page should raise'
+    except instaloader.exceptions.ConnectionException:
+        pass
+
+    print("✅ Async extraction matches the sync API and leaves the event loop free")
+    return True
+
+
+def test_location_record():
+    """Test the compact record type and its dict conversion at the edges"""
+    print("\n🔄 Testing LocationRecord...")
+    data = {
+        'name': 'Grand Canyon National Park', 'latitude': 36.1069, 'longitude': -112.1129,
+        'post_url': 'https://www.instagram.com/p/REC001/', 'date': '2024-03-10 07:15:00',
+        'caption': 'Sunrise ' * 40, 'caption_urls': '', 'hashtags': '#grandcanyon', 'mentions': '',
+        'owner_username': 'desert_wanderer', 'likes': 892, 'comments': 67, 'is_video': True,
+        'video_url': 'https://cdn.example.com/REC001.mp4', 'display_url': 'https://cdn.example.com/REC001.jpg',
+        'image_file': 'media/3f/3fa2.jpg', 'video_file': '', 'collection': 'Road Trip', 'cluster_size': 3
+    }
+    record = LocationRecord.from_dict(data)
+    assert record.shortcode == 'REC001'
+    assert record.to_dict() == data
+    assert not hasattr(record, '__dict__')
+    assert sys.getsizeof(record) < sys.getsizeof(data) / 2
+
+    # Repeated strings are shared between records
+    other = LocationRecord.from_dict({**data, 'post_url': 'https://www.instagram.com/p/REC002/'})
+    assert other.name is record.name and other.owner_username is record.owner_username
+
+    row = record.csv_row()
+    assert len(row[3]) == 200 and row[6] == data['caption']
+    assert row[13] == 'Yes' and row[-1] == 3
+
+    print("✅ LocationRecord round-trips and stays compact")
+    return True
+
+
+def test_caption_analysis():
+    """Test the single-pass caption tokenizer against instaloader's per-property regexes"""
+    print("\n🔄 Testing caption analysis...")
+    captions = [
+        'Icon of freedom 🗽 Read more: https://nps.gov/stli https://example.com/liberty-facts #NYC #history',
+        'Brunch with @Best.Friend and @foodie_99 ☕️🥐 #Sundays #café',
+        'mail me: someone@example.com, not a mention. @a..b @trailing. #123',
+        '',
+    ]
+    for caption in captions:
+        analysis = analyze_caption(caption)
+        post = instaloader.Post(None, {'shortcode': 'CAPTION', 'caption': caption})
+        assert analysis.hashtags == post.caption_hashtags
+        assert analysis.mentions == post.caption_mentions
+        assert analysis.urls == InstagramLocationExtractor.extract_urls_from_text(caption)
+
+    first = analyze_caption(captions[0])
+    assert first.urls == ['https://nps.gov/stli', 'https://example.com/liberty-facts']
+    assert first.hashtags == ['nyc', 'history']
+    assert first.emoji_count == 1
+    assert analyze_caption(captions[1]).emoji_count == 2
+    assert analyze_caption(None) == ([], [], [], 0)
+    assert [a.hashtags for a in analyze_captions(captions)] == [['nyc', 'history'], ['sundays', 'café'], ['123'], []]
+
+    print("✅ Caption tokenizer matches instaloader's hashtags and mentions")
+    return True
+
+
+def test_multi_format_export():
+    """Test that one pass over the locations writes valid CSV, GeoJSON, KML and NDJSON"""
+    print("\n🔄 Testing multi-format export...")
+    nodes = [make_post_node(f'MULTI{i:03d}', make_location(i, f'Café <{i}> & Co', 40.0 + i, -3.5),
+                            caption=f'Stop #{i} @friend') for i in range(20)]
+    nodes.append(make_post_node('MULTINOLOC', make_location(99, 'Somewhere', None, None)))
+    extractor = make_offline_extractor(nodes)
+    posts = extractor._get_saved_posts()
+    extractor._get_saved_posts = lambda: posts
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        basename = os.path.join(tmpdir, 'export')
+        outputs = extractor.export_to_formats(extractor.iter_locations(), ['csv', 'geojson', 'kml', 'ndjson'],
+                                              basename=basename)
+        assert outputs == {f: f'{basename}.{f}' for f in ('csv', 'geojson', 'kml', 'ndjson')}
+        # A single crawl fed all four files
+        assert posts.queries == 2
+
+        with open(outputs['csv'], newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 21 and rows[3]['Name'] == 'Café <3> & Co'
+
+        with open(outputs['geojson'], encoding='utf-8') as f:
+            collection = json.load(f)
+        assert len(collection['features']) == 21
+        assert collection['features'][1]['geometry']['coordinates'] == [-3.5, 41.0]
+        assert collection['features'][-1]['geometry'] is None
+
+        kml = ET.parse(outputs['kml']).getroot()
+        placemarks = kml.findall('.//{http://www.opengis.net/kml/2.2}Placemark')
+        assert len(placemarks) == 21
+        assert placemarks[2].find('{http://www.opengis.net/kml/2.2}name').text == 'Café <2> & Co'
+
+        with open(outputs['ndjson'], encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f]
+        assert [line['name'] for line in lines] == [row['Name'] for row in rows]
+
+        # An error mid-stream still leaves well-formed files with the locations written so far
+        def failing_locations():
+            yield LocationRecord.from_dict(lines[0])
+            raise RuntimeError('connection lost')
+        partial = {'geojson': f'{basename}_partial.geojson', 'kml': f'{basename}_partial.kml'}
+        try:
+            export_records(failing_locations(), partial)
+            assert False, 'the error should propagate'
+        except RuntimeError:
+            pass
+        with open(partial['geojson'], encoding='utf-8') as f:
+            assert len(json.load(f)['features']) == 1
+        assert len(ET.parse(partial['kml']).getroot().findall('.//{http://www.opengis.net/kml/2.2}Placemark')) == 1
+
+    print("✅ CSV, GeoJSON, KML and NDJSON written in one pass")
+    return True
+
+
+def test_spatial_index():
+    """Test bbox, radius and nearest-neighbour queries against a linear scan"""
+    print("\n🔄 Testing spatial index...")
+    rng = random.Random(7)
+    records = [LocationRecord(f'GEO{i:04d}', f'Place {i}', rng.gauss(48.85, 0.2), rng.gauss(2.35, 0.2),
+                              '2024-01-15 10:30:00') for i in range(1500)]
+    records += [LocationRecord(f'GEO{i:04d}', f'Place {i}', rng.uniform(-80, 80), rng.uniform(-180, 180),
+                               '2024-01-15 10:30:00') for i in range(1500, 2000)]
+    records.append(LocationRecord('GEONONE', 'Nowhere', None, None, '2024-01-15 10:30:00'))
+    index = SpatialIndex(records)
+    assert len(index) == 2000
+
+    def scan(lat, lng):
+        return sorted((haversine_km(lat, lng, r.latitude, r.longitude), r.shortcode) for r in records[:2000])
+
+    for lat, lng in [(48.86, 2.34), (0.0, 179.99), (-45.0, -179.95), (79.0, 10.0)]:
+        for radius_km in (2, 500):
+            expected = [sc for distance, sc in scan(lat, lng) if distance <= radius_km]
+            assert [r.shortcode for _, r in index.within_radius(lat, lng, radius_km)] == expected
+        for k in (1, 10):
+            assert [r.shortcode for _, r in index.nearest(lat, lng, k)] == [sc for _, sc in scan(lat, lng)[:k]]
+
+    for box in [(48.8, 2.3, 48.9, 2.4), (-30, 170, 30, -170), (-90, -180, 90, 180)]:
+        min_lat, min_lng, max_lat, max_lng = box
+        expected = {r.shortcode for r in records[:2000] if min_lat <= r.latitude <= max_lat and
+                    (min_lng <= r.longitude <= max_lng if min_lng <= max_lng
+                     else (r.longitude >= min_lng or r.longitude <= max_lng))}
+        assert {r.shortcode for r in index.bbox(*box)} == expected
+
+    # Dense neighbourhoods, and coarse grids whose rings wrap around the globe
+    dense = [LocationRecord(f'DENSE{i:04d}', f'Spot {i}', rng.gauss(48.86, 0.002), rng.gauss(2.34, 0.002),
+                            '2024-01-15 10:30:00') for i in range(2000)]
+    for others, cell_size in ((dense, SpatialIndex.DEFAULT_CELL_SIZE), (records[1500:2000], 60.0)):
+        coarse = SpatialIndex(others, cell_size=cell_size)
+        for lat, lng in [(48.86, 2.34), (48.861, 2.338), (0.0, 179.99), (-70.0, -100.0)]:
+            expected = sorted((haversine_km(lat, lng, r.latitude, r.longitude), r.shortcode) for r in others)
+            for k in (1, 10):
+                assert [r.shortcode for _, r in coarse.nearest(lat, lng, k)] == [sc for _, sc in expected[:k]]
+
+    # Points far apart in longitude are only found together on the coarsest levels, whose
+    # neighbouring columns wrap onto the same cells
+    far_apart = SpatialIndex([LocationRecord('WEST', 'West', 0.0, 10.0, '2024-01-15 10:30:00'),
+                              LocationRecord('EAST', 'East', 0.0, 170.0, '2024-01-15 10:30:00')])
+    assert [r.shortcode for _, r in far_apart.nearest(0.0, 0.0, k=2)] == ['WEST', 'EAST']
+    assert [r.shortcode for _, r in far_apart.nearest(0.0, 0.0, k=3)] == ['WEST', 'EAST']
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Built from the post cache and from an export; persisted and loaded again
+        cache = PostCache(os.path.join(tmpdir, 'cache.sqlite3'))
+        for record in records[:100]:
+            cache.put(record.shortcode, record)
+        cache.put('NOLOCATION', None)
+        assert len(SpatialIndex.from_cache(cache)) == 100
+        cache.close()
+
+        export_records(records, {'csv': os.path.join(tmpdir, 'export.csv')})
+        from_csv = SpatialIndex.from_export(os.path.join(tmpdir, 'export.csv'))
+        assert [r.shortcode for _, r in from_csv.nearest(48.86, 2.34, 5)] == \
+            [r.shortcode for _, r in index.nearest(48.86, 2.34, 5)]
+
+        index.save(os.path.join(tmpdir, 'index.json'))
+        loaded = SpatialIndex.load(os.path.join(tmpdir, 'index.json'))
+        assert loaded.records == index.records
+        assert loaded.bbox(48.8, 2.3, 48.9, 2.4) == index.bbox(48.8, 2.3, 48.9, 2.4)
+
+    print("✅ Spatial index queries match a linear scan")
+    return True
+
+
+def test_location_clustering():
+    """Test that near-duplicate places are merged and distinct neighbours are kept apart"""
+    print("\n🔄 Testing location clustering...")
+    date = '2024-01-15 10:30:00'
+    records = [
+        LocationRecord('DUP1', 'Eiffel Tower', 48.8584, 2.2945, date),
+        LocationRecord('DUP2', 'Café de Flore', 48.8541, 2.3326, date),
+        LocationRecord('DUP3', 'Eiffel Tower', 48.8584, 2.2945, date),
+        LocationRecord('DUP4', 'Tour Eiffel', 48.8583, 2.2950, date),          # reordered words, 40 m away
+        LocationRecord('DUP5', 'EIFFEL TOWER!', 48.8590, 2.2940, date),        # 80 m away
+        LocationRecord('DUP6', 'Eiffel Tower', 48.8650, 2.2945, date),         # 730 m away: too far
+        LocationRecord('DUP7', 'Cafe de Flore', 48.8542, 2.3327, date),
+        LocationRecord('DUP8', 'Les Deux Magots', 48.8540, 2.3330, date),     # next door, other name
+        LocationRecord('DUP9', 'Eiffel Tower', None, None, date),
+    ]
+    clusters = cluster_locations(records)
+    by_member = {member.shortcode: cluster for cluster in clusters for member in cluster.members}
+
+    assert [cluster.cluster_id for cluster in clusters] == list(range(len(clusters)))
+    assert sorted(m.shortcode for m in by_member['DUP1'].members) == ['DUP1', 'DUP3', 'DUP4', 'DUP5']
+    assert by_member['DUP1'].representative.name == 'Eiffel Tower'
+    assert by_member['DUP2'] is by_member['DUP7']
+    assert by_member['DUP8'] is not by_member['DUP2']
+    assert by_member['DUP6'] is not by_member['DUP1']
+    assert by_member['DUP9'].members == [records[8]]
+    assert len(clusters) == 5
+    assert sum(len(cluster.members) for cluster in clusters) == len(records)
+
+    # A larger distance threshold reaches the far pin; a strict name threshold splits reordered names
+    wide = {m.shortcode: c.cluster_id for c in cluster_locations(records, max_distance_m=1000) for m in c.members}
+    assert wide['DUP6'] == wide['DUP1']
+    strict = {m.shortcode: c.cluster_id for c in cluster_locations(records, min_name_similarity=1.0)
+              for m in c.members}
+    assert strict['DUP3'] == strict['DUP1'] == strict['DUP5'] and strict['DUP4'] != strict['DUP1']
+
+    # Deduplicated output keeps one pin per place, with the number of locations merged into it
+    places = dedupe_locations(records)
+    assert places == [cluster.representative for cluster in clusters]
+    assert [place.cluster_size for place in places] == [len(cluster.members) for cluster in clusters]
+    assert by_member['DUP1'].representative.cluster_size == 4
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'places.csv')
+        export_records(places, {'csv': filename})
+        with open(filename, newline='', encoding='utf-8') as f:
+            assert sorted(int(row['Cluster_Size']) for row in csv.DictReader(f)) == [1, 1, 1, 2, 4]
+        assert list(read_export(filename)) == places
+    assert parse_args(['--dedupe', '--columns', 'date']).fields[-1] == 'cluster_size'
+
+    print("✅ Near-duplicate places share a cluster and a representative")
+    return True
+
+
+def test_chunked_export():
+    """Test that chunked CSV export respects row and byte limits and writes a manifest"""
+    print("\n🔄 Testing chunked export...")
+    records = [LocationRecord(f'CHUNK{i:03d}', f'Place {i}', 10.0 + (i % 3) * 20, 5.0, f'202{i % 2}-03-01 12:00:00',
+                              caption='x' * (i % 7) * 50) for i in range(250)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        basename = os.path.join(tmpdir, 'layers')
+        manifest = export_csv_chunks(iter(records), basename, max_rows=100, max_bytes=20000)
+        with open(f'{basename}_manifest.json', encoding='utf-8') as f:
+            assert json.load(f) == manifest
+        assert manifest['total_rows'] == 250 and len(manifest['chunks']) > 3
+
+        exported = []
+        for chunk in manifest['chunks']:
+            path = os.path.join(tmpdir, chunk['file'])
+            assert chunk['rows'] <= 100 and os.path.getsize(path) == chunk['bytes'] <= 20000
+            with open(path, newline='', encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+            assert len(rows) == chunk['rows']
+            exported += [row['URL'] for row in rows]
+        assert exported == [record.post_url for record in records]
+
+        # Grouped by year: every file holds a single year
+        manifest = export_csv_chunks(records, os.path.join(tmpdir, 'years'), max_rows=100, group_by='year')
+        assert [(chunk['group'], chunk['part'], chunk['rows']) for chunk in manifest['chunks']] == \
+            [('2020', 1, 100), ('2021', 1, 100), ('2020', 2, 25), ('2021', 2, 25)]
+        assert manifest['chunks'][0]['file'] == 'years_2020_001.csv'
+
+        manifest = export_csv_chunks(records, os.path.join(tmpdir, 'regions'), group_by='region')
+        assert sorted(chunk['group'] for chunk in manifest['chunks']) == ['N10_E000', 'N30_E000', 'N50_E000']
+
+    print("✅ Chunks stay within the limits and are listed in the manifest")
+    return True
+
+
+def test_record_and_replay():
+    """Test that a recorded run replays offline with identical results"""
+    print("\n🔄 Testing record and replay...")
+    locations = [make_location(i, f'Spot {i}', 35.0 + i, 139.0) for i in range(6)]
+    # Location stubs without coordinates make the extractor fetch each location page
+    nodes = [make_post_node(f'REC{i:03d}', {'id': str(i % 6), 'name': f'Spot {i % 6}'}, caption=f'#trip{i}')
+             for i in range(30)]
+
+    def lookup_missing_location(context):
+        try:
+            context.get_json('explore/locations/77/', params={'__a': 1, '__d': 'dis'})
+            assert False, 'the location should not be found'
+        except instaloader.exceptions.QueryReturnedNotFoundException as e:
+            return str(e)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        recording = os.path.join(tmpdir, 'run.ndjson')
+        instagram = FakeInstagram(nodes, locations)
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler())
+        extractor.loader.context.sleep = False
+        instagram.install(extractor.loader.context)
+        recorder = ResponseRecorder(recording, mode='record')
+        recorder.install(extractor.loader.context)
+        assert extractor.login('tester', 'secret')
+        recorded = list(extractor.iter_locations())
+        assert lookup_missing_location(extractor.loader.context) == 'location 77 not found'
+        recorder.close()
+        assert len(recorded) == 30
+        assert instagram.requests == recorder.requests == 1 + 3 + 6 + 1
+
+        replayer = ResponseRecorder(recording)
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler(), recorder=replayer)
+        assert extractor.login('someone-else', '')
+        assert extractor.loader.context.username == 'tester'
+        started = time.monotonic()
+        assert list(extractor.iter_locations()) == recorded
+        assert time.monotonic() - started < 5
+        assert extractor.stats == {'posts': 30, 'locations': 30, 'cached': 0}
+        assert not any(extractor.scheduler.stats()['requests'].values())
+        # Errors are replayed as well
+        assert lookup_missing_location(extractor.loader.context) == 'location 77 not found'
+
+        # Requests that were never recorded fail instead of going online
+        try:
+            extractor.loader.context.get_json('explore/locations/99/', params={'__a': 1, '__d': 'dis'})
+            assert False, 'an unrecorded request should fail'
+        except ReplayMissError:
+            pass
+
+        # A request instaloader retries internally is recorded once, with its final response
+        flaky_recording = os.path.join(tmpdir, 'flaky.ndjson')
+        context = InstagramLocationExtractor(scheduler=make_test_scheduler()).loader.context
+        instagram.install(context)
+        fake_get_json = context.get_json
+
+        def retrying_get_json(path, params, host='www.instagram.com', session=None, _attempt=1,
+                              response_headers=None, use_post=False):
+            if _attempt == 1:
+                # As instaloader retries a failed request: through the context's get_json
+                return context.get_json(path, params, host, session, _attempt + 1,
+                                        response_headers=response_headers, use_post=use_post)
+            return fake_get_json(path, params, host, session, _attempt, response_headers, use_post)
+
+        context.get_json = retrying_get_json
+        recorder = ResponseRecorder(flaky_recording, mode='record')
+        recorder.install(context)
+        response = context.get_json('explore/locations/1/', params={'__a': 1, '__d': 'dis'})
+        recorder.close()
+        with open(flaky_recording, encoding='utf-8') as f:
+            assert len(f.readlines()) == 1 and recorder.requests == 1
+        context = InstagramLocationExtractor(scheduler=make_test_scheduler(),
+                                             recorder=ResponseRecorder(flaky_recording)).loader.context
+        assert context.get_json('explore/locations/1/', params={'__a': 1, '__d': 'dis'}) == response
+
+    print("✅ Recorded run replayed offline with identical locations")
+    return True
+
+
+def test_benchmark_smoke():
+    """Test that the benchmark's synthetic corpus is realistic and every stage runs"""
+    print("\n🔄 Testing benchmark suite on a small corpus...")
+    from benchmark_extractor import EXPORTERS as BENCHMARKED_FORMATS, compare, run_scale, synthetic_nodes
+
+    nodes = list(synthetic_nodes(2000))
+    assert len({node['shortcode'] for node in nodes}) == 2000
+    assert 0.2 < sum(node['is_video'] for node in nodes) / 2000 < 0.3
+    location_ids = [node['location']['id'] for node in nodes if node['location']]
+    assert 0.8 < len(location_ids) / 2000 < 0.9
+    assert len(set(location_ids)) < len(location_ids) / 2  # popular places are saved many times
+
+    results = run_scale(300)
+    assert set(results) == {'extract', 'captions', 'export_all', 'export_chunked'} | \
+        {f'export_{name}' for name in BENCHMARKED_FORMATS}
+    assert results['extract']['rows'] == sum(1 for node in synthetic_nodes(300) if node['location'])
+    assert all(result['rows_per_sec'] > 0 and result['peak_rss_mb'] > 0 for result in results.values())
+
+    slower = {stage: dict(result, rows_per_sec=result['rows_per_sec'] / 2) for stage, result in results.items()}
+    assert compare({'300': slower}, {'300': results}, 0.2)
+    assert not compare({'300': results}, {'300': results}, 0.2)
+
+    print("✅ Benchmark stages run on a synthetic corpus")
+    return True
+
+
+def test_run_metrics():
+    """Test the run report: phase timings, cache hit ratios, requests and bytes written"""
+    print("\n🔄 Testing run metrics...")
+    nodes = [make_post_node(f'METRIC{i:03d}', make_location(i % 4, f'Spot {i % 4}', 52.0, 13.0 + i % 4)
+                            if i % 5 else None) for i in range(30)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        extractor = make_offline_extractor(nodes, cache_path=os.path.join(tmpdir, 'cache.sqlite3'))
+        list(extractor.iter_locations())
+        extractor = make_offline_extractor(nodes, cache_path=os.path.join(tmpdir, 'cache.sqlite3'))
+        outputs = extractor.export_to_formats(extractor.iter_locations(), ['csv', 'geojson'],
+                                              basename=os.path.join(tmpdir, 'export'))
+        report = extractor.run_report()
+
+        assert {'page_fetch', 'export'} <= set(report['phases'])
+        assert report['phases']['page_fetch']['calls'] == 1 + 3 + 1  # iterator setup, 3 pages, end
+        assert report['phases']['export']['calls'] == 2
+        counters = report['counters']
+        assert counters['posts'] == 30 and counters['locations'] == 24
+        assert counters['post_cache_hits'] == 30 and report['cache']['post_cache_hit_ratio'] == 1.0
+        assert counters['rows_written'] == 48
+        assert counters['bytes_written'] == sum(os.path.getsize(filename) for filename in outputs.values())
+
+        # A fresh run resolves every post; locations shared by several posts hit the location cache
+        extractor = make_offline_extractor(nodes)
+        list(extractor.iter_locations())
+        report = extractor.run_report()
+        assert report['phases']['resolve']['calls'] == 30
+        assert report['phases']['caption_parsing']['calls'] == 24
+        assert report['counters']['location_cache_misses'] == 4
+        assert report['cache']['location_cache_hit_ratio'] == round(20 / 24, 4)
+        assert report['cache']['post_cache_hit_ratio'] is None
+        assert set(report['requests']) == {'by_endpoint', 'rate_limited', 'wait_seconds', 'rates_per_minute'}
+
+        write_json_report(report, os.path.join(tmpdir, 'report.json'))
+        with open(os.path.join(tmpdir, 'report.json'), encoding='utf-8') as f:
+            assert json.load(f) == report
+        write_prometheus_textfile(report, os.path.join(tmpdir, 'metrics.prom'))
+        with open(os.path.join(tmpdir, 'metrics.prom'), encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        assert 'instagram_extractor_phase_calls{phase="resolve"} 30' in lines
+        assert 'instagram_extractor_location_cache_misses 4' in lines
+        assert all(line.startswith('# ') or len(line.split(' ')) == 2 for line in lines)
+
+    print("✅ Run report covers phases, caches, requests and output")
+    return True
+
+
+def test_session_persistence():
+    """Test saving and reusing the login session, 2FA, and renewing an expired session"""
+    print("\n🔄 Testing session persistence...")
+    logins = []
+
+    def make_extractor(two_factor=False):
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler())
+        context = extractor.loader.context
+
+        def login(user, passwd):
+            if passwd != 'secret':
+                raise instaloader.exceptions.BadCredentialsException('bad password')
+            if two_factor:
+                raise instaloader.exceptions.TwoFactorAuthRequiredException('2FA required')
+            finish_login(user)
+
+        def finish_login(user):
+            logins.append(user)
+            context._session.cookies.set('sessionid', f'session{len(logins)}')
+            context._session.cookies.set('csrftoken', 'token')
+            context._session.cookies.set('ds_user_id', '42')
+            context.username = user
+
+        context.login = login
+        context.two_factor_login = lambda code: finish_login('tester') if code == '123456' else None
+        return extractor
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        session_file = os.path.join(tmpdir, 'session-tester')
+        assert make_extractor().login('tester', 'secret', session_file=session_file)
+        assert len(logins) == 1 and os.path.isfile(session_file)
+
+        # The next run starts from the saved session: no login, no request
+        extractor = make_extractor()
+        extractor.loader.test_login = lambda: (_ for _ in ()).throw(AssertionError('no check needed'))
+        assert extractor.login('tester', session_file=session_file)
+        assert len(logins) == 1
+        assert extractor.loader.context.username == 'tester' and extractor.loader.context.user_id == '42'
+
+        # An old session is checked first, and trusted again once it passed
+        old = time.time() - 2 * 24 * 3600
+        os.utime(session_file, (old, old))
+        extractor = make_extractor()
+        extractor.loader.test_login = lambda: 'tester'
+        assert extractor.login('tester', session_file=session_file)
+        assert len(logins) == 1 and os.path.getmtime(session_file) > old
+
+        # An expired session falls back to the password, or fails without one
+        os.utime(session_file, (old, old))
+        extractor = make_extractor()
+        extractor.loader.test_login = lambda: None
+        assert not extractor.login('tester', session_file=session_file)
+        assert not extractor.loader.context.is_logged_in
+        extractor.loader.test_login = lambda: None
+        assert extractor.login('tester', 'secret', session_file=session_file)
+        assert len(logins) == 2
+
+        # Two-factor authentication asks for the code instead of failing
+        assert not make_extractor(two_factor=True).login('tester', 'secret')
+        assert make_extractor(two_factor=True).login('tester', 'secret', two_factor_code=lambda: '123456')
+        assert len(logins) == 3
+
+        # A session expiring mid-run is renewed once, transparently
+        extractor = make_extractor()
+        assert extractor.login('tester', 'secret')
+        calls = []
+
+        def fetch():
+            calls.append(extractor._session_generation)
+            if len(calls) == 1:
+                raise instaloader.exceptions.LoginRequiredException('Redirected to login page.')
+            return 'page'
+
+        assert extractor._call_with_backoff(fetch) == 'page'
+        assert calls == [0, 1] and len(logins) == 5
+
+        extractor = make_extractor()
+        extractor.loader.test_login = lambda: 'tester'
+        assert extractor.login('tester', session_file=session_file)
+        try:
+            extractor._call_with_backoff(lambda: (_ for _ in ()).throw(
+                instaloader.exceptions.LoginRequiredException('Redirected to login page.')))
+            assert False, 'without a password the session cannot be renewed'
+        except instaloader.exceptions.LoginRequiredException:
+            pass
+
+        # login_account() validates the saved session once, and keeps the password from the
+        # environment to renew the session later
+        os.environ['TEST_INSTAGRAM_PASSWORD'] = 'secret'
+        try:
+            extractor = make_extractor()
+            extractor.loader.test_login = lambda: 'tester'
+            assert login_account(extractor, 'tester', session_file, 'TEST_INSTAGRAM_PASSWORD')
+            assert extractor._credentials == ('tester', 'secret', session_file) and len(logins) == 5
+
+            os.utime(session_file, (old, old))
+            extractor = make_extractor()
+            checks = []
+            extractor.loader.test_login = lambda: checks.append(1)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                assert login_account(extractor, 'tester', session_file, 'TEST_INSTAGRAM_PASSWORD')
+            assert checks == [1] and len(logins) == 6
+            assert 'Login failed' not in output.getvalue()
+        finally:
+            del os.environ['TEST_INSTAGRAM_PASSWORD']
+
+    print("✅ Sessions are saved, reused, verified and renewed")
+    return True
+
+
+def test_batch_accounts():
+    """Test the non-interactive command line and a batch run of several accounts in worker processes"""
+    print("\n🔄 Testing batch runs...")
+    # Options that only make sense for one account are rejected in batch mode
+    for argv in (['--accounts', 'a.json', '--username', 'x'], ['--accounts', 'a.json', '--format', 'kml'],
+                 ['--processes', '2'], ['--incremental', '--no-cache']):
+        try:
+            parse_args(argv)
+            assert False, f'{argv} should be rejected'
+        except SystemExit as e:
+            assert e.code == 2
+    args = parse_args(['--username', 'tester', '--yes', '--format', 'csv,geojson', '-o', 'out'])
+    assert args.formats == ['csv', 'geojson'] and args.output == 'out' and args.yes
+
+    locations = [make_location(i, f'Spot {i}', 35.0 + i, 139.0) for i in range(4)]
+    accounts = {
+        'alice': [make_post_node(f'A{i:03d}', locations[i % 4], caption=f'#alice{i}') for i in range(12)],
+        # bob saved two of alice's posts, and one post without a location
+        'bob': [make_post_node(f'B{i:03d}', locations[i % 4]) for i in range(5)]
+               + [make_post_node('A000', locations[0]), make_post_node('A001', locations[1]),
+                  make_post_node('B999')],
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Record each account once, then run the batch from the recordings, offline
+        entries = []
+        for username, nodes in accounts.items():
+            recording = os.path.join(tmpdir, f'{username}.ndjson')
+            extractor = InstagramLocationExtractor(scheduler=make_test_scheduler())
+            extractor.loader.context.sleep = False
+            FakeInstagram(nodes, locations).install(extractor.loader.context)
+            recorder = ResponseRecorder(recording, mode='record')
+            recorder.install(extractor.loader.context)
+            assert extractor.login(username, 'secret')
+            assert len(list(extractor.iter_locations())) == len([node for node in nodes if node['location']])
+            recorder.close()
+            entries.append({'username': username, 'replay': recording})
+        entries.append({'username': 'carol', 'password_env': 'NO_SUCH_PASSWORD_VARIABLE',
+                        'session_file': os.path.join(tmpdir, 'no-session')})
+        accounts_file = os.path.join(tmpdir, 'accounts.json')
+        with open(accounts_file, 'w') as f:
+            json.dump(entries, f)
+        assert [account['username'] for account in load_accounts(accounts_file)] == ['alice', 'bob', 'carol']
+
+        output_dir = os.path.join(tmpdir, 'out')
+        merged = os.path.join(tmpdir, 'merged')
+        report_path = os.path.join(tmpdir, 'report.json')
+        try:
+            main(['--accounts', accounts_file, '--output-dir', output_dir, '--format', 'csv,ndjson',
+                  '-o', merged, '--metrics', report_path, '--processes', '2'])
+            assert False, 'the failed login of carol should fail the batch'
+        except SystemExit as e:
+            assert e.code == 1
+
+        # Per-account outputs and logs; carol could not log in without a session or a password
+        with open(os.path.join(output_dir, 'alice.csv'), newline='', encoding='utf-8') as f:
+            assert len(list(csv.DictReader(f))) == 12
+        with open(os.path.join(output_dir, 'bob.ndjson'), encoding='utf-8') as f:
+            assert len(f.readlines()) == 7
+        with open(os.path.join(output_dir, 'carol.log'), encoding='utf-8') as f:
+            assert 'NO_SUCH_PASSWORD_VARIABLE' in f.read()
+        assert not os.path.exists(os.path.join(output_dir, 'carol.csv'))
+
+        # The merged output lists every post once
+        with open(f'{merged}.ndjson', encoding='utf-8') as f:
+            post_urls = [json.loads(line)['post_url'] for line in f]
+        assert len(post_urls) == len(set(post_urls)) == 17
+        with open(report_path) as f:
+            report = json.load(f)['accounts']
+        assert report['alice']['counters']['locations'] == 12 and report['carol']['counters']['locations'] == 0
+
+        # An account output that cannot be read back fails the merge alone: the report is still written
+        os.remove(report_path)
+        module = sys.modules[InstagramLocationExtractor.__module__]
+        merge_exports = module.merge_exports
+
+        def unreadable(filenames):
+            raise ValueError('corrupt export')
+
+        module.merge_exports = unreadable
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                main(['--accounts', accounts_file, '--output-dir', output_dir, '-o', merged,
+                      '--metrics', report_path, '--processes', '2'])
+            assert False, 'the batch should fail'
+        except SystemExit as e:
+            assert e.code == 1
+        finally:
+            module.merge_exports = merge_exports
+        assert "Could not merge the accounts' locations: corrupt export" in output.getvalue()
+        assert 'Could not read the accounts' not in output.getvalue()
+        assert os.path.isfile(report_path)
+
+    print("✅ Accounts extracted in parallel, with per-account and merged outputs")
+    return True
+
+
+def test_offline_export():
+    """Test re-exporting the cache and earlier exports offline, without loading instaloader"""
+    print("\n🔄 Testing offline export...")
+    # Two posts a day from January 1st, 2024, alternately in Lisbon and Tokyo
+    nodes = [make_post_node(f'OFF{i:03d}', make_location(i % 2, ['Lisbon', 'Tokyo'][i % 2], [38.72, 35.68][i % 2],
+                                                          [-9.14, 139.69][i % 2]) if i % 5 else None,
+                            timestamp=1704110400 + i * 43200)
+             for i in range(40)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+        extracted = make_offline_extractor(nodes, cache_path=cache_path).extract_locations_from_saved()
+        assert len(extracted) == 32
+
+        # The last run again, from the cache, in saved order
+        basename = os.path.join(tmpdir, 'again')
+        main(['export', '--cache', cache_path, '--format', 'ndjson', '-o', basename])
+        assert list(read_export(f'{basename}.ndjson')) == extracted
+
+        # Filtered by date and area, from an earlier export
+        main(['export', f'{basename}.ndjson', '--since', '2024-01-05', '--until', '2024-01-10',
+              '--near=38.7,-9.1,10', '--format', 'csv,geojson', '-o', basename + '_lisbon'])
+        lisbon = list(read_export(f'{basename}_lisbon.geojson'))
+        assert lisbon and all(record.name == 'Lisbon' for record in lisbon)
+        assert all('2024-01-05' <= record.date[:10] <= '2024-01-10' for record in lisbon)
+        assert lisbon == list(read_export(f'{basename}_lisbon.csv'))
+        assert len(list(filter_records(extracted, bbox=(30.0, 130.0, 40.0, -170.0)))) == 16
+
+        # Nothing matching leaves no empty files behind
+        main(['export', '--cache', cache_path, '--since', '2030-01-01', '-o', basename + '_none'])
+        assert not os.path.exists(f'{basename}_none.csv')
+
+        # A fresh interpreter exports without importing instaloader or building a loader
+        script = ("import sys, instagram_location_extractor as extractor; "
+                  f"extractor.main(['export', '--cache', {cache_path!r}, '-o', {basename + '_fresh'!r}]); "
+                  "assert 'instaloader.instaloader' not in sys.modules and 'requests.adapters' not in sys.modules")
+        result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+        assert len(list(read_export(f'{basename}_fresh.csv'))) == 32
+
+    print("✅ Cache and exports re-exported offline")
+    return True
+
+
+def test_media_downloads():
+    """Test downloading post media into the content-addressed store, concurrently and resumably"""
+    print("\n🔄 Testing media downloads...")
+    shared_image = b'\xff\xd8 shared sunset ' * 1000
+    files = {f'https://cdn{i % 2}.example.com/p{i}.jpg': b'\xff\xd8 image %d ' % i * 500 for i in range(20)}
+    files['https://cdn0.example.com/a.jpg'] = files['https://cdn1.example.com/b.jpg'] = shared_image
+    # A video of several chunks
+    files['https://video.example.com/v.mp4'] = os.urandom(5 * 64 * 1024 + 123)
+    records = [LocationRecord(f'MED{i:03d}', f'Spot {i}', 1.0, 2.0, '2024-01-01 00:00:00',
+                              display_url=f'https://cdn{i % 2}.example.com/p{i}.jpg') for i in range(20)]
+    records += [LocationRecord('SHARED1', 'Beach', 1.0, 2.0, '', display_url='https://cdn0.example.com/a.jpg'),
+                LocationRecord('SHARED2', 'Beach', 1.0, 2.0, '', display_url='https://cdn1.example.com/b.jpg'),
+                LocationRecord('VIDEO', 'Pier', 1.0, 2.0, '', is_video=True, video_url='https://video.example.com/v.mp4',
+                               display_url='https://cdn0.example.com/p0.jpg'),
+                LocationRecord('GONE', 'Lost', 1.0, 2.0, '', display_url='https://cdn0.example.com/expired.jpg'),
+                LocationRecord('NOMEDIA', 'Nowhere', 1.0, 2.0, '')]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        media = os.path.join(tmpdir, 'media')
+        cdn = FakeCdn(files)
+        downloader = MediaDownloader(media, videos=True, workers=6, per_host=2, session=cdn)
+        downloaded = list(downloader.download(records))
+        assert [record.shortcode for record in downloaded] == [record.shortcode for record in records]
+        assert max(cdn.max_in_flight.values()) == 2
+        assert cdn.chunk_sizes == {64 * 1024}
+
+        by_shortcode = {record.shortcode: record for record in downloaded}
+        for record in downloaded[:20]:
+            with open(record.image_file, 'rb') as f:
+                content = f.read()
+            assert content == files[record.display_url]
+            assert os.path.basename(record.image_file) == hashlib.sha256(content).hexdigest() + '.jpg'
+        # Same content, one file
+        assert by_shortcode['SHARED1'].image_file == by_shortcode['SHARED2'].image_file
+        assert by_shortcode['VIDEO'].image_file == by_shortcode['MED000'].image_file
+        with open(by_shortcode['VIDEO'].video_file, 'rb') as f:
+            assert f.read() == files['https://video.example.com/v.mp4']
+        assert by_shortcode['VIDEO'].video_file.endswith('.mp4')
+        assert by_shortcode['GONE'].image_file == '' and by_shortcode['NOMEDIA'].image_file == ''
+        assert downloader.stats['failed'] == 1 and downloader.stats['deduplicated'] == 2
+        assert not os.listdir(os.path.join(media, 'tmp'))
+
+        # Another run finds everything in place: only the failed image is tried again
+        cdn.requests.clear()
+        for record in records:
+            record.image_file = record.video_file = ''
+        again = MediaDownloader(media, videos=True, session=cdn)
+        assert [record.image_file for record in again.download(records)] == \
+            [by_shortcode[record.shortcode].image_file for record in records]
+        assert cdn.requests == ['https://cdn0.example.com/expired.jpg']
+
+        # The file paths are exported with the records
+        path = os.path.join(tmpdir, 'with_media.csv')
+        assert export_records(downloaded, {'csv': path}) == {'csv': len(records)}
+        assert list(read_export(path)) == downloaded
+
+    print("✅ Media stored once per content, streamed, and resumed")
+    return True
+
+
+def test_saved_collections():
+    """Test collection listing, per-collection extraction and concurrent collection crawls"""
+    print("\n🔄 Testing saved collections...")
+    locations = [make_location(i, f'Place {i}', 40.0 + i, -3.0 - i) for i in range(6)]
+    shared = make_iphone_media('SHARED', locations[0], caption='#both')
+    collections = {
+        'Tokyo': [make_iphone_media(f'TYO{i:03d}', locations[i % 3], caption=f'#tokyo{i}') for i in range(5)]
+                 + [make_iphone_media('TYONONE'), shared],
+        'Paris': [make_iphone_media(f'PAR{i:03d}', locations[3 + i % 3]) for i in range(5)] + [shared],
+        'Empty': [],
+    }
+    in_flight = {'current': 0, 'max': 0}
+    counter_lock = threading.Lock()
+
+    def make_extractor(**kwargs):
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler(), **kwargs)
+        extractor.loader.context.sleep = False
+        instagram = FakeInstagram([], locations, collections)
+        instagram.install(extractor.loader.context)
+
+        def slow_get_json(path, params, host='www.instagram.com', *args, **kwargs):
+            # As instaloader's rate controller would
+            extractor.scheduler.acquire('iphone' if host == 'i.instagram.com' else 'graphql')
+            crawl = path.startswith('api/v1/feed/collection/')
+            with counter_lock:
+                in_flight['current'] += crawl
+                in_flight['max'] = max(in_flight['max'], in_flight['current'])
+            try:
+                time.sleep(0.02)
+                return instagram.get_json(path, params, host, *args, **kwargs)
+            finally:
+                with counter_lock:
+                    in_flight['current'] -= crawl
+
+        extractor.loader.context.get_json = slow_get_json
+        assert extractor.login('tester', 'secret')
+        return extractor, instagram
+
+    # The automatic "All posts" collection is left out, and the listing is paginated
+    extractor, instagram = make_extractor()
+    saved = extractor.get_saved_collections()
+    assert [(collection.name, collection.media_count) for collection in saved] == \
+        [('Tokyo', 7), ('Paris', 6), ('Empty', 0)]
+    assert extractor.find_collections(['paris', 'Paris']) == [saved[1]]
+    try:
+        extractor.find_collections(['Lisbon'])
+        assert False, 'an unknown collection should be rejected'
+    except ValueError as e:
+        assert 'Tokyo, Paris, Empty' in str(e)
+
+    # One collection, built from the iPhone API items without any further request
+    instagram.requests = 0
+    records = list(extractor.iter_locations(collection=saved[0]))
+    assert [record.shortcode for record in records] == [f'TYO{i:03d}' for i in range(5)] + ['SHARED']
+    assert {record.collection for record in records} == {'Tokyo'}
+    assert records[0].to_dict()['hashtags'] == '#tokyo0' and records[0].latitude == 40.0
+    assert records[0].display_url == 'https://cdn.example.com/TYO000.jpg'
+    assert instagram.requests == 2  # two pages of five
+    assert extractor.stats == {'posts': 7, 'locations': 6, 'cached': 0}
+
+    # Several collections at once, within the shared budget
+    extractor, instagram = make_extractor()
+    scheduler = extractor.scheduler
+    in_flight['max'] = 0
+    records = list(extractor.iter_collection_locations(saved, concurrency=2))
+    assert sorted((record.collection, record.shortcode) for record in records) == sorted(
+        [('Tokyo', f'TYO{i:03d}') for i in range(5)] + [('Paris', f'PAR{i:03d}') for i in range(5)]
+        + [('Tokyo', 'SHARED'), ('Paris', 'SHARED')])
+    assert extractor.stats == {'posts': 13, 'locations': 12, 'cached': 0}
+    assert in_flight['max'] == 2
+    assert scheduler.stats()['requests']['iphone'] == instagram.requests == 5
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('collection-crawl')]
+
+    # A failing crawl stops the others and reaches the consumer
+    gone = saved[0]._replace(id='999', name='Gone')
+    try:
+        list(extractor.iter_collection_locations([saved[0], gone, saved[1]], concurrency=3))
+        assert False, 'the missing collection should raise'
+    except instaloader.exceptions.QueryReturnedNotFoundException:
+        pass
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('collection-crawl')]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Incremental runs keep one watermark per collection
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+        extractor, instagram = make_extractor(cache_path=cache_path)
+        list(extractor.iter_locations(incremental=True, collection=saved[1]))
+        assert extractor.cache.get_state('collection_shortcodes:101')[0] == 'PAR000'
+        assert extractor.cache.get_state('saved_shortcodes') is None
+        collections['Paris'].insert(0, make_iphone_media('PARNEW', locations[5]))
+        again = list(extractor.iter_locations(incremental=True, collection=saved[1]))
+        assert extractor.stats['posts'] == 1 and len(again) == 7
+        assert {record.collection for record in again} == {'Paris'}
+        del collections['Paris'][0]
+        extractor.cache.close()
+
+        # From the command line, replaying a recorded run
+        recording = os.path.join(tmpdir, 'collections.ndjson')
+        extractor, instagram = make_extractor()
+        recorder = ResponseRecorder(recording, mode='record')
+        recorder.install(extractor.loader.context)
+        assert extractor.login('tester', 'secret')
+        list(extractor.iter_collection_locations(extractor.find_collections(['Tokyo', 'Paris'])))
+        recorder.close()
+
+        output = os.path.join(tmpdir, 'tagged')
+        main(['--replay', recording, '--yes', '--no-cache', '--collection', 'tokyo', '--collection', 'Paris',
+              '--format', 'csv,ndjson', '-o', output])
+        exported = list(read_export(output + '.ndjson'))
+        assert len(exported) == 12
+        assert {(record.collection, record.shortcode) for record in exported} >= {('Tokyo', 'SHARED'),
+                                                                                  ('Paris', 'SHARED')}
+        with open(output + '.csv', newline='', encoding='utf-8') as f:
+            assert {row['Collection'] for row in csv.DictReader(f)} == {'Tokyo', 'Paris'}
+
+        listing = io.StringIO()
+        with contextlib.redirect_stdout(listing):
+            main(['--replay', recording, '--list-collections'])
+        assert '  Tokyo (7 posts)' in listing.getvalue() and '  Empty (0 posts)' in listing.getvalue()
+        try:
+            main(['--replay', recording, '--yes', '--collection', 'Tokyo', '--resume'])
+            assert False, '--resume should be rejected with --collection'
+        except SystemExit as e:
+            assert e.code == 2
+
+    print("✅ Collections listed, extracted per collection and crawled concurrently")
+    return True
+
+
+def test_field_projection():
+    """Test that a field selection is pushed down into extraction and exports"""
+    print("\n🔄 Testing field projection...")
+    locations = [make_location(i, f'Spot {i}', 48.0 + i / 10, 2.0) for i in range(5)]
+    nodes = [make_post_node(f'FLD{i:03d}', locations[i % 5], caption=f'#field{i} @someone', likes=i,
+                            is_video=i % 3 == 0) for i in range(30)]
+    minimal = ['date']
+
+    # Only the properties behind the selected fields are read
+    CountingPost.reads = {}
+    records = list(make_offline_extractor(nodes, post_class=CountingPost, fields=minimal).iter_locations())
+    assert len(records) == 30 and CountingPost.reads == {'date_local': 30}
+    assert records[1].caption == '' and records[1].likes is None
+    CountingPost.reads = {}
+    full = list(make_offline_extractor(nodes, post_class=CountingPost).iter_locations())
+    assert {'caption', 'owner_username', 'likes', 'comments', 'video_url'} <= set(CountingPost.reads)
+    assert full[1].hashtags == '#field1' and full[1].likes == 1
+    assert records[1].date == full[1].date
+
+    # Against Instagram, a minimal run costs the profile lookup and the saved-post pages alone;
+    # video URLs cost an iPhone API request per video
+    def count_requests(**kwargs):
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler(), prefetch=0, **kwargs)
+        extractor.loader.context.sleep = False
+        instagram = FakeInstagram(json.loads(json.dumps(nodes)), locations)
+        instagram.install(extractor.loader.context)
+        assert extractor.login('tester', 'secret')
+        before = instagram.requests
+        assert len(list(extractor.iter_locations())) == 30
+        return instagram.requests - before
+
+    assert count_requests(fields=minimal) == 1 + 3
+    assert count_requests() == 1 + 3 + 10
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Exports adapt to the selection
+        extractor = make_offline_extractor(nodes, fields=['date', 'likes'])
+        basename = os.path.join(tmpdir, 'projected')
+        outputs = extractor.export_to_formats(extractor.iter_locations(), ['csv', 'geojson', 'kml', 'ndjson'],
+                                              basename)
+        with open(outputs['csv'], newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ['Name', 'Latitude', 'Longitude', 'URL', 'Date', 'Likes']
+        assert rows[2][-1] == '1'
+        with open(outputs['ndjson'], encoding='utf-8') as f:
+            assert list(json.loads(f.readline())) == ['name', 'latitude', 'longitude', 'post_url', 'date', 'likes']
+        with open(outputs['geojson'], encoding='utf-8') as f:
+            assert set(json.load(f)['features'][0]['properties']) == {'name', 'latitude', 'longitude', 'post_url',
+                                                                       'date', 'likes'}
+        with open(outputs['kml'], encoding='utf-8') as f:
+            assert '#field' not in f.read()
+        assert [record.likes for record in read_export(outputs['csv'])] == list(range(30))
+        manifest = extractor.export_to_chunks(iter(records), os.path.join(tmpdir, 'chunk'))
+        with open(manifest[0], encoding='utf-8') as f:
+            assert f.readline().strip() == 'Name,Latitude,Longitude,URL,Date,Likes'
+
+        # The cache remembers what was left out, and a later run reads only that
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+        list(make_offline_extractor(nodes, cache_path=cache_path, fields=minimal).iter_locations())
+        CountingPost.reads = {}
+        list(make_offline_extractor(nodes, post_class=CountingPost, cache_path=cache_path,
+                                    fields=['hashtags']).iter_locations())
+        assert CountingPost.reads == {'caption': 30}
+        CountingPost.reads = {}
+        cached = list(make_offline_extractor(nodes, post_class=CountingPost, cache_path=cache_path,
+                                             fields=minimal + ['hashtags']).iter_locations())
+        assert CountingPost.reads == {}
+        assert cached[1].hashtags == '#field1' and cached[1].date == full[1].date
+        cached = list(make_offline_extractor(nodes, post_class=ExplodingPost, cache_path=cache_path).iter_locations())
+        assert cached == full
+
+        # Locations merged into an incremental run from a projected one are completed as well
+        cache_path = os.path.join(tmpdir, 'incremental.sqlite3')
+        list(make_offline_extractor(nodes, cache_path=cache_path, fields=minimal).iter_locations(incremental=True))
+        newer = [make_post_node('FLDNEW', locations[0], caption='#fresh')] + nodes
+        CountingPost.reads = {}
+        merged = list(make_offline_extractor(newer, post_class=CountingPost, cache_path=cache_path)
+                      .iter_locations(incremental=True))
+        assert merged[1:] == full and CountingPost.reads['caption'] == 31
+        assert list(make_offline_extractor(newer, post_class=ExplodingPost, cache_path=cache_path)
+                    .iter_locations(incremental=True)) == merged
+
+    # From the command line
+    assert parse_args(['--columns', 'date, likes']).fields == ('name', 'latitude', 'longitude', 'post_url',
+                                                                'date', 'likes')
+    assert parse_args(['--columns', 'date', '--media', 'media']).fields[-2:] == ('display_url', 'image_file')
+    assert parse_args([]).fields is None
+    with contextlib.redirect_stderr(io.StringIO()):
+        try:
+            parse_args(['--columns', 'date,altitude'])
+            assert False, 'an unknown field should be rejected'
+        except SystemExit as e:
+            assert e.code == 2
+
+    print("✅ Only the selected fields are resolved and written")
+    return True
+
+
+def test_location_filter():
+    """Test that filters rule posts out from their page node, before anything is resolved"""
+    print("\n🔄 Testing location filter...")
+    locations = [make_location(i, f'Square {i}', 50.0 + i, 10.0 + i) for i in range(6)]
+    # Saved newest first, one day apart
+    nodes = [make_post_node(f'FLT{i:03d}', locations[i % 6] if i % 10 != 9 else None,
+                            caption='#rare find' if i % 20 == 3 else f'#common{i}',
+                            owner='alice' if i % 2 else 'bob', is_video=i % 4 == 0,
+                            timestamp=1709294400 - i * 86400) for i in range(60)]
+    full = list(make_offline_extractor(nodes).iter_locations())
+    assert len(full) == 54
+
+    def extract(location_filter, **kwargs):
+        CountingPost.reads = {}
+        extractor = make_offline_extractor(nodes, post_class=CountingPost, location_filter=location_filter, **kwargs)
+        return list(extractor.iter_locations()), extractor
+
+    # Same records as filtering afterwards, but only the matching posts are resolved
+    for location_filter in (LocationFilter(hashtags=['#Rare']), LocationFilter(owners=['alice'], has_video=False),
+                            LocationFilter(since=LocationFilter.node_day(nodes[30]),
+                                           until=LocationFilter.node_day(nodes[20])),
+                            LocationFilter(bbox=(51.5, 0.0, 53.5, 20.0)),
+                            LocationFilter(near=(50.0, 10.0, 50), has_video=True)):
+        records, extractor = extract(location_filter)
+        expected = list(location_filter.filter(full))
+        assert records == expected and expected
+        assert CountingPost.reads.get('likes') == len(expected)
+        assert extractor.metrics.counters['posts_filtered'] == 60 - len(expected)
+    assert [record.shortcode for record in records] == ['FLT000', 'FLT012', 'FLT024', 'FLT036', 'FLT048']
+    assert len(list(filter_records(full, hashtags=['rare']))) == 3
+
+    # The fields a filter needs are resolved even if not selected, e.g. hashtags from cached captions
+    records, _ = extract(LocationFilter(hashtags=['rare']), fields=['date'])
+    assert [record.hashtags for record in records] == ['#rare'] * 3
+
+    # With stop_before_since, pagination ends after the first page entirely before the cutoff
+    since = LocationFilter.node_day(nodes[17])
+
+    def count_pages(location_filter, **kwargs):
+        extractor = InstagramLocationExtractor(scheduler=make_test_scheduler(), prefetch=0,
+                                               location_filter=location_filter, **kwargs)
+        extractor.loader.context.sleep = False
+        extractor.loader.context.iphone_support = False  # no video URL lookups
+        instagram = FakeInstagram(json.loads(json.dumps(nodes)), locations)
+        instagram.install(extractor.loader.context)
+        assert extractor.login('tester', 'secret')
+        before = instagram.requests
+        records = list(extractor.iter_locations())
+        return records, instagram.requests - before - 1  # the profile lookup
+
+    records, pages = count_pages(LocationFilter(since=since))
+    assert pages == 5 and len(records) == 17
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, 'cache.sqlite3')
+        stopped, pages = count_pages(LocationFilter(since=since, stop_before_since=True), cache_path=cache_path)
+        assert pages == 3 and stopped == records
+        # An interrupted crawl is no reference for incremental runs
+        cache = PostCache(cache_path)
+        assert cache.get_state('saved_shortcodes') is None
+        cache.close()
+
+        # Neither is a filtered run, whose ruled out posts are not cached: a later unfiltered
+        # incremental run still finds every location
+        cache_path = os.path.join(tmpdir, 'filtered.sqlite3')
+        rare = LocationFilter(hashtags=['rare'])
+        extractor = make_offline_extractor(nodes, cache_path=cache_path, location_filter=rare)
+        assert len(list(extractor.iter_locations(incremental=True))) == 3
+        assert extractor.stats['posts'] == 60
+        assert list(make_offline_extractor(nodes, cache_path=cache_path).iter_locations(incremental=True)) == full
+
+    try:
+        LocationFilter(stop_before_since=True)
+        assert False, 'stop_before_since without since should be rejected'
+    except ValueError:
+        pass
+
+    # From the command line
+    args = parse_args(['--since', '2024-01-01', '--hashtag', '#Rare', '--owner', '@Alice', '--videos-only'])
+    assert args.location_filter.hashtags == {'rare'} and args.location_filter.owners == {'alice'}
+    assert args.location_filter.has_video is True and args.location_filter.since == '2024-01-01'
+    assert not parse_args([]).location_filter
+    assert parse_args(['export', '--no-videos']).location_filter.has_video is False
+    with contextlib.redirect_stderr(io.StringIO()):
+        for argv in (['--stop-before-since'], ['--since', '2024-02-01', '--until', '2024-01-01']):
+            try:
+                parse_args(argv)
+                assert False, f'{argv} should be rejected'
+            except SystemExit as e:
+                assert e.code == 2
+
+    print("✅ Filters skip non-matching posts before resolving them")
+    return True
+
+
 if __name__ == "__main__":
     print("\nRunning automated tests...\n")
 
-    # Test 1: Class initialization
-    test1 = test_class_initialization()
-
-    # Test 2: CSV export
-    test2 = test_csv_export()
+    tests = [
+        ("Class Initialization", test_class_initialization),
+        ("CSV Export", test_csv_export),
+        ("Post Cache", test_post_cache),
+        ("Incremental Sync", test_incremental_sync),
+        ("Resume Checkpoint", test_resume_from_checkpoint),
+        ("Location Cache", test_location_cache),
+        ("Request Scheduler", test_request_scheduler),
+        ("Concurrent Enrichment", test_concurrent_enrichment),
+        ("Streaming Export", test_streaming_export),
+        ("Page Prefetch", test_page_prefetch),
+        ("Async Extraction", test_async_extraction),
+        ("Location Record", test_location_record),
+        ("Caption Analysis", test_caption_analysis),
+        ("Multi-format Export", test_multi_format_export),
+        ("Spatial Index", test_spatial_index),
+        ("Location Clustering", test_location_clustering),
+        ("Chunked Export", test_chunked_export),
+        ("Record and Replay", test_record_and_replay),
+        ("Benchmark Suite", test_benchmark_smoke),
+        ("Run Metrics", test_run_metrics),
+        ("Session Persistence", test_session_persistence),
+        ("Batch Accounts", test_batch_accounts),
+        ("Offline Export", test_offline_export),
+        ("Media Downloads", test_media_downloads),
+        ("Saved Collections", test_saved_collections),
+        ("Field Projection", test_field_projection),
+        ("Location Filter", test_location_filter),
+    ]
+    results = [(name, test()) for name, test in tests]
 
     # Summary
     print("\n" + "=" * 60)
     print("TEST SUMMARY")
     print("=" * 60)
-    print(f"Class Initialization: {'✅ PASS' if test1 else '❌ FAIL'}")
-    print(f"CSV Export:           {'✅ PASS' if test2 else '❌ FAIL'}")
+    for name, passed in results:
+        print(f"{name + ':':<24}{'✅ PASS' if passed else '❌ FAIL'}")
     print("=" * 60)
 
-    if test1 and test2:
+    if all(passed for _, passed in results):
         print("\n🎉 All tests passed! The script is ready to use.")
         print("\nNext steps:")
         print("1. Run: ./venv/bin/python instagram_location_extractor.py")
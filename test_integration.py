@@ -7,12 +7,16 @@ Success Criteria:
 - Successfully authenticate with Instagram
 - Extract at least 5 locations from saved posts
 - Export data to CSV
+
+Run with --record FILE to save Instagram's responses, then with --replay FILE to repeat the
+same run offline (no .env, network access or rate limiting needed).
 """
 
+import argparse
 import os
 import sys
 from pathlib import Path
-from instagram_location_extractor import InstagramLocationExtractor
+from instagram_location_extractor import InstagramLocationExtractor, ResponseRecorder
 
 
 def load_credentials():
@@ -47,24 +51,32 @@ def load_credentials():
     return username, password
 
 
-def run_integration_test():
-    """Run the full integration test"""
+def run_integration_test(record=None, replay=None):
+    """Run the full integration test, optionally recording or replaying Instagram's responses"""
     print("=" * 70)
     print("Instagram Location Extractor - Integration Test")
     print("=" * 70)
 
     # Load credentials
-    print("\n[1/5] Loading credentials from .env file...")
-    username, password = load_credentials()
+    if replay:
+        print(f"\n[1/5] Replaying the run recorded in {replay} (no credentials needed)...")
+        username, password = '', ''
+    else:
+        print("\n[1/5] Loading credentials from .env file...")
+        username, password = load_credentials()
 
-    if not username or not password:
-        return False
+        if not username or not password:
+            return False
 
-    print(f"✓ Loaded credentials for: {username}")
+        print(f"✓ Loaded credentials for: {username}")
 
     # Initialize extractor
     print("\n[2/5] Initializing Instagram extractor...")
-    extractor = InstagramLocationExtractor()
+    if replay:
+        recorder = ResponseRecorder(replay)
+    else:
+        recorder = ResponseRecorder(record, mode='record') if record else None
+    extractor = InstagramLocationExtractor(recorder=recorder)
     print("✓ Extractor initialized")
 
     # Login
@@ -109,7 +121,7 @@ def run_integration_test():
     # Show sample locations
     print("\nSample locations found:")
     for i, loc in enumerate(locations[:5], 1):
-        print(f"  {i}. {loc['name']} ({loc['latitude']}, {loc['longitude']})")
+        print(f"  {i}. {loc.name} ({loc.latitude}, {loc.longitude})")
 
     if location_count > 5:
         print(f"  ... and {location_count - 5} more")
@@ -121,9 +133,15 @@ def run_integration_test():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Integration test against Instagram")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='FILE', help="save Instagram's responses to FILE")
+    mode.add_argument('--replay', metavar='FILE', help="replay a recorded run from FILE, offline")
+    args = parser.parse_args()
+
     print("\n🔒 Security Note: Credentials are loaded from .env (not in git)\n")
 
-    success = run_integration_test()
+    success = run_integration_test(record=args.record, replay=args.replay)
 
     if success:
         print("\n✅ All tests passed! The Instagram location extractor is working.")